@@ -0,0 +1 @@
+''' Benchmarks of bayes_mapvar '''
@@ -0,0 +1,92 @@
+''' Synthetic models for benchmarking '''
+import inspect
+
+import numpy as np
+
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+tfd = tfp.distributions
+
+
+def _node_function(args, body):
+    """ Function of the named model nodes, since dist_dict callables
+        are matched to nodes by their argument names, calling body with
+        the values of args in order
+    """
+    def function(**kwargs):
+        return body(*[kwargs[arg] for arg in args])
+    function.__signature__ = inspect.Signature(
+        [inspect.Parameter(arg, inspect.Parameter.KEYWORD_ONLY)
+         for arg in args])
+    return function
+
+
+def _likelihood(covariates, coefficients, *scales):
+    scale = 1.0
+    for value in scales:
+        scale = scale + value
+    return tfd.Normal(loc=tf.linalg.matvec(covariates, coefficients),
+                      scale=scale)
+
+
+def make_model(n_rows, n_params, depth=1, n_constraints=1, seed=0):
+    """ Linear regression with a chain of deterministic nodes and
+        log-transformed scale parameters
+
+        y ~ Normal(x beta, 1 + s_1 + ... + s_k) where beta has
+        n_params elements and passes through depth Deterministic
+        nodes, and s_i = exp(unconstrained_s_i) are the
+        n_constraints constrained parameters.
+
+        Parameters:
+        -------
+        n_rows: int
+            number of observations
+
+        n_params: int
+            number of regression coefficients
+
+        depth: int, default value = 1
+            number of Deterministic nodes between the coefficients
+            and the likelihood
+
+        n_constraints: int, default value = 1
+            number of constrained scale parameters
+
+        seed: int, default value = 0
+            seed of the simulated data
+
+        Returns:
+        -------
+        dictionary of the mapvar arguments dist_dict, observed_data,
+        observed_varnames and constrained_fcns
+    """
+    rng = np.random.default_rng(seed)
+    covariates = rng.normal(size=(n_rows, n_params)) / np.sqrt(n_params)
+    beta = rng.normal(size=n_params)
+    response = covariates @ beta + \
+        (1 + n_constraints) * rng.normal(size=n_rows)
+
+    dist_dict = {'unconstrained_beta': tfd.Normal(
+        tf.zeros(n_params, dtype=tf.float64), 1)}
+    previous = 'unconstrained_beta'
+    for level in range(depth):
+        node = 'beta_' + str(level)
+        dist_dict[node] = _node_function(
+            [previous], lambda value: tfd.Deterministic(loc=value))
+        previous = node
+    scales = []
+    constrained_fcns = {}
+    for index in range(n_constraints):
+        name = 's_' + str(index)
+        dist_dict['unconstrained_' + name] = tfd.Normal(
+            tf.zeros(1, dtype=tf.float64), 1)
+        constrained_fcns[name] = _node_function(
+            ['unconstrained_' + name], tf.exp)
+        scales.append(name)
+    dist_dict['y'] = _node_function(['x', previous] + scales, _likelihood)
+    return {"dist_dict": dist_dict,
+            "observed_data": {'x': covariates, 'y': response},
+            "observed_varnames": ['y'],
+            "constrained_fcns": constrained_fcns}
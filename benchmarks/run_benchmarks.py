@@ -0,0 +1,305 @@
+''' Benchmark suite for MAP and posterior variance estimation
+
+Times the traverse_dist overhead, the compiled loss and gradient, the
+MAP fit and get_hessian_delta_variance separately on synthetic models
+(benchmarks.models.make_model) that scale the number of rows, the
+number of parameters, the depth of the model graph and the number of
+constrained functions. Each case runs in its own process, so the peak
+resident memory recorded is that of the case alone. The time to import
+the package and mapvar in a new process is recorded with each suite.
+
+Run from the project root directory:
+
+    python -m benchmarks.run_benchmarks --suite quick --output new.json
+    python -m benchmarks.run_benchmarks --compare old.json new.json
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+BASE_CASE = {"n_rows": 1000, "n_params": 2, "depth": 1, "n_constraints": 1}
+
+SUITES = {
+    "quick": {"n_rows": [100, 10000, 100000],
+              "n_params": [2, 100, 1000],
+              "depth": [1, 10],
+              "n_constraints": [1, 10]},
+    "full": {"n_rows": [100, 10000, 1000000, 10000000],
+             "n_params": [2, 100, 1000, 10000],
+             "depth": [1, 10, 100],
+             "n_constraints": [1, 10, 100]},
+}
+
+PHASES = ["traverse", "loss_and_gradient", "map", "variance"]
+
+# dense Hessians beyond this many parameters are not benchmarked
+MAX_VARIANCE_PARAMS = 2000
+
+# the design matrix is limited to this many elements
+MAX_DATA_SIZE = 10**8
+
+IMPORTS = {"package": "import bayes_mapvar",
+           "mapvar": "from bayes_mapvar import mapvar"}
+
+# import times are compared from this many seconds up, below it the
+# ratio of two fast imports is noise
+MIN_IMPORT_SECONDS = 0.05
+
+
+def suite_cases(suite):
+    """ Cases of a suite, varying one dimension of BASE_CASE at a time
+
+        Parameters:
+        -------
+        suite: string
+            name of a suite in SUITES
+
+        Returns:
+        -------
+        list of dictionaries of make_model arguments
+    """
+    cases = []
+    for dimension, values in SUITES[suite].items():
+        for value in values:
+            case = dict(BASE_CASE, **{dimension: value})
+            if case["n_rows"] * case["n_params"] > MAX_DATA_SIZE:
+                continue
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def _timed(function, repeat=1):
+    """ Smallest wall time of repeat calls of function, and its result"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_case(case, repeat=5):
+    """ Time the phases of one case in this process
+
+        Parameters:
+        -------
+        case: dict
+            make_model arguments
+
+        repeat: int, default value = 5
+            repetitions of the traverse and loss and gradient timings,
+            the fastest is kept
+
+        Returns:
+        -------
+        dictionary of the case, the seconds of each phase, None for
+        phases skipped, and the peak resident memory in MB
+    """
+    # pylint: disable=import-outside-toplevel
+    import tensorflow as tf
+    from benchmarks.models import make_model
+    from bayes_mapvar import mapvar, traverse_dist, ModelPlan, \
+        ParameterLayout, make_loss_and_gradient, get_bandwidths, \
+        get_hessian_delta_variance
+
+    model = make_model(**case)
+    result = dict(case)
+
+    plan = ModelPlan(model["dist_dict"], model["observed_varnames"],
+                     model["constrained_fcns"])
+    data = plan.prepare_data(model["observed_data"])
+    _, init = plan.initial_unconstrained(data)
+
+    result["traverse"], _ = _timed(lambda: traverse_dist(
+        model["dist_dict"], model["observed_data"],
+        model["observed_varnames"], generate="constrained",
+        constrained_fcns=model["constrained_fcns"],
+        unconstrained_par_dict=init), repeat)
+
+    layout = ParameterLayout.from_par_dict(init)
+    loss_and_gradient = make_loss_and_gradient(
+        lambda par_vec: -plan.log_prob(layout.unpack(par_vec), data),
+        "graph")
+    par_vec = layout.pack(init)
+    loss_and_gradient(par_vec)
+    result["loss_and_gradient"], _ = _timed(
+        lambda: [value.numpy() for value in loss_and_gradient(par_vec)],
+        repeat)
+
+    result["map"], fit = _timed(lambda: mapvar(
+        **model, compile_mode="graph"))
+    result["map_iterations"] = int(fit[2].nit)
+
+    result["variance"] = None
+    if layout.size <= MAX_VARIANCE_PARAMS:
+        constrained_layout = ParameterLayout.from_par_dict(fit[1])
+        par_map = layout.pack(fit[0])
+
+        def constrained_vec(par_vec):
+            return constrained_layout.pack(
+                plan.constrained(layout.unpack(par_vec), data))
+
+        result["variance"], _ = _timed(lambda: get_hessian_delta_variance(
+            par_map.numpy(), None, constrained_vec,
+            get_bandwidths(par_map), layout, constrained_layout,
+            loss_and_gradient, as_frames=False))
+
+    result["peak_rss_mb"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["tensorflow"] = tf.__version__
+    return result
+
+
+def import_times(repeat=5):
+    """ Time each statement of IMPORTS in a new Python process
+
+        Returns:
+        -------
+        dictionary of the smallest wall time in seconds of each
+        statement over repeat processes
+    """
+    times = {}
+    for name, statement in IMPORTS.items():
+        code = "import time\nstart = time.perf_counter()\n" + \
+            statement + "\nprint(time.perf_counter() - start)"
+        best = np.inf
+        for _ in range(repeat):
+            completed = subprocess.run(
+                [sys.executable, "-c", code], capture_output=True,
+                text=True, check=True,
+                env=dict(os.environ, TF_CPP_MIN_LOG_LEVEL="2"))
+            best = min(best, float(completed.stdout.strip().splitlines()[-1]))
+        times[name] = best
+    return times
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(suite, repeat=5):
+    """ Run every case of a suite, each in a new process
+
+        Returns:
+        -------
+        dictionary of the commit, platform and list of case results
+    """
+    results = []
+    for case in suite_cases(suite):
+        print("running", case, flush=True)
+        completed = subprocess.run(
+            [sys.executable, "-m", "benchmarks.run_benchmarks",
+             "--case", json.dumps(case), "--repeat", str(repeat)],
+            capture_output=True, text=True, check=False,
+            env=dict(os.environ, TF_CPP_MIN_LOG_LEVEL="2"))
+        if completed.returncode != 0:
+            print(completed.stderr[-2000:], file=sys.stderr)
+            results.append(dict(case, error=completed.returncode))
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return {"commit": _git_commit(),
+            "suite": suite,
+            "imports": import_times(repeat),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "cases": results}
+
+
+def _case_key(result):
+    return tuple(result[key] for key in BASE_CASE)
+
+
+def compare(baseline, current, threshold=1.2):
+    """ Print the ratio of current to baseline seconds and peak memory
+        of each case and phase, marking ratios above threshold
+
+        Returns:
+        -------
+        number of regressions
+    """
+    baseline_cases = {_case_key(result): result
+                      for result in baseline["cases"]}
+    regressions = 0
+    columns = PHASES + ["peak_rss_mb"]
+    print("case (rows, params, depth, constraints)".ljust(36) +
+          "".join(column.rjust(19) for column in columns))
+    for result in current["cases"]:
+        old = baseline_cases.get(_case_key(result))
+        if old is None:
+            continue
+        line = str(_case_key(result)).ljust(36)
+        for column in columns:
+            if old.get(column) is None or result.get(column) is None:
+                line = line + "-".rjust(19)
+                continue
+            ratio = result[column] / old[column]
+            flag = " !" if ratio > threshold else "  "
+            regressions = regressions + (ratio > threshold)
+            line = line + (f"{ratio:.2f}" + flag).rjust(19)
+        print(line)
+    for name, seconds in current.get("imports", {}).items():
+        old = baseline.get("imports", {}).get(name)
+        if old is None:
+            continue
+        ratio = max(seconds, MIN_IMPORT_SECONDS) / \
+            max(old, MIN_IMPORT_SECONDS)
+        flag = " !" if ratio > threshold else "  "
+        regressions = regressions + (ratio > threshold)
+        print(("import " + name).ljust(36) +
+              (f"{ratio:.2f}" + flag).rjust(19) + f"{seconds:.3f}s".rjust(19))
+    print(str(regressions) + " regressions above " + str(threshold) +
+          "x of " + str(baseline.get("commit")))
+    return regressions
+
+
+def main():
+    ''' Command line entry point '''
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--suite", choices=list(SUITES), default="quick")
+    parser.add_argument("--output",
+                        help="JSON file to save the results to")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--compare", nargs=2,
+                        metavar=("BASELINE", "CURRENT"),
+                        help="compare two saved results")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        print(json.dumps(run_case(json.loads(args.case), args.repeat)))
+        return 0
+    if args.compare is not None:
+        with open(args.compare[0], encoding="utf-8") as file:
+            baseline = json.load(file)
+        with open(args.compare[1], encoding="utf-8") as file:
+            current = json.load(file)
+        return 1 if compare(baseline, current, args.threshold) else 0
+
+    results = run_suite(args.suite, args.repeat)
+    output = args.output or os.path.join(
+        "benchmarks", "results",
+        args.suite + "_" + str(results["commit"]) + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=1)
+    print("saved to " + output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,4 +5,4 @@ set -e
 script_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 cd $script_dir/..
 
-find bin tests src -name "*.py" | xargs pylint
+find bin tests src benchmarks -name "*.py" | xargs pylint
@@ -0,0 +1,15 @@
+#!/bin/bash
+# Make it so that any command that fails in here also fails the script and causes a build error
+set -e
+
+script_dir="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+cd $script_dir/..
+
+if test -f venv/bin/activate; then
+    . venv/bin/activate
+fi
+
+# Arguments are passed on, e.g.
+#   bin/run_benchmarks.sh --suite full
+#   bin/run_benchmarks.sh --compare benchmarks/results/quick_abc1234.json benchmarks/results/quick_def5678.json
+python -m benchmarks.run_benchmarks "$@"
@@ -1,7 +1,72 @@
-from .mapvar import mapvar
-from .map_utils import par_vec_from_dict
-from .map_utils import par_dict_from_vec
-from .map_utils import traverse_dist
-from .var_utils import get_bandwidths
-from .var_utils import get_hessian_delta_variance
+''' Bayesian posterior mode and variance estimation
 
+The public functions and classes are imported from their modules on
+first access, so that importing the package does not import
+TensorFlow, TensorFlow Probability, SciPy or pandas.
+'''
+import importlib
+import sys
+import types
+import typing
+
+if typing.TYPE_CHECKING:
+    from bayes_mapvar.mapvar import mapvar, mapvar_batch, mapvar_update, \
+        compare_models
+    from bayes_mapvar.result import MapVarResult
+    from bayes_mapvar.map_utils import par_vec_from_dict, \
+        par_dict_from_vec, traverse_dist, ModelPlan, ParameterLayout, \
+        make_loss_and_gradient
+    from bayes_mapvar.var_utils import get_bandwidths, \
+        get_hessian_delta_variance, get_autodiff_hessian_delta, \
+        hessian_vector_product
+    from bayes_mapvar.profiling import Profiler
+
+_EXPORTS = {
+    "mapvar": "mapvar",
+    "mapvar_batch": "mapvar",
+    "mapvar_update": "mapvar",
+    "compare_models": "mapvar",
+    "MapVarResult": "result",
+    "par_vec_from_dict": "map_utils",
+    "par_dict_from_vec": "map_utils",
+    "traverse_dist": "map_utils",
+    "ModelPlan": "map_utils",
+    "ParameterLayout": "map_utils",
+    "make_loss_and_gradient": "map_utils",
+    "get_bandwidths": "var_utils",
+    "get_hessian_delta_variance": "var_utils",
+    "get_autodiff_hessian_delta": "var_utils",
+    "hessian_vector_product": "var_utils",
+    "Profiler": "profiling",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module " + __name__ + " has no attribute " +
+                             name)
+    value = getattr(importlib.import_module("." + _EXPORTS[name],
+                                            __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+class _Package(types.ModuleType):
+    """ Keeps an exported function when the import system sets the
+        submodule of the same name (bayes_mapvar.mapvar) on the package
+    """
+    def __setattr__(self, name, value):
+        if isinstance(value, types.ModuleType) and \
+                value.__name__ == __name__ + "." + name and \
+                _EXPORTS.get(name) == name:
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
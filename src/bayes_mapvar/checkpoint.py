@@ -0,0 +1,193 @@
+''' Checkpoints of long running MAP fits and Hessian computations'''
+import json
+import os
+import time
+
+import numpy as np
+
+from bayes_mapvar.exceptions import MapVarException
+
+MANIFEST = "manifest.json"
+OPTIMIZER = "optimizer.npz"
+HESSIAN = "hessian.npz"
+_FORMAT_VERSION = 1
+
+# iterates and gradients kept for the curvature pairs of a resumed
+# L-BFGS-B, its default number of corrections plus one
+HISTORY_SIZE = 11
+
+_RESULT_FIELDS = {"fun": float, "success": bool, "status": int,
+                  "nit": int, "nfev": int, "message": str}
+
+
+class Checkpoint:
+    """ Directory of checkpoints of a mapvar fit
+
+        The optimizer iterate with the history of its objective values,
+        the last iterates and gradients, and the Hessian and Delta
+        columns completed so far are written at most every interval
+        seconds. Each file is replaced atomically, so a job preempted
+        while writing leaves the previous checkpoint intact.
+
+        Parameters:
+        -------
+        path: string
+            directory to write checkpoints to, created if missing
+
+        layout: ParameterLayout
+            layout of the unconstrained parameter vector, checked
+            against the checkpoints resumed from
+
+        interval: float, default value = 60.0
+            least number of seconds between two writes of the
+            optimizer or Hessian checkpoint
+
+        resume_from: string (optional)
+            directory of checkpoints to continue from, often path.
+            Nothing is resumed when it holds no checkpoint.
+    """
+    def __init__(self, path, layout, interval=60.0, resume_from=None):
+        self.path = path
+        self.interval = interval
+        self.manifest = {"version": _FORMAT_VERSION,
+                         "names": list(layout.names),
+                         "sizes": [layout.sizes[name]
+                                   for name in layout.names]}
+        self.optimizer = None
+        self._hessian = None
+        if resume_from is not None:
+            self._resume(resume_from)
+        self.fun_history = [] if self.optimizer is None else \
+            list(self.optimizer["fun_history"])
+        self._iterates = [] if self.optimizer is None else \
+            list(self.optimizer["iterates"])
+        self._gradients = [] if self.optimizer is None else \
+            list(self.optimizer["gradients"])
+        self._nit = 0 if self.optimizer is None else \
+            int(self.optimizer["nit"])
+        self._written = {OPTIMIZER: -np.inf, HESSIAN: -np.inf}
+        os.makedirs(path, exist_ok=True)
+        if resume_from is None or \
+                os.path.abspath(resume_from) != os.path.abspath(path):
+            for name in [OPTIMIZER, HESSIAN]:
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+        with open(os.path.join(path, MANIFEST), "w",
+                  encoding="utf-8") as file:
+            json.dump(self.manifest, file)
+
+    def _resume(self, path):
+        try:
+            with open(os.path.join(path, MANIFEST), encoding="utf-8") \
+                    as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            return
+        if manifest != self.manifest:
+            raise MapVarException('checkpoint in ' + str(path) + ' is of another model or version')
+        for name in [OPTIMIZER, HESSIAN]:
+            try:
+                with np.load(os.path.join(path, name)) as arrays:
+                    state = {key: arrays[key] for key in arrays.files}
+            except FileNotFoundError:
+                continue
+            if name == OPTIMIZER:
+                self.optimizer = state
+            else:
+                self._hessian = state
+
+    def _save(self, name, force, **arrays):
+        now = time.monotonic()
+        if not force and now - self._written[name] < self.interval:
+            return
+        temporary = os.path.join(self.path, name + ".tmp.npz")
+        np.savez(temporary, **arrays)
+        os.replace(temporary, os.path.join(self.path, name))
+        self._written[name] = now
+
+    @property
+    def optimized(self):
+        """ Did the resumed checkpoint hold a finished optimization?"""
+        return self.optimizer is not None and bool(self.optimizer["done"])
+
+    def record_iteration(self, par_vec, fun, gradient):
+        """ Add an optimizer iteration, written if interval has passed"""
+        self._nit = self._nit + 1
+        self.fun_history.append(float(fun))
+        self._iterates = (self._iterates + [np.array(par_vec)]
+                          )[-HISTORY_SIZE:]
+        self._gradients = (self._gradients + [np.array(gradient)]
+                           )[-HISTORY_SIZE:]
+        self._save(OPTIMIZER, False, **self._optimizer_arrays(par_vec))
+
+    def finish_optimization(self, scipyopt):
+        """ Write the final optimization result"""
+        arrays = self._optimizer_arrays(scipyopt.x, done=True)
+        arrays["jac"] = np.asarray(scipyopt.jac)
+        for field, kind in _RESULT_FIELDS.items():
+            arrays[field] = np.asarray(kind(scipyopt.get(field, 0)))
+        self._save(OPTIMIZER, True, **arrays)
+
+    def _optimizer_arrays(self, par_vec, done=False):
+        return {"x": np.asarray(par_vec), "done": np.asarray(done),
+                "nit": np.asarray(self._nit),
+                "fun_history": np.asarray(self.fun_history),
+                "iterates": np.asarray(self._iterates),
+                "gradients": np.asarray(self._gradients)}
+
+    @property
+    def nit(self):
+        """ Optimizer iterations recorded, including resumed ones"""
+        return self._nit
+
+    def inverse_hessian(self):
+        """ L-BFGS inverse Hessian estimate from the curvature pairs
+            of the recorded iterates and gradients, None without pairs
+        """
+        # pylint: disable=import-outside-toplevel
+        import scipy.optimize
+        steps = np.diff(np.asarray(self._iterates), axis=0)
+        changes = np.diff(np.asarray(self._gradients), axis=0)
+        if len(steps) == 0:
+            return None
+        keep = np.sum(steps * changes, axis=1) > 0
+        if not np.any(keep):
+            return None
+        return scipy.optimize.LbfgsInvHessProduct(steps[keep],
+                                                  changes[keep])
+
+    def optimize_result(self):
+        """ OptimizeResult of the finished optimization resumed from"""
+        # pylint: disable=import-outside-toplevel
+        import scipy.optimize
+        result = scipy.optimize.OptimizeResult(
+            x=np.array(self.optimizer["x"]),
+            jac=np.array(self.optimizer["jac"]),
+            **{field: kind(self.optimizer[field])
+               for field, kind in _RESULT_FIELDS.items()})
+        hess_inv = self.inverse_hessian()
+        if hess_inv is not None:
+            result.hess_inv = hess_inv
+        return result
+
+    def hessian_columns(self, par_vec, bandwidths):
+        """ Hessian, Delta and completed column mask resumed from, None
+            unless computed at the same point with the same bandwidths
+        """
+        if self._hessian is None or \
+                not np.array_equal(self._hessian["par_vec"], par_vec) or \
+                not np.array_equal(self._hessian["bandwidths"],
+                                   bandwidths):
+            return None
+        return (np.array(self._hessian["hessian"]),
+                np.array(self._hessian["delta"]),
+                np.array(self._hessian["done"]))
+
+    def record_columns(self, par_vec, bandwidths, hessian, delta, done,
+                       force=False):
+        """ Write the Hessian and Delta columns completed so far, if
+            interval has passed or force
+        """
+        self._save(HESSIAN, force, par_vec=np.asarray(par_vec),
+                   bandwidths=np.asarray(bandwidths), hessian=hessian,
+                   delta=delta, done=done)
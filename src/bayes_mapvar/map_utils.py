@@ -1,17 +1,108 @@
 ''' Utilities for Maximum A Posteriori (MAP) estimation'''
+import functools
 from inspect import signature
+import zlib
 import numpy as np
-import pandas as pd
-import scipy.optimize
 
 import tensorflow as tf
 import tensorflow_probability as tfp
 
+from bayes_mapvar import profiling
 from bayes_mapvar.exceptions import MapVarException
 
 tfd = tfp.distributions
 tfb = tfp.bijectors
 
+class ParameterLayout:
+    """ Positions of parameters in a flattened parameter vector
+
+        Built once from a parameter dictionary, the layout holds the
+        names, shapes, sizes and offsets of the parameters, so packing
+        a dictionary is one tf.concat and unpacking a vector is one
+        tf.split, without recomputing sizes and slices on every call.
+
+        Parameters:
+        -------
+        shapes: dict
+            dictionary of parameter shapes, in the order of the
+            parameter vector
+    """
+    def __init__(self, shapes):
+        self.names = list(shapes)
+        self.shapes = {name: tuple(int(dim) for dim in shape)
+                       for name, shape in shapes.items()}
+        self.sizes = {name: int(np.prod(shape, dtype=int))
+                      for name, shape in self.shapes.items()}
+        self.offsets = {}
+        offset = 0
+        for name in self.names:
+            self.offsets[name] = offset
+            offset = offset + self.sizes[name]
+        self.size = offset
+        self.labels = []
+        for name in self.names:
+            if self.sizes[name] > 1:
+                self.labels.extend(name + "_" + str(i)
+                                   for i in range(self.sizes[name]))
+            else:
+                self.labels.append(name)
+        self._split_sizes = [self.sizes[name] for name in self.names]
+
+    @classmethod
+    def from_par_dict(cls, par_dict):
+        """ Layout of a dictionary of parameter values"""
+        return cls({name: value.shape if hasattr(value, "shape")
+                    else np.shape(value)
+                    for name, value in par_dict.items()})
+
+    @classmethod
+    def from_sizes(cls, par_size):
+        """ Layout of flat parameters from a dictionary of sizes, or
+            the layout itself when given a ParameterLayout
+        """
+        if isinstance(par_size, cls):
+            return par_size
+        return cls({name: (int(size),) for name, size in par_size.items()})
+
+    def pack(self, par_dict):
+        """ Parameter vector from a parameter dictionary"""
+        if not self.names:
+            return tf.zeros(0, dtype=tf.float64)
+        return tf.concat([tf.reshape(par_dict[name], [-1])
+                          for name in self.names], 0)
+
+    def unpack(self, par_vec):
+        """ Parameter dictionary from a parameter vector, or from a
+            [..., size] tensor of parameter vectors with the leading
+            dimensions kept
+        """
+        if not self.names:
+            return {}
+        par_vec = tf.convert_to_tensor(par_vec)
+        batch_shape = [-1 if dim is None else dim
+                       for dim in par_vec.shape[:-1].as_list()]
+        parts = tf.split(par_vec, self._split_sizes, axis=-1)
+        return {name: tf.reshape(part, batch_shape + list(self.shapes[name]))
+                for name, part in zip(self.names, parts)}
+
+    def rows(self, name):
+        """ Positions of a parameter in the parameter vector"""
+        return np.arange(self.offsets[name],
+                         self.offsets[name] + self.sizes[name])
+
+    def index(self, names=None):
+        """ Positions of the named parameters in the parameter vector,
+            all positions when names is None
+        """
+        if names is None:
+            return np.arange(self.size)
+        unknown = [name for name in names if name not in self.sizes]
+        if unknown:
+            raise MapVarException('unknown parameters: ' + ', '.join(unknown))
+        if not names:
+            return np.zeros(0, dtype=int)
+        return np.concatenate([self.rows(name) for name in names])
+
 def par_vec_from_dict(par_dict):
     """ Get parameter vector from parameter dictionary
 
@@ -24,15 +115,17 @@ def par_vec_from_dict(par_dict):
         -------
         Parameter vector
     """
-    keylist = list(par_dict.keys())
-    init_vec = tf.zeros(0,dtype=tf.float64)
-    for key in keylist:
-        init_vec = tf.concat([init_vec,tf.reshape(par_dict[key],-1)], 0)
-    return init_vec
+    if not par_dict:
+        return tf.zeros(0, dtype=tf.float64)
+    return tf.concat([tf.reshape(value, [-1])
+                      for value in par_dict.values()], 0)
 
 def par_dict_from_vec(par_vec, par_dict_ref):
     """ Get parameter dictionary from parameter vector
 
+        Builds a ParameterLayout on every call, keep a layout for
+        repeated conversions.
+
         Parameters:
         -------
         par_vec: 1D tensor
@@ -46,15 +139,712 @@ def par_dict_from_vec(par_vec, par_dict_ref):
         -------
         Parameter dictionary
     """
-    pardict = {}
-    parindex = 0
-    for key in par_dict_ref.keys():
-        keysize = tf.size(par_dict_ref[key])
-        keyshape = par_dict_ref[key].shape
-        keypar = par_vec[parindex:(parindex + keysize)]
-        parindex = parindex + keysize
-        pardict[key] = tf.reshape(keypar, keyshape)
-    return pardict
+    return ParameterLayout.from_par_dict(par_dict_ref).unpack(par_vec)
+
+def is_chunked(observed_data):
+    """ Is observed data given in chunks?
+
+        Chunked observed data is a list or tuple of dictionaries of
+        observed data, a tf.data.Dataset of such dictionaries, or a
+        function returning a new iterator over such dictionaries each
+        time it is called.
+    """
+    return isinstance(observed_data, (list, tuple, tf.data.Dataset)) \
+        or callable(observed_data)
+
+def iter_chunks(observed_data):
+    """ Iterate over the chunks of chunked observed data
+
+        Parameters:
+        -------
+        observed_data: list, tf.data.Dataset or function
+            chunked observed data, see is_chunked
+
+        Returns:
+        -------
+        iterator over dictionaries of observed data
+    """
+    chunks = observed_data() if callable(observed_data) \
+        else observed_data
+    chunk_iter = iter(chunks)
+    if chunk_iter is chunks and not callable(observed_data):
+        raise MapVarException('observed_data is read for every loss evaluation, pass a list, a tf.data.Dataset or a function returning an iterator rather than an iterator')
+    return chunk_iter
+
+def make_loss_and_gradient(loss, compile_mode=None, has_aux=False):
+    """ Wrap a loss function so that it returns its value and gradient
+
+        Parameters:
+        -------
+        loss: function
+            scalar function of a 1D parameter tensor and optionally
+            further arguments, such as a chunk of observed data
+
+        compile_mode: string (optional)
+            None: evaluate eagerly
+            "graph": trace the loss and gradient once with tf.function
+            "xla": as "graph", additionally compiled with XLA
+
+            Traces are reused across calls and only retraced when the
+            shape of the parameter vector changes.
+
+        has_aux: boolean, default value = False
+            loss returns a pair of the loss and auxiliary values that
+            are not differentiated, such as the constrained parameters
+            computed in the same traversal
+
+        Returns:
+        -------
+        function returning the loss value and gradient with respect
+        to the 1D parameter tensor, taking the same arguments as loss.
+        With has_aux the loss value is replaced by the pair returned
+        by loss.
+    """
+    if compile_mode not in [None, "graph", "xla"]:
+        raise MapVarException('invalid value for compile_mode argument')
+
+    def loss_and_gradient(par_vec, *args):
+        return tfp.math.value_and_gradient(
+            lambda par_vec: loss(par_vec, *args), par_vec, has_aux=has_aux)
+
+    if compile_mode is None:
+        return loss_and_gradient
+    return tf.function(loss_and_gradient,
+                       jit_compile=compile_mode == "xla")
+
+
+def cache_by_vector(function, maxsize=64):
+    """ Least recently used cache of a function of a parameter vector
+
+        Parameters:
+        -------
+        function: function
+            function of a 1D float64 NumPy parameter vector, its results
+            must not be modified by the caller
+
+        maxsize: int, default value = 64
+            number of parameter vectors kept
+
+        Returns:
+        -------
+        function of a 1D parameter vector calling function only for
+        vectors not among the last maxsize distinct ones, with the
+        cache_info and cache_clear methods of functools.lru_cache
+    """
+    @functools.lru_cache(maxsize=maxsize)
+    def cached(key):
+        return function(np.frombuffer(key, np.float64))
+
+    def wrapper(par_vec):
+        return cached(np.ascontiguousarray(par_vec, np.float64).tobytes())
+    wrapper.cache_info = cached.cache_info
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+class ModelPlan:
+    """ Compiled evaluation plan for a model
+
+        The dependency graph of dist_dict and constrained_fcns is
+        topologically sorted once, the argument lists of all callables
+        are cached and every node is classified as one of
+
+        "observed" : observed variable, contributes to the log
+                     likelihood
+
+        "free" : unconstrained parameter, contributes to the prior
+
+        "deterministic" : callable in dist_dict returning a
+                          Deterministic distribution
+
+        "constraint" : function in constrained_fcns
+
+        "data" : argument of a callable that is not in dist_dict or
+                 constrained_fcns, such as a covariate, taken from the
+                 observed data
+
+        Evaluation then walks a flat list of precompiled steps
+        instead of rediscovering the graph on every call.
+
+        Parameters:
+        -------
+        dist_dict: dict
+            dictonary of distributions representing unconstrained
+            parameters (prior) and observed data likliehood, jointly
+            the posterior.
+
+        observed_varnames: list
+            list of observed varaibles in dist_dict
+
+        constrained_fcns: dictionary (optional)
+            dictionary of functions mapping the unconstrained
+            parameters to the constrained and transformed parameters
+
+        dtype: tf.DType or string (optional)
+            floating point type to evaluate the model in, such as
+            tf.float32. Floating point data and parameter values are
+            cast to dtype, priors built outside callables keep their
+            own dtype, and log densities are summed in float64.
+            Callables in dist_dict must then not hard-code float64.
+            Defaults to the types of the data and priors as given.
+    """
+    def __init__(self, dist_dict, observed_varnames=None,
+                 constrained_fcns=None, dtype=None):
+        self.dist_dict = dist_dict
+        self.dtype = None if dtype is None else tf.as_dtype(dtype)
+        self.constrained_fcns = {} if constrained_fcns is None \
+            else constrained_fcns
+        self.observed_varnames = [] if observed_varnames is None \
+            else list(observed_varnames)
+        self.callers = {}
+        self.args = {}
+        for node in list(dist_dict.keys()) + \
+                list(self.constrained_fcns.keys()):
+            if node in self.constrained_fcns:
+                caller = self.constrained_fcns[node]
+            elif callable(dist_dict[node]):
+                caller = dist_dict[node]
+            else:
+                caller = None
+            self.callers[node] = caller
+            self.args[node] = () if caller is None else \
+                tuple(signature(caller).parameters.keys())
+        self.order = self._sort()
+        self.kinds = {}
+        for node in self.order:
+            if node in self.constrained_fcns:
+                self.kinds[node] = "constraint"
+            elif node not in dist_dict:
+                self.kinds[node] = "data"
+            elif node in self.observed_varnames:
+                self.kinds[node] = "observed"
+            elif self.callers[node] is None:
+                self.kinds[node] = "free"
+        self._steps = {}
+
+    def _sort(self):
+        """ Topologically sort the nodes, parents before children"""
+        order = []
+        done = set()
+        active = set()
+        for root in list(self.args):
+            if root in done:
+                continue
+            stack = [(root, iter(self.args[root]))]
+            active.add(root)
+            while stack:
+                node, arg_iter = stack[-1]
+                arg = next(arg_iter, None)
+                if arg is None:
+                    stack.pop()
+                    active.discard(node)
+                    done.add(node)
+                    order.append(node)
+                elif arg in done:
+                    continue
+                elif arg in active:
+                    raise MapVarException(
+                        'cyclic dependency involving ' + arg)
+                elif arg not in self.args:
+                    self.callers[arg] = None
+                    self.args[arg] = ()
+                    done.add(arg)
+                    order.append(arg)
+                else:
+                    active.add(arg)
+                    stack.append((arg, iter(self.args[arg])))
+        return order
+
+    @property
+    def resolved(self):
+        """ Have all node kinds been determined?"""
+        return len(self.kinds) == len(self.order)
+
+    def prepare_data(self, observed_data):
+        """ Convert the observed variables and data nodes to tensors
+            once
+
+            Parameters:
+            -------
+            observed_data: dict
+                dictionary of observed data, tensors are used as they
+                are so that models can share them
+
+            Returns:
+            -------
+            dictionary of observed data tensors, keyed by observed
+            variable or data node name
+        """
+        data = {}
+        for node in self.order:
+            if self.kinds.get(node) in ("observed", "data"):
+                if node not in observed_data:
+                    raise MapVarException(node + ' is not in dist_dict, constrained_fcns or observed_data')
+                value = observed_data[node]
+                data[node] = self._cast(value if tf.is_tensor(value) else
+                                        tf.convert_to_tensor(
+                                            np.asarray(value)))
+        return data
+
+    def _cast(self, value):
+        """ value in the dtype of the plan, if floating point"""
+        if self.dtype is None or not value.dtype.is_floating or \
+                value.dtype == self.dtype:
+            return value
+        return tf.cast(value, self.dtype)
+
+    def _call(self, node, values):
+        return self.callers[node](
+            **{arg: values[arg] for arg in self.args[node]})
+
+    def initial_unconstrained(self, observed_data, method="zero",
+                              calc_log_prob=False, seed=None):
+        """ Generate unconstrained parameter values
+
+            Walking the graph once also determines which callables in
+            dist_dict return Deterministic distributions.
+
+            Parameters:
+            -------
+            observed_data: dict
+                dictionary of observed data
+
+            method: string, default value = "zero"
+                "zero": all unconstrained parameter values are zero
+                "sample_mean": unconstrained parameters are the mean of
+                               100 samples of their distribution.
+                "sample": unconstrained parameters are a single draw
+                          from their distribution.
+
+            calc_log_prob: boolean, default value = False
+                calculate the posterior density at the generated values?
+
+            seed: int (optional)
+                seed for method="sample"
+
+            Returns:
+            -------
+            log_prob: scalar
+                log probability density of posterior if calculated,
+                otherwise 0
+
+            unconstrained_par_dict: dictionary
+                dictionary of unconstrained parameter values
+        """
+        if method not in ["zero", "sample_mean", "sample"]:
+            raise MapVarException(
+                'invalid value for unconstrained_generate argument')
+        values = {}
+        unconstrained_par_dict = {}
+        log_probs = []
+        for node in self.order:
+            kind = self.kinds.get(node)
+            if kind == "constraint":
+                values[node] = self._call(node, values)
+                continue
+            if kind == "data" or (kind == "observed" and
+                                  not calc_log_prob):
+                values[node] = observed_data[node]
+                continue
+            if self.callers[node] is None:
+                dist = self.dist_dict[node]
+            else:
+                dist = self._call(node, values)
+            if kind == "observed":
+                values[node] = observed_data[node]
+            elif self.callers[node] is not None and \
+                    isinstance(dist, (tfd.Deterministic,
+                                      tfd.VectorDeterministic)):
+                self.kinds[node] = "deterministic"
+                values[node] = dist.loc
+                continue
+            else:
+                self.kinds[node] = "free"
+                if method == "zero":
+                    values[node] = tf.zeros(
+                        dist.batch_shape + dist.event_shape,
+                        dtype=dist.dtype)
+                elif method == "sample":
+                    values[node] = dist.sample(
+                        seed=None if seed is None else
+                        seed + self.order.index(node))
+                else:
+                    values[node] = tf.reduce_mean(
+                        dist.sample(100), axis=0)
+                unconstrained_par_dict[node] = values[node]
+                values[node] = self._cast(values[node])
+            if calc_log_prob:
+                log_probs.append(_reduce_log_prob(
+                    dist.log_prob(_like(values[node], dist)), self.dtype))
+        return _sum_log_probs(log_probs), unconstrained_par_dict
+
+    def _compile(self, mode, calc_log_prob, weighted):
+        """ Build the flat list of steps for one evaluation mode"""
+        steps = []
+        for node in self.order:
+            kind = self.kinds[node]
+            caller = self.callers[node]
+            if kind == "data":
+                steps.append(_value_step(node, "data"))
+            elif kind == "constraint":
+                steps.append(_constraint_step(node, caller,
+                                              self.args[node]))
+            elif kind == "deterministic":
+                steps.append(_deterministic_step(node, caller,
+                                                 self.args[node]))
+            elif kind == "free":
+                if calc_log_prob and mode != "likelihood":
+                    steps.append(_free_step(node, caller,
+                                            self.args[node],
+                                            self.dist_dict[node],
+                                            self.dtype))
+                else:
+                    steps.append(_value_step(node, "par"))
+            elif mode == "post_pred":
+                steps.append(_post_pred_step(node, caller,
+                                             self.args[node],
+                                             self.dist_dict[node],
+                                             calc_log_prob, self.dtype))
+            elif calc_log_prob:
+                steps.append(_observed_step(node, caller,
+                                            self.args[node],
+                                            self.dist_dict[node],
+                                            weighted, self.dtype))
+            else:
+                steps.append(_value_step(node, "data"))
+        return steps
+
+    def _run(self, mode, calc_log_prob, unconstrained_par_dict,
+             observed_data, weights=None, seed=None):
+        if not self.resolved:
+            self.initial_unconstrained(observed_data)
+        key = (mode, calc_log_prob, weights is not None)
+        if key not in self._steps:
+            self._steps[key] = self._compile(*key)
+        if self.dtype is not None:
+            unconstrained_par_dict = {
+                node: self._cast(tf.convert_to_tensor(value))
+                for node, value in unconstrained_par_dict.items()}
+        values = {}
+        aux = {"post_pred": {}, "weights": weights, "seed": seed}
+        log_probs = []
+        node_timer = profiling.node_timer(tf.executing_eagerly())
+        for node, step in zip(self.order, self._steps[key]):
+            if node_timer is None:
+                log_prob = step(values, unconstrained_par_dict,
+                                observed_data, aux)
+            else:
+                with node_timer(node):
+                    log_prob = step(values, unconstrained_par_dict,
+                                    observed_data, aux)
+            if log_prob is not None:
+                log_probs.append(log_prob)
+        return _sum_log_probs(log_probs), values, aux["post_pred"]
+
+    def _constrained_dict(self, values):
+        return {node: values[node] for node in self.order
+                if self.kinds[node] in ("constraint", "deterministic")}
+
+    def log_prob(self, unconstrained_par_dict, observed_data,
+                 weights=None):
+        """ Log posterior density
+
+            Parameters:
+            -------
+            unconstrained_par_dict: dictionary
+                dictionary of unconstrained parameter values
+
+            observed_data: dict
+                dictionary of observed data
+
+            weights: dict (optional)
+                weights of the elementwise log likelihood of each
+                observed variable, such as 0/1 masks of padded rows
+
+            Returns:
+            -------
+            scalar log probability density of the posterior
+        """
+        return self._run("constrained", True, unconstrained_par_dict,
+                         observed_data, weights)[0]
+
+    def log_likelihood(self, unconstrained_par_dict, observed_data,
+                       weights=None):
+        """ Log likelihood, the log posterior density without the
+            prior terms
+
+            Parameters:
+            -------
+            unconstrained_par_dict: dictionary
+                dictionary of unconstrained parameter values
+
+            observed_data: dict
+                dictionary of observed data
+
+            weights: dict (optional)
+                weights of the elementwise log likelihood of each
+                observed variable
+
+            Returns:
+            -------
+            scalar log likelihood
+        """
+        return self._run("likelihood", True, unconstrained_par_dict,
+                         observed_data, weights)[0]
+
+    def log_prob_and_constrained(self, unconstrained_par_dict,
+                                 observed_data, include_prior=True):
+        """ Log posterior density and constrained parameter values from
+            one traversal of the model
+
+            Parameters:
+            -------
+            unconstrained_par_dict: dictionary
+                dictionary of unconstrained parameter values
+
+            observed_data: dict
+                dictionary of observed data
+
+            include_prior: boolean, default value = True
+                False for the log likelihood instead of the log
+                posterior density
+
+            Returns:
+            -------
+            scalar log density and dictionary of constrained parameter
+            values
+        """
+        log_prob, values, _ = self._run(
+            "constrained" if include_prior else "likelihood", True,
+            unconstrained_par_dict, observed_data)
+        return log_prob, self._constrained_dict(values)
+
+    def constrained(self, unconstrained_par_dict, observed_data):
+        """ Constrained parameter values
+
+            Parameters:
+            -------
+            unconstrained_par_dict: dictionary
+                dictionary of unconstrained parameter values
+
+            observed_data: dict
+                dictionary of observed data
+
+            Returns:
+            -------
+            dictionary of constrained parameter values
+        """
+        _, values, _ = self._run("constrained", False,
+                                 unconstrained_par_dict, observed_data)
+        return self._constrained_dict(values)
+
+    def post_pred(self, unconstrained_par_dict, observed_data, seed=None):
+        """ Constrained parameters and posterior predictive draws
+
+            Parameters:
+            -------
+            unconstrained_par_dict: dictionary
+                dictionary of unconstrained parameter values
+
+            observed_data: dict
+                dictionary of observed data
+
+            seed: tensor (optional)
+                stateless int32 seed of shape [2], each observed
+                variable is drawn with a seed derived from it and its
+                name. Stateless seeds give reproducible, independent
+                draws under tf.vectorized_map.
+
+            Returns:
+            -------
+            constrained_par_dict: dictionary
+                dictionary of constrained parameter values
+
+            post_pred_dict: dictionary
+                dictionary of posterior predictive samples of observed
+                data
+        """
+        _, values, post_pred_dict = self._run(
+            "post_pred", False, unconstrained_par_dict, observed_data,
+            seed=seed)
+        return self._constrained_dict(values), post_pred_dict
+
+    def hessian_structure(self):
+        """ Unconstrained parameters that interact in the posterior
+
+            Two unconstrained parameters can only have a nonzero mixed
+            second derivative if they enter the same log density term,
+            and a constrained parameter only depends on the
+            unconstrained parameters upstream of it in the graph.
+
+            Returns:
+            -------
+            terms: list
+                one set of unconstrained parameter names per log
+                density term (prior or likelihood)
+
+            constrained_deps: dictionary
+                set of unconstrained parameter names each constrained
+                parameter depends on
+        """
+        if not self.resolved:
+            raise MapVarException('node kinds are unknown, call initial_unconstrained first')
+        upstream = {}
+        terms = []
+        constrained_deps = {}
+        for node in self.order:
+            parents = set()
+            for arg in self.args[node]:
+                parents = parents | upstream[arg]
+            kind = self.kinds[node]
+            if kind == "free":
+                upstream[node] = {node}
+                terms.append(parents | {node})
+            elif kind == "observed":
+                upstream[node] = set()
+                if parents:
+                    terms.append(parents)
+            elif kind == "data":
+                upstream[node] = set()
+            else:
+                upstream[node] = parents
+                constrained_deps[node] = parents
+        return terms, constrained_deps
+
+    def traverse(self, observed_data, generate, calc_log_prob=True,
+                 unconstrained_par_dict=None,
+                 unconstrained_generate="zero"):
+        """ Evaluate the plan, see traverse_dist for arguments"""
+        if generate == "unconstrained" and \
+                unconstrained_par_dict is not None:
+            raise MapVarException('cannot specify unconstrained_generate and unconstrained_par_dict simultaneously')
+
+        if unconstrained_generate not in ["zero", "sample_mean"]:
+            raise MapVarException('invalid value for generate argument')
+
+        if generate not in ["unconstrained", "constrained", "post_pred"]:
+            raise MapVarException('invalid value for generate argument')
+
+        if generate == "unconstrained":
+            log_prob, unconstrained_par_dict = \
+                self.initial_unconstrained(observed_data,
+                                           unconstrained_generate,
+                                           calc_log_prob)
+            return log_prob, unconstrained_par_dict, {}, {}
+        log_prob, values, post_pred_dict = self._run(
+            generate, calc_log_prob, unconstrained_par_dict,
+            observed_data)
+        return log_prob, unconstrained_par_dict, \
+            self._constrained_dict(values), post_pred_dict
+
+
+def _sum_log_probs(log_probs):
+    if not log_probs:
+        return tf.zeros([], dtype=tf.float64)
+    return tf.add_n(log_probs)
+
+
+def _reduce_log_prob(log_prob, dtype):
+    """ Sum of elementwise log densities, accumulated in float64 when
+        the plan evaluates the model in a reduced dtype
+    """
+    if dtype is None:
+        return tf.reduce_sum(log_prob)
+    return tf.reduce_sum(tf.cast(log_prob, tf.float64))
+
+
+def _like(value, dist):
+    """ value in the dtype of dist, for priors built in another dtype
+        than the plan
+    """
+    if dist.dtype is None or value.dtype == dist.dtype:
+        return value
+    return tf.cast(value, dist.dtype)
+
+
+def _constraint_step(node, caller, args):
+    def step(values, par_dict, data, aux):
+        # pylint: disable=unused-argument
+        values[node] = caller(**{arg: values[arg] for arg in args})
+    return step
+
+
+def _deterministic_step(node, caller, args):
+    def step(values, par_dict, data, aux):
+        # pylint: disable=unused-argument
+        values[node] = caller(**{arg: values[arg] for arg in args}).loc
+    return step
+
+
+def _value_step(node, source):
+    if source == "par":
+        def step(values, par_dict, data, aux):
+            # pylint: disable=unused-argument
+            values[node] = par_dict[node]
+    else:
+        def step(values, par_dict, data, aux):
+            # pylint: disable=unused-argument
+            values[node] = data[node]
+    return step
+
+
+def _free_step(node, caller, args, dist, dtype=None):
+    if caller is None:
+        def step(values, par_dict, data, aux):
+            # pylint: disable=unused-argument
+            values[node] = par_dict[node]
+            return _reduce_log_prob(
+                dist.log_prob(_like(values[node], dist)), dtype)
+    else:
+        def step(values, par_dict, data, aux):
+            # pylint: disable=unused-argument
+            values[node] = par_dict[node]
+            node_dist = caller(**{arg: values[arg] for arg in args})
+            return _reduce_log_prob(
+                node_dist.log_prob(_like(values[node], node_dist)), dtype)
+    return step
+
+
+def _observed_step(node, caller, args, dist, weighted, dtype=None):
+    if caller is None:
+        def node_log_prob(values):
+            return dist.log_prob(values[node])
+    else:
+        def node_log_prob(values):
+            return caller(**{arg: values[arg] for arg in args}).log_prob(
+                values[node])
+    if weighted:
+        def step(values, par_dict, data, aux):
+            # pylint: disable=unused-argument
+            values[node] = data[node]
+            log_prob = node_log_prob(values)
+            return _reduce_log_prob(
+                tf.cast(aux["weights"][node], log_prob.dtype) * log_prob,
+                dtype)
+    else:
+        def step(values, par_dict, data, aux):
+            # pylint: disable=unused-argument
+            values[node] = data[node]
+            return _reduce_log_prob(node_log_prob(values), dtype)
+    return step
+
+
+def _post_pred_step(node, caller, args, dist, calc_log_prob, dtype=None):
+    def step(values, par_dict, data, aux):
+        # pylint: disable=unused-argument
+        node_dist = dist if caller is None else \
+            caller(**{arg: values[arg] for arg in args})
+        if aux["seed"] is None:
+            values[node] = node_dist.sample()
+        else:
+            values[node] = node_dist.sample(seed=tf.bitwise.bitwise_xor(
+                aux["seed"], [0, zlib.crc32(node.encode()) & 0x7fffffff]))
+        aux["post_pred"][node] = values[node]
+        if calc_log_prob:
+            return _reduce_log_prob(node_dist.log_prob(values[node]), dtype)
+        return None
+    return step
+
 
 def traverse_dist(dist_dict, observed_data, observed_varnames,
                   generate, constrained_fcns=None, calc_log_prob = True,
@@ -90,7 +880,7 @@ def traverse_dist(dist_dict, observed_data, observed_varnames,
                             values from the input unconstrained_par_dict
                             unconstrained parameter values
 
-            "post pred" : generate a dictionary containing the constrained
+            "post_pred" : generate a dictionary containing the constrained
                           parameter values and new samples of the observed
                           variables based on the input unconstrained_par_dict
                           unconstrained parameter values.
@@ -111,7 +901,7 @@ def traverse_dist(dist_dict, observed_data, observed_varnames,
             If generate="unconstrained", indicates what method to use for
             obtaining unconstrained parameter values.
             "zero": all unconstrained parameter values are zero
-            "sample mean": unconstrained parameters are obtained by taking
+            "sample_mean": unconstrained parameters are obtained by taking
                            the mean of 100 samples of their distribution.
 
         Returns:
@@ -130,104 +920,12 @@ def traverse_dist(dist_dict, observed_data, observed_varnames,
             dictionary of posterior predictive samples of observed data
 
     """
-    log_prob_res = tf.zeros(1,dtype=tf.float64)
-    if generate == "unconstrained" and unconstrained_par_dict is not None:
-        raise MapVarException('cannot specify unconstrained_generate and unconstrained_par_dict simultaneously')
-
-    if unconstrained_generate not in ["zero", "sample_mean"]:
-        raise MapVarException('invalid value for generate argument')
-
-    if generate not in ["unconstrained","constrained","post_pred"]:
-        raise MapVarException('invalid value for generate argument')
-
-    constrained_par_dict = {}
-    post_pred_dict = {}
-    if generate == "unconstrained":
-        unconstrained_par_dict = {}
-
-    if constrained_fcns is None:
-        constrained_fcns = {}
-
-    vars_pars_to_do = list(dist_dict.keys()) + list(constrained_fcns.keys())
-
-    samp_dict = {}
-    while len(vars_pars_to_do) > 0:
-        var_par = vars_pars_to_do[0]
-        arg_dict = {}
-        arg_list = []
-        addback2vars_pars_to_do = False
-        samp_caller = None
-        if var_par in constrained_fcns:
-            samp_caller = constrained_fcns[var_par]
-            arg_list = list(signature(samp_caller).parameters.keys())
-        elif callable(dist_dict[var_par]):
-            samp_caller = dist_dict[var_par]
-            arg_list = list(signature(samp_caller).parameters.keys())
-        elif var_par not in observed_varnames:
-            if generate == "unconstrained":
-                if unconstrained_generate == "zero":
-                    samp_dict[var_par] = tf.zeros(
-                        dist_dict[var_par].batch_shape +
-                        dist_dict[var_par].event_shape,dtype=tf.float64)
-                else:
-                    samp_dict[var_par] = tf.reduce_mean(dist_dist[var_par].sample(100),axis=0)
-                unconstrained_par_dict[var_par] = samp_dict[var_par]
-            else:
-                samp_dict[var_par] = unconstrained_par_dict[var_par]
-            if calc_log_prob:
-                log_prob_res += tf.reduce_sum(
-                            dist_dict[var_par].log_prob(samp_dict[var_par]))
-        else:
-            if generate == "pred_post":
-                samp_dict[var_par] = dist_dict[var_par].sample()
-                post_pred_dict[var_par] = samp_dict[var_par]
-            else:
-                samp_dict[var_par] = observed_data[var_par]
-            if calc_log_prob:
-                log_prob_res += tf.reduce_sum(
-                            dist_dict[var_par].log_prob(samp_dict[var_par]))
-        for arg in arg_list:
-            if arg not in samp_dict:
-                addback2vars_pars_to_do = True
-                vars_pars_to_do_tmp = [arg]
-                vars_pars_to_do_tmp.extend(vars_pars_to_do)
-                vars_pars_to_do =  vars_pars_to_do_tmp
-            else:
-                arg_dict[arg] = samp_dict[arg]
-        if not addback2vars_pars_to_do and samp_caller is not None:
-            if calc_log_prob or not (var_par in observed_varnames
-                                     and generate != "post pred"):
-                samp_res_caller = samp_caller(**arg_dict)
-            elif var_par in observed_varnames and generate != "post pred":
-                samp_dict[var_par] = observed_data[var_par]
-            if var_par in constrained_fcns:
-                samp_dict[var_par] = samp_res_caller
-                if generate == "constrained" or generate == "post pred":
-                    constrained_par_dict[var_par] = samp_dict[var_par]
-            elif var_par in observed_varnames and generate == "post pred":
-                samp_dict[var_par] = samp_res_caller.sample()
-                post_pred_dict[var_par] = samp_dict[var_par]
-            elif var_par not in observed_varnames:
-                if samp_res_caller.name == 'Deterministic':
-                    samp_dict[var_par] = samp_res_caller.loc
-                    if generate == "constrained" or generate == "post pred":
-                        constrained_par_dict[var_par] = samp_dict[var_par]
-                else:
-                    if generate == "unconstrained":
-                        if unconstrained_generate == "zero":
-                            samp_dict[var_par] = tf.zeros(
-                            samp_res_caller.batch_shape +
-                            samp_res_caller.event_shape,dtype=tf.float64)
-                        else:
-                            samp_dict[var_par] = tf.reduce_mean(
-                                samp_res_caller.sample(100),axis=0)
-                        unconstrained_par_dict[var_par] = samp_dict[var_par]
-                    else:
-                        samp_dict[var_par] = unconstrained_par_dict[var_par]
-            else:
-                samp_dict[var_par] = observed_data[var_par]
-            if calc_log_prob and var_par not in constrained_fcns:
-                log_prob_res += tf.reduce_sum(samp_res_caller.log_prob(samp_dict[var_par]))
-        if var_par in samp_dict:
-            vars_pars_to_do = list(set(vars_pars_to_do) - set([var_par]))
-    return log_prob_res, unconstrained_par_dict, constrained_par_dict, post_pred_dict
+    log_prob, unconstrained_par_dict, constrained_par_dict, \
+        post_pred_dict = ModelPlan(dist_dict, observed_varnames,
+                                   constrained_fcns).traverse(
+                                       observed_data, generate,
+                                       calc_log_prob,
+                                       unconstrained_par_dict,
+                                       unconstrained_generate)
+    return tf.reshape(log_prob, [1]), unconstrained_par_dict, \
+        constrained_par_dict, post_pred_dict
@@ -1,27 +1,520 @@
 ''' Utilities for MAP and posterior variance estimation'''
 
+import functools
+import os
+
 import numpy as np
-import pandas as pd
+import scipy.linalg
 import scipy.optimize
+import scipy.sparse
+import scipy.sparse.linalg
 
 import tensorflow as tf
 import tensorflow_probability as tfp
 
 from bayes_mapvar.map_utils \
-    import par_dict_from_vec,par_vec_from_dict, traverse_dist
+    import ModelPlan, ParameterLayout, make_loss_and_gradient, \
+        cache_by_vector, is_chunked, iter_chunks
 from bayes_mapvar.var_utils \
-    import get_hessian_delta_variance, get_bandwidths
+    import get_hessian_delta_variance, get_bandwidths, \
+        get_autodiff_delta, get_constrained_variance, get_var_index, \
+        autodiff_hessian, hessian_vector_product, _probe_fcn
+from bayes_mapvar.parallel import process_pool, worker_state, ShardPool
+from bayes_mapvar.checkpoint import Checkpoint
+from bayes_mapvar.result import MapVarResult
+from bayes_mapvar.exceptions import MapVarException
+from bayes_mapvar import profiling
 
 
 tfd = tfp.distributions
 tfb = tfp.bijectors
 
+OPTIMIZERS = ["L-BFGS-B", "trust-ncg", "trust-krylov", "trust-exact",
+              "tfp-lbfgs", "tfp-bfgs"]
+TFP_MAX_ITERATIONS = 1000
+EVALUATION_CACHE_SIZE = 64
+HESSIAN_BACKENDS = ["threads", "processes"]
+
+
+class _Objective:
+    """ Negative log posterior of a model on its observed data, with
+        its gradient and the constrained parameter map
+
+        Without chunks, evaluate returns the loss, gradient and
+        constrained parameter vector from one traversal of the model,
+        cached by parameter vector, and the optimizer and the variance
+        stage share its cache.
+    """
+    def __init__(self, dist_dict, observed_data, observed_varnames,
+                 constrained_fcns, compile_mode=None, include_prior=True,
+                 dtype=None):
+        self.plan = ModelPlan(dist_dict, observed_varnames,
+                              constrained_fcns, dtype)
+        self.include_prior = include_prior
+        self.compile_mode = compile_mode
+        self.chunks = None
+        self.evaluate = None
+        self._last = None
+        if is_chunked(observed_data):
+            self.chunks = observed_data
+            self.data = self.plan.prepare_data(
+                next(iter_chunks(observed_data)))
+        else:
+            self.data = self.plan.prepare_data(observed_data)
+        with profiling.phase("init_traversal"):
+            _, self.init_unconstrained_par_dict = \
+                self.plan.initial_unconstrained(self.data)
+            self.layout = ParameterLayout.from_par_dict(
+                self.init_unconstrained_par_dict)
+            self.constrained_layout = ParameterLayout.from_par_dict(
+                self.plan.constrained(self.init_unconstrained_par_dict,
+                                      self.data))
+        if self.chunks is None:
+            self.loss_and_gradient = profiling.counted(
+                make_loss_and_gradient(self.loss, compile_mode),
+                "loss_and_gradient")
+            self._loss_gradient_constrained = make_loss_and_gradient(
+                self._loss_and_constrained, compile_mode, has_aux=True)
+            self.evaluate = cache_by_vector(self._np_evaluate,
+                                            EVALUATION_CACHE_SIZE)
+        else:
+            self._chunk_loss_and_gradient = [
+                make_loss_and_gradient(self._chunk_loss, compile_mode),
+                make_loss_and_gradient(self._chunk_neg_log_likelihood,
+                                       compile_mode)]
+            self.loss_and_gradient = profiling.counted(
+                self._chunked_loss_and_gradient, "loss_and_gradient")
+
+    def loss(self, par_vec):
+        """ Negative log posterior density"""
+        if self.chunks is not None:
+            return self._chunked_loss_and_gradient(par_vec)[0]
+        return self._chunk_loss(par_vec, self.data)
+
+    def _chunk_loss(self, par_vec, data):
+        if not self.include_prior:
+            return self._chunk_neg_log_likelihood(par_vec, data)
+        return -self.plan.log_prob(self.layout.unpack(par_vec), data)
+
+    def _loss_and_constrained(self, par_vec):
+        log_prob, constrained = self.plan.log_prob_and_constrained(
+            self.layout.unpack(par_vec), self.data, self.include_prior)
+        return -log_prob, self.constrained_layout.pack(constrained)
+
+    def _np_evaluate(self, par_vec):
+        profiling.count("loss_and_gradient")
+        (loss, constrained), gradient = self._loss_gradient_constrained(
+            tf.convert_to_tensor(par_vec, tf.float64))
+        return np.array(tf.cast(loss, tf.float64).numpy()), \
+            tf.cast(gradient, tf.float64).numpy(), constrained.numpy()
+
+    def _chunk_neg_log_likelihood(self, par_vec, data):
+        return -self.plan.log_likelihood(self.layout.unpack(par_vec), data)
+
+    def _chunked_loss_and_gradient(self, par_vec):
+        """ Loss and gradient accumulated over the chunks of observed
+            data, the prior enters with the first chunk only
+        """
+        loss_value = 0
+        gradient = 0
+        for index, chunk in enumerate(iter_chunks(self.chunks)):
+            chunk_loss, chunk_gradient = \
+                self._chunk_loss_and_gradient[min(index, 1)](
+                    par_vec, self.plan.prepare_data(chunk))
+            loss_value = loss_value + chunk_loss
+            gradient = gradient + chunk_gradient
+        return loss_value, gradient
+
+    def np_loss_and_gradient(self, par_vec):
+        """ Loss and gradient as NumPy values for SciPy, the last one
+            kept when there is no evaluation cache
+        """
+        if self.evaluate is not None:
+            loss, gradient, _ = self.evaluate(par_vec)
+            return loss.copy(), gradient.copy()
+        if self._last is None or \
+                not np.array_equal(self._last[0], par_vec):
+            loss_gradient = self.loss_and_gradient(
+                tf.convert_to_tensor(par_vec, tf.float64))
+            self._last = (np.array(par_vec),
+                np.array(tf.cast(loss_gradient[0], tf.float64).numpy()),
+                tf.cast(loss_gradient[1], tf.float64).numpy())
+        return self._last[1].copy(), self._last[2].copy()
+
+    def constrained_vec(self, par_vec):
+        """ Constrained parameter vector"""
+        return self.constrained_layout.pack(self.plan.constrained(
+            self.layout.unpack(par_vec), self.data))
+
+    def constrained_par_dict(self, par_vec):
+        """ Constrained parameter dictionary, from the evaluation cache
+            when available
+        """
+        if self.evaluate is None:
+            return self.plan.constrained(self.layout.unpack(par_vec),
+                                         self.data)
+        return self.constrained_layout.unpack(self.evaluate(par_vec)[2])
+
+    def minimize(self, init_par_vec, preconditioner=None,
+                 optimizer="L-BFGS-B", callback=None):
+        """ Minimize the loss from init_par_vec with one of OPTIMIZERS,
+            L-BFGS-B optionally in the coordinates of a _Preconditioner,
+            calling callback with the parameter vector of every
+            iteration of the SciPy optimizers
+        """
+        with profiling.phase("optimize"):
+            return self._minimize(init_par_vec, preconditioner, optimizer,
+                                  callback)
+
+    def _minimize(self, init_par_vec, preconditioner, optimizer, callback):
+        if optimizer in ["tfp-lbfgs", "tfp-bfgs"]:
+            return self._tfp_minimize(init_par_vec, optimizer)
+        if optimizer != "L-BFGS-B":
+            return self._trust_minimize(init_par_vec, optimizer, callback)
+        if preconditioner is None:
+            return scipy.optimize.minimize(
+                        self.np_loss_and_gradient,
+                        jac=True,
+                        x0=init_par_vec,
+                        method='L-BFGS-B',
+                        callback=_iteration_callback(callback))
+
+        def np_loss_and_gradient(scaled_vec):
+            loss, gradient = self.np_loss_and_gradient(
+                init_par_vec + preconditioner.to_par(scaled_vec))
+            return loss, preconditioner.to_grad(gradient)
+
+        scipyopt = scipy.optimize.minimize(
+                    np_loss_and_gradient,
+                    jac=True,
+                    x0=np.zeros(len(init_par_vec)),
+                    method='L-BFGS-B',
+                    callback=_iteration_callback(
+                        callback, lambda scaled_vec:
+                        init_par_vec + preconditioner.to_par(scaled_vec)))
+        scaled_hess_inv = scipyopt.hess_inv
+        scipyopt.x = init_par_vec + preconditioner.to_par(scipyopt.x)
+        scipyopt.jac = self.np_loss_and_gradient(scipyopt.x)[1]
+        scipyopt.hess_inv = _FactoredInverse(preconditioner,
+                                             scaled_hess_inv)
+        return scipyopt
+
+    def _trust_minimize(self, init_par_vec, optimizer, callback=None):
+        """ Newton trust-region methods, with Hessian-vector products
+            or, for trust-exact, the Hessian from automatic
+            differentiation
+        """
+        if optimizer == "trust-exact":
+            hessian = _compiled(lambda par_vec: autodiff_hessian(
+                self.loss, par_vec), self.compile_mode)
+            return scipy.optimize.minimize(
+                        self.np_loss_and_gradient,
+                        jac=True,
+                        hess=lambda par_vec: hessian(
+                            tf.convert_to_tensor(par_vec, tf.float64)).numpy(),
+                        x0=init_par_vec,
+                        method=optimizer,
+                        callback=_iteration_callback(callback))
+        hvp = _compiled(lambda par_vec, vector: hessian_vector_product(
+            self.loss, par_vec, vector), self.compile_mode)
+        return scipy.optimize.minimize(
+                    self.np_loss_and_gradient,
+                    jac=True,
+                    hessp=lambda par_vec, vector: hvp(
+                        tf.convert_to_tensor(par_vec, tf.float64),
+                        tf.convert_to_tensor(vector, tf.float64)).numpy(),
+                    x0=init_par_vec,
+                    method=optimizer,
+                    callback=_iteration_callback(callback))
+
+    def _tfp_minimize(self, init_par_vec, optimizer):
+        """ TFP (L-)BFGS with the whole optimization in one graph,
+            returned as a SciPy OptimizeResult
+        """
+        minimize = tfp.optimizer.lbfgs_minimize \
+            if optimizer == "tfp-lbfgs" else tfp.optimizer.bfgs_minimize
+
+        @tf.function
+        def run(initial_position):
+            return minimize(self.loss_and_gradient,
+                            initial_position=initial_position,
+                            max_iterations=TFP_MAX_ITERATIONS)
+
+        optresults = run(tf.convert_to_tensor(init_par_vec, tf.float64))
+        converged = bool(optresults.converged)
+        scipyopt = scipy.optimize.OptimizeResult(
+            x=optresults.position.numpy(),
+            fun=float(optresults.objective_value),
+            jac=optresults.objective_gradient.numpy(),
+            success=converged,
+            status=0 if converged else 1,
+            nit=int(optresults.num_iterations),
+            nfev=int(optresults.num_objective_evaluations),
+            message="converged" if converged else
+                "failed" if bool(optresults.failed) else
+                "maximum number of iterations reached")
+        if optimizer == "tfp-bfgs":
+            scipyopt.hess_inv = optresults.inverse_hessian_estimate.numpy()
+        return scipyopt
+
+
+def _iteration_callback(callback, to_par=None):
+    """ SciPy minimize callback timing the iteration in the active
+        Profiler and calling callback with the parameter vector, mapped
+        from the optimizer coordinates by to_par
+    """
+    timer = profiling.iteration_callback()
+    if callback is None:
+        return timer
+
+    def iteration(par_vec):
+        if timer is not None:
+            timer(par_vec)
+        callback(par_vec if to_par is None else to_par(par_vec))
+    return iteration
+
+
+def _compiled(function, compile_mode):
+    if compile_mode is None:
+        return function
+    return tf.function(function, jit_compile=compile_mode == "xla")
+
+
+class _Preconditioner:
+    """ Change of variables x = x0 + S z, with S S' the inverse of a
+        previous Hessian or the inverse Hessian estimate of a previous
+        L-BFGS run, so that L-BFGS starts with the curvature of the
+        previous fit
+
+        An L-BFGS estimate is the identity outside the span of its
+        curvature pairs, so S is factored on an orthonormal basis Q of
+        that span, S = I + Q (L - I) Q' with L L' = Q' H Q, without
+        forming the dense matrix. The estimate of a preconditioned run
+        keeps the preconditioner it was computed with as outer factor.
+    """
+    def __init__(self, hessian=None, inverse_hessian=None):
+        self.inverse = hessian is None
+        self.outer = None
+        self.basis = None
+        if isinstance(inverse_hessian, _FactoredInverse):
+            self.outer = inverse_hessian.preconditioner
+            inverse_hessian = inverse_hessian.scaled_inverse
+        if isinstance(inverse_hessian, scipy.optimize.LbfgsInvHessProduct):
+            self.basis = np.linalg.qr(np.transpose(np.concatenate(
+                [inverse_hessian.sk, inverse_hessian.yk])))[0]
+            inverse_hessian = np.matmul(np.transpose(self.basis),
+                                        inverse_hessian.matmat(self.basis))
+            inverse_hessian = (inverse_hessian +
+                               np.transpose(inverse_hessian)) / 2
+        self.cholesky = np.linalg.cholesky(
+            _dense(inverse_hessian if self.inverse else hessian))
+
+    def to_par(self, scaled_vec):
+        """ S z"""
+        par_vec = self._on_basis(self._factor, scaled_vec)
+        if self.outer is not None:
+            par_vec = self.outer.to_par(par_vec)
+        return par_vec
+
+    def to_grad(self, gradient):
+        """ S' g"""
+        if self.outer is not None:
+            gradient = self.outer.to_grad(gradient)
+        return self._on_basis(self._factor_transpose, gradient)
+
+    def _on_basis(self, apply, vec):
+        if self.basis is None:
+            return apply(vec)
+        coefficients = np.matmul(np.transpose(self.basis), vec)
+        return vec + np.matmul(self.basis,
+                               apply(coefficients) - coefficients)
+
+    def _factor(self, vec):
+        if self.inverse:
+            return np.matmul(self.cholesky, vec)
+        return scipy.linalg.solve_triangular(
+            np.transpose(self.cholesky), vec, lower=False)
+
+    def _factor_transpose(self, vec):
+        if self.inverse:
+            return np.matmul(np.transpose(self.cholesky), vec)
+        return scipy.linalg.solve_triangular(
+            self.cholesky, vec, lower=True)
+
+
+class _FactoredInverse(scipy.sparse.linalg.LinearOperator):
+    """ Inverse Hessian estimate S H S' of an L-BFGS-B run in the
+        coordinates of a _Preconditioner S, H being the estimate in
+        those coordinates
+    """
+    def __init__(self, preconditioner, scaled_inverse):
+        super().__init__(np.float64, scaled_inverse.shape)
+        self.preconditioner = preconditioner
+        self.scaled_inverse = scaled_inverse
+
+    def _matvec(self, x):
+        return self.preconditioner.to_par(self.scaled_inverse.matvec(
+            self.preconditioner.to_grad(np.reshape(x, -1))))
+
+    def _adjoint(self):
+        return self
+
+
+def _warm_start(init, init_unconstrained_par_dict, layout):
+    """ Starting point and preconditioner from an unconstrained
+        parameter dictionary or a previous mapvar result
+    """
+    if isinstance(init, dict):
+        return layout.pack(
+            {key: tf.reshape(tf.cast(init.get(key, value), tf.float64),
+                             value.shape)
+             for key, value in init_unconstrained_par_dict.items()}
+            ).numpy(), None
+    init_par_vec = layout.pack(init[0]).numpy()
+    hessian = _previous_hessian(init)
+    try:
+        if hessian is not None:
+            return init_par_vec, _Preconditioner(hessian=hessian)
+        hess_inv = getattr(init[2], "hess_inv", None)
+        if isinstance(hess_inv, (np.ndarray, _FactoredInverse,
+                                 scipy.optimize.LbfgsInvHessProduct)):
+            return init_par_vec, _Preconditioner(inverse_hessian=hess_inv)
+    except np.linalg.LinAlgError:
+        pass
+    return init_par_vec, None
+
+
+def _checkpoint_recorder(objective, checkpoint):
+    """ Optimizer callback recording each iterate in checkpoint, with
+        the loss and gradient of its evaluation by the optimizer
+    """
+    if checkpoint is None:
+        return None
+
+    def record(par_vec):
+        checkpoint.record_iteration(
+            par_vec, *objective.np_loss_and_gradient(par_vec))
+    return record
+
+
+def _resume_preconditioner(checkpoint, optimizer):
+    """ Preconditioner of a resumed L-BFGS-B from the curvature pairs of
+        the checkpointed iterations
+    """
+    inverse_hessian = checkpoint.inverse_hessian()
+    if inverse_hessian is None or optimizer != "L-BFGS-B":
+        return None
+    try:
+        return _Preconditioner(inverse_hessian=inverse_hessian)
+    except np.linalg.LinAlgError:
+        return None
+
+
+def _previous_hessian(previous):
+    """ Hessian of a previous result, without labeling it"""
+    if isinstance(previous, MapVarResult):
+        return previous.hessian_array
+    return previous[3]
+
+
+def _dense(matrix):
+    """ Dense array of a DataFrame or sparse matrix"""
+    if scipy.sparse.issparse(matrix):
+        return matrix.toarray()
+    return np.asarray(matrix)
+
+
+def _draw_starts(objective, n_starts, start_method, start_scale, seed):
+    rng = np.random.default_rng(seed)
+    init_par_vec = objective.layout.pack(
+        objective.init_unconstrained_par_dict).numpy()
+    starts = [init_par_vec]
+    for _ in range(1, n_starts):
+        if start_method == "jitter":
+            starts.append(init_par_vec + rng.normal(
+                scale=start_scale, size=len(init_par_vec)))
+        else:
+            _, draw = objective.plan.initial_unconstrained(
+                objective.data, method="sample",
+                seed=int(rng.integers(2**31 - 1)))
+            starts.append(objective.layout.pack(draw).numpy())
+    return starts
+
+
+def _shard_loss_and_gradient(model, include_prior):
+    """ NumPy loss and gradient of one shard, built in a shard worker"""
+    return _Objective(**model,
+                      include_prior=include_prior).np_loss_and_gradient
+
+def _variance_probe(model):
+    """ Gradient and constrained parameter vector of a NumPy parameter
+        vector, built in a Hessian column worker
+    """
+    objective = _Objective(**model)
+    return _probe_fcn(objective.loss_and_gradient, objective.constrained_vec,
+                      objective.evaluate)
+
+def _shard_data(observed_data, observed_varnames, n_shards):
+    """ Split observed data into n_shards contiguous blocks of rows,
+        the number of rows being that of the first observed variable
+    """
+    # pylint: disable=import-outside-toplevel
+    import pandas as pd
+    if is_chunked(observed_data):
+        raise MapVarException('n_shards requires observed_data in memory')
+    if isinstance(observed_data, pd.DataFrame):
+        n_rows = len(observed_data)
+    else:
+        if not observed_varnames:
+            raise MapVarException('n_shards requires observed_varnames')
+        n_rows = len(np.asarray(observed_data[observed_varnames[0]]))
+    if n_shards > n_rows:
+        raise MapVarException('n_shards exceeds the number of observations')
+    bounds = np.linspace(0, n_rows, n_shards + 1).astype(int)
+    if isinstance(observed_data, pd.DataFrame):
+        return [observed_data.iloc[start:stop]
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+    shards = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        shard = {}
+        for key, value in observed_data.items():
+            value = np.asarray(value)
+            shard[key] = value[start:stop] \
+                if value.ndim > 0 and len(value) == n_rows else value
+        shards.append(shard)
+    return shards
+
+def _minimize_start(init_par_vec):
+    state = worker_state()
+    if "objective" not in state:
+        state["objective"] = _Objective(**state["model"])
+    return state["objective"].minimize(init_par_vec,
+                                       optimizer=state["optimizer"])
+
 
 def mapvar(dist_dict,
             observed_data,
             observed_varnames=None,
             constrained_fcns=None,
-            skip_var=True):
+            skip_var=True,
+            compile_mode=None,
+            hessian_method="finite_difference",
+            var_params=None,
+            n_starts=1,
+            start_method="jitter",
+            start_scale=1.0,
+            n_workers=None,
+            seed=None,
+            init=None,
+            n_shards=None,
+            optimizer="L-BFGS-B",
+            dtype=None,
+            checkpoint_dir=None,
+            resume_from=None,
+            checkpoint_interval=60.0,
+            n_jobs=None,
+            hessian_backend="threads",
+            n_threads=None):
     """ Estimate posterior modes and posterior variances
 
         Parameters:
@@ -38,7 +531,13 @@ def mapvar(dist_dict,
 
         observed_data: dict
             dictionary of observed data, used in calculating the
-            posterior density
+            posterior density.
+            Observed data larger than memory may be given in chunks,
+            as a list of such dictionaries, a tf.data.Dataset of
+            them, or a function returning a new iterator over them.
+            The loss and gradient are then accumulated chunk by chunk,
+            covariates must be passed as data (see mapvar_batch) and
+            hessian_method must be "finite_difference" or "sparse".
 
         observed_varnames: list
             list of observed varaibles in dist_dict
@@ -47,11 +546,163 @@ def mapvar(dist_dict,
             dictionary of functions mapping the unconstrained
             parameters to the constrained and transformed parameters
 
-        calc_log_prob: boolean, default value = False
+        skip_var: boolean, default value = True
             skip posterior variance estimation?
 
+        compile_mode: string (optional)
+            None: evaluate the loss and gradient eagerly
+            "graph": evaluate the loss and gradient with tf.function
+            "xla": as "graph", additionally compiled with XLA
+
+        hessian_method: string, default value = "finite_difference"
+            "finite_difference": Hessian and Delta matrix from central
+                                 differences, see get_bandwidths
+            "batched_finite_difference": as "finite_difference", with
+                                 all 2p probes evaluated in one
+                                 vectorized call
+            "sparse": as "finite_difference", with probes compressed
+                      by coloring the Hessian sparsity pattern implied
+                      by the model graph, see
+                      ModelPlan.hessian_structure
+            "autodiff": exact Hessian and Delta matrix from
+                        vectorized automatic differentiation
+            "matrix_free": Hessian-vector products and conjugate
+                           gradient solves, the Hessian is not formed
+
+        var_params: list (optional)
+            names of constrained parameters to estimate the posterior
+            variance of, defaults to all
+
+        n_starts: int, default value = 1
+            number of starting points of the MAP optimization. With
+            more than one start, the optimizations run in parallel and
+            the start with the highest log posterior is kept.
+
+        start_method: string, default value = "jitter"
+            how starting points after the first (all unconstrained
+            parameters zero) are drawn when n_starts > 1.
+            "jitter": zero plus normal noise with sd start_scale
+            "sample": a draw of the unconstrained parameters from
+                      the prior
+
+        start_scale: float, default value = 1.0
+            standard deviation of the noise for start_method="jitter"
+
+        n_workers: int (optional)
+            number of worker processes for n_starts > 1, defaults to
+            min(n_starts, number of cores). With 1 the starts run
+            in this process. Each worker limits TensorFlow to its
+            share of the cores.
+
+        seed: int (optional)
+            seed for drawing starting points
+
+        init: dictionary, MapVarResult or tuple (optional)
+            warm start, either a dictionary of unconstrained parameter
+            values (missing parameters start at zero) or a previous
+            result of mapvar. A previous result provides the starting
+            point, and its Hessian, or the L-BFGS inverse Hessian
+            estimate built from its curvature pairs when the variance
+            was skipped, preconditions the optimization.
+            Overrides n_starts.
+
+        n_shards: int (optional)
+            split the observations into n_shards blocks of rows, each
+            held by its own worker process, which evaluate their part
+            of the loss and gradient in parallel. Parameters are sent
+            to the workers through shared memory. Speeds up the MAP
+            optimization and the "finite_difference" and "sparse"
+            Hessians of large datasets; multiple starts then run in
+            this process. Requires observed data in memory, and
+            observed_varnames unless observed_data is a DataFrame.
+            Only observed_data is split: the rows of a DataFrame, or
+            of the variables of a dictionary with as many rows as
+            the first observed variable, other variables being sent
+            whole to every worker. Covariates captured by the
+            callables of dist_dict are not split.
+
+        optimizer: string, default value = "L-BFGS-B"
+            "L-BFGS-B": SciPy L-BFGS-B, the only optimizer for
+                        chunked or sharded observed data
+            "trust-ncg", "trust-krylov": SciPy Newton trust-region
+                        methods driven by automatic differentiation
+                        Hessian-vector products, for poorly scaled
+                        posteriors
+            "trust-exact": SciPy trust-region method with the Hessian
+                        from automatic differentiation. Its final
+                        Hessian is reused for the variance when
+                        hessian_method is "finite_difference" or
+                        "autodiff".
+            "tfp-lbfgs", "tfp-bfgs": TFP (L-)BFGS with the whole
+                        optimization in one TensorFlow graph
+            Warm starts from a previous result are preconditioned
+            with L-BFGS-B only.
+
+        dtype: tf.DType or string (optional)
+            floating point type of the likelihood and gradient
+            evaluations during the MAP optimization, such as
+            tf.float32 for large observed arrays. Data and parameters
+            are cast to dtype, log densities are summed in float64 and
+            the optimizer state stays in float64. The Hessian, Delta
+            and variance are computed in float64 at the mode found,
+            with an unsharded float64 copy of the model when n_shards
+            is set. Callables in dist_dict must not hard-code float64,
+            see ModelPlan. Defaults to the types of the data and
+            priors as given.
+
+        checkpoint_dir: string (optional)
+            directory to write checkpoints of the fit to, see
+            checkpoint.Checkpoint: the optimizer iterate, its
+            objective history and last iterates and gradients, and
+            the "finite_difference" Hessian and Delta columns
+            completed so far. Defaults to resume_from. Requires
+            n_starts=1 and a SciPy optimizer.
+
+        resume_from: string (optional)
+            directory of checkpoints of an interrupted fit of the same
+            model to continue from. A finished optimization is not
+            repeated, an unfinished one continues from its last
+            iterate, L-BFGS-B preconditioned with the curvature of
+            its last iterations, and Hessian columns already computed
+            at the mode are skipped. Without checkpoints in the
+            directory the fit starts afresh. Overrides init.
+
+        checkpoint_interval: float, default value = 60.0
+            least number of seconds between two checkpoints of the
+            optimizer or of the Hessian columns, the final optimizer
+            and Hessian state is always written
+
+        n_jobs: int (optional)
+            number of workers computing the columns of the
+            "finite_difference" Hessian and Delta matrix concurrently,
+            with the same results bit for bit as one at a time, up to
+            n_threads. The other hessian_method values are not
+            parallelized and raise MapVarException with n_jobs > 1.
+            Defaults to 1.
+
+        hessian_backend: string, default value = "threads"
+            "threads": the n_jobs workers are threads of this process
+                       sharing its TensorFlow thread pool, suited to
+                       compiled models and large data
+            "processes": the n_jobs workers are processes, each
+                         rebuilding the model and holding its own copy
+                         of the observed data, suited to eager models
+                         whose probes are dominated by Python
+
+        n_threads: int (optional)
+            TensorFlow intra-op and inter-op threads of each worker
+            when hessian_backend="processes", defaults to the cores
+            divided among the n_jobs workers. The rounding of threaded
+            reductions depends on the number of threads, pass
+            tf.config.threading.get_intra_op_parallelism_threads() for
+            the same results bit for bit as this process.
+
         Returns:
         -------
+        MapVarResult, which unpacks as the tuple below. The matrices
+        are held as arrays and labeled on first access, and
+        log_marginal_likelihood gives the Laplace approximation of
+        the model evidence.
 
         unconstrained_par_map: dictionary
             dictionary of unconstrained parameter value
@@ -63,15 +714,20 @@ def mapvar(dist_dict,
 
         scipyopt: SciPy optimization object
             results of MAP estimation.
+            When n_starts > 1, scipyopt.candidates holds the
+            optimization results of all starts sorted by loss, each
+            with its log_posterior.
 
         hessian: dataframe
             Hessian matrix of log posterior density.
             Dataframe is indexed by unconstrained parameter
             names and indices to flattened parameter vectors.
+            A scipy.sparse.csc_matrix when hessian_method="sparse"
+            and None when hessian_method="matrix_free".
 
         delta: dataframe
             Delta matrix for constrained parameter variance
-            calculation.
+            calculation, rows of var_params only.
             Dataframe is indexed by constrained and
             unconstrained parameter names and indices to
             flattened parameter vectors.
@@ -81,90 +737,559 @@ def mapvar(dist_dict,
             Dataframe is indexed by constrained parameter names and
             indices to flattened parameter vectors.
     """
-    _, init_unconstrained_par_dict, _, _ = \
-        traverse_dist(dist_dict,
-                        observed_data,
-                        observed_varnames,
-                        generate="unconstrained",
-                        constrained_fcns=constrained_fcns,
-                        calc_log_prob = False,
-                        unconstrained_par_dict=None,
-                        unconstrained_generate="zero")
-    def loss(par_vec):
-        unconstrained_par_dict = \
-            par_dict_from_vec(par_vec,
-                init_unconstrained_par_dict)
-        log_prob, _, _, _ = \
-            traverse_dist(dist_dict,
-                            observed_data,
-                            observed_varnames,
-                            generate="constrained",
-                            constrained_fcns=constrained_fcns,
-                            calc_log_prob = True,
-                            unconstrained_par_dict=
-                                unconstrained_par_dict)
-        return -log_prob
-
-    def np_loss_and_gradient(par_vec):
-        loss_gradient = tfp.math.value_and_gradient(loss, tf.convert_to_tensor(par_vec,tf.float64))
-        return np.array(tf.cast(loss_gradient[0], tf.float64).numpy()), \
-            tf.cast(loss_gradient[1], tf.float64).numpy()
-
-    scipyopt = scipy.optimize.minimize(
-                    np_loss_and_gradient,
-                    jac=True,
-                    x0=par_vec_from_dict(
-                        init_unconstrained_par_dict),
-                    method='L-BFGS-B')
-
-    unconstrained_par_map = par_dict_from_vec(
-        scipyopt.x,init_unconstrained_par_dict)
-    _, _, constrained_par_map, _ = \
-        traverse_dist(dist_dict,
-                        observed_data,
-                        observed_varnames,
-                        generate="constrained",
-                        constrained_fcns=constrained_fcns,
-                        calc_log_prob = False,
-                        unconstrained_par_dict=
-                        unconstrained_par_map)
-    def constrained_vec(par_vec):
-        unconstrained_par_dict = par_dict_from_vec(
-            par_vec,init_unconstrained_par_dict)
-        _, _, constrained_par_dict, _ = \
-            traverse_dist(dist_dict,
-                            observed_data,
-                            observed_varnames,
-                            generate="constrained",
-                            constrained_fcns=constrained_fcns,
-                            calc_log_prob = False,
-                            unconstrained_par_dict=
-                                unconstrained_par_dict)
-        return par_vec_from_dict(constrained_par_dict)
+    if n_starts < 1:
+        raise MapVarException('n_starts must be at least 1')
+    if start_method not in ["jitter", "sample"]:
+        raise MapVarException('invalid value for start_method argument')
+    if optimizer not in OPTIMIZERS:
+        raise MapVarException('invalid value for optimizer argument')
+    if optimizer != "L-BFGS-B" and (is_chunked(observed_data) or
+            (n_shards is not None and n_shards > 1)):
+        raise MapVarException('chunked or sharded observed_data requires optimizer "L-BFGS-B"')
+    if hessian_backend not in HESSIAN_BACKENDS:
+        raise MapVarException('invalid value for hessian_backend argument')
+    if hessian_backend == "processes" and n_shards is not None and \
+            n_shards > 1:
+        raise MapVarException('n_shards requires hessian_backend "threads"')
+    if n_jobs is not None and n_jobs > 1 and not skip_var and \
+            hessian_method != "finite_difference":
+        raise MapVarException('n_jobs requires hessian_method "finite_difference"')
+    if checkpoint_dir is None:
+        checkpoint_dir = resume_from
+    if checkpoint_dir is not None and (n_starts > 1 or
+                                       optimizer.startswith("tfp")):
+        raise MapVarException('checkpoints require n_starts=1 and a SciPy optimizer')
+    model = {"dist_dict": dist_dict,
+             "observed_data": observed_data,
+             "observed_varnames": observed_varnames,
+             "constrained_fcns": constrained_fcns,
+             "compile_mode": compile_mode,
+             "dtype": dtype}
+    if is_chunked(observed_data) and not skip_var and \
+            hessian_method not in ["finite_difference", "sparse"]:
+        raise MapVarException('chunked observed_data requires hessian_method "finite_difference" or "sparse"')
+    objective = _Objective(**model)
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = Checkpoint(checkpoint_dir, objective.layout,
+                                checkpoint_interval, resume_from)
+    fit_args = {"model": model, "skip_var": skip_var,
+                "hessian_method": hessian_method, "var_params": var_params,
+                "n_starts": n_starts, "start_method": start_method,
+                "start_scale": start_scale, "n_workers": n_workers,
+                "seed": seed, "init": init, "optimizer": optimizer,
+                "checkpoint": checkpoint, "n_jobs": n_jobs,
+                "hessian_backend": hessian_backend,
+                "n_threads": n_threads}
+    if n_shards is not None and n_shards > 1:
+        if not skip_var and \
+                hessian_method not in ["finite_difference", "sparse"]:
+            raise MapVarException('n_shards requires hessian_method "finite_difference" or "sparse"')
+        shards = _shard_data(observed_data, observed_varnames, n_shards)
+        builders = [functools.partial(_shard_loss_and_gradient,
+                        dict(model, observed_data=shard), index == 0)
+                    for index, shard in enumerate(shards)]
+        with ShardPool(builders, objective.layout.size) as pool:
+            objective.loss_and_gradient = profiling.counted(
+                pool, "loss_and_gradient")
+            objective.evaluate = None
+            fit_args["n_workers"] = 1
+            return _fit(objective, **fit_args)
+    return _fit(objective, **fit_args)
+
+
+def _fit(objective, model, skip_var, hessian_method, var_params,
+         n_starts, start_method, start_scale, n_workers, seed, init,
+         optimizer, checkpoint=None, n_jobs=None,
+         hessian_backend="threads", n_threads=None):
+    """ MAP estimation and posterior variance of mapvar"""
+    init_unconstrained_par_dict = objective.init_unconstrained_par_dict
+    layout = objective.layout
+    record = _checkpoint_recorder(objective, checkpoint)
+
+    if checkpoint is not None and checkpoint.optimized:
+        scipyopt = checkpoint.optimize_result()
+    elif checkpoint is not None and checkpoint.optimizer is not None:
+        scipyopt = objective.minimize(
+            np.array(checkpoint.optimizer["x"]),
+            _resume_preconditioner(checkpoint, optimizer), optimizer,
+            record)
+    elif init is not None:
+        init_par_vec, preconditioner = _warm_start(
+            init, init_unconstrained_par_dict, layout)
+        scipyopt = objective.minimize(init_par_vec, preconditioner,
+                                      optimizer, record)
+    elif n_starts == 1:
+        scipyopt = objective.minimize(
+            layout.pack(init_unconstrained_par_dict).numpy(),
+            optimizer=optimizer, callback=record)
+    else:
+        starts = _draw_starts(objective, n_starts, start_method,
+                              start_scale, seed)
+        if n_workers is None:
+            n_workers = min(n_starts, os.cpu_count() or 1)
+        if n_workers == 1:
+            candidates = [objective.minimize(start, optimizer=optimizer)
+                          for start in starts]
+        else:
+            with process_pool(n_workers, {"model": model,
+                                          "optimizer": optimizer}) as pool:
+                candidates = list(pool.map(_minimize_start, starts))
+        for candidate in candidates:
+            candidate.log_posterior = -float(candidate.fun)
+        candidates.sort(key=lambda candidate: candidate.fun)
+        scipyopt = candidates[0]
+        scipyopt.candidates = candidates
+    if checkpoint is not None and not checkpoint.optimized:
+        scipyopt.nit = checkpoint.nit
+        checkpoint.finish_optimization(scipyopt)
+
+    reuse_hessian = getattr(scipyopt, "hess", None) is not None and \
+        objective.plan.dtype is None and \
+        hessian_method in ["finite_difference", "autodiff"]
+    if objective.plan.dtype is not None and not skip_var:
+        # Hessian and variance in float64 at the mode found in dtype,
+        # casting priors built in dtype and summing in float64
+        objective = _Objective(**dict(model, dtype=tf.float64))
+    constrained_par_map = objective.constrained_par_dict(scipyopt.x)
+    if objective.plan.dtype is not None:
+        constrained_par_map = {
+            name: tf.cast(value, tf.float64) if value.dtype.is_floating
+            else value for name, value in constrained_par_map.items()}
+    plan = objective.plan
+    data = objective.data
+    loss = objective.loss
+    loss_and_gradient = objective.loss_and_gradient
+    constrained_vec = objective.constrained_vec
+    unconstrained_par_map = layout.unpack(scipyopt.x)
+    probe_builder = None
+    if hessian_backend == "processes":
+        probe_builder = functools.partial(_variance_probe,
+                                          dict(model, dtype=tf.float64))
+
+    hessian = None
+    delta = None
+    variance = None
+    if not skip_var:
+        with profiling.phase("variance_stage"):
+            if reuse_hessian:
+                hessian = np.asarray(scipyopt.hess)
+                hessian = (hessian + np.transpose(hessian)) / 2
+                delta = get_autodiff_delta(
+                    scipyopt.x, constrained_vec)[get_var_index(
+                        objective.constrained_layout, var_params)]
+                variance = get_constrained_variance(hessian, delta)
+            else:
+                bandwidths = None
+                if hessian_method not in ["autodiff", "matrix_free"]:
+                    bandwidths = get_bandwidths(
+                        layout.pack(unconstrained_par_map))
+                hessian, delta, variance = \
+                    get_hessian_delta_variance(
+                        layout.pack(unconstrained_par_map).numpy(),
+                        loss,
+                        constrained_vec,
+                        bandwidths,
+                        layout,
+                        objective.constrained_layout,
+                        loss_and_gradient,
+                        hessian_method,
+                        var_params,
+                        plan.hessian_structure(),
+                        as_frames=False,
+                        loss_gradient_constrained=objective.evaluate,
+                        checkpoint=checkpoint,
+                        n_jobs=n_jobs,
+                        probe_builder=probe_builder,
+                        n_threads=n_threads)
+
+    return MapVarResult(unconstrained_par_map, constrained_par_map,
+                        scipyopt, layout, objective.constrained_layout,
+                        hessian, delta, variance, var_params, plan, data)
+
+
+def mapvar_batch(dist_dict,
+            datasets,
+            observed_varnames=None,
+            constrained_fcns=None,
+            skip_var=True,
+            max_iterations=200,
+            tolerance=1e-8):
+    """ Estimate posterior modes and posterior variances of one model
+        on many datasets at once
+
+        The datasets are padded to a common length and stacked along
+        a leading batch dimension, padded rows are masked out of the
+        likelihood. All log posteriors and gradients are evaluated in
+        one vectorized call and optimized together with the batched
+        L-BFGS of tfp.optimizer.lbfgs_minimize.
+
+        Covariates must reach the likelihood through the observed
+        data, as arguments of the callables in dist_dict that are not
+        in dist_dict or constrained_fcns, rather than being captured
+        in the callables.
+
+        Parameters:
+        -------
+        dist_dict: dict
+            dictonary of distributions representing
+            unconstrained parameters (prior) and observed data
+            likelihood, jointly the posterior, see mapvar.
+
+        datasets: list
+            list of dictionaries of observed data, all with the same
+            variables. Variables are stacked along their first axis.
+
+        observed_varnames: list
+            list of observed varaibles in dist_dict
+
+        constrained_fcns: dictionary (optional)
+            dictionary of functions mapping the unconstrained
+            parameters to the constrained and transformed parameters
+
+        skip_var: boolean, default value = True
+            skip posterior variance estimation?
+
+        max_iterations: int, default value = 200
+            maximum number of L-BFGS iterations
+
+        tolerance: float, default value = 1e-8
+            gradient tolerance of L-BFGS
+
+        Returns:
+        -------
+
+        unconstrained_par_map: dictionary
+            dictionary of unconstrained parameter value
+            posterior modes, with a leading batch dimension
+
+        constrained_par_map: dictionary
+            dictionary of constrained parameters from the
+            unconstrained posterior modes, with a leading batch
+            dimension
+
+        optresults: LBfgsOptimizerResults
+            results of the batched MAP estimation.
+
+        hessian: array
+            [datasets, p, p] Hessian matrices of negative log
+            posterior density by automatic differentiation, ordered
+            as get_par_labels of the unconstrained parameters.
+
+        delta: array
+            [datasets, c, p] Delta matrices for constrained parameter
+            variance calculation.
+
+        constrained_var: array
+            [datasets, c, c] constrained variance matrices, NaN for
+            datasets whose Hessian is not positive definite.
+    """
+    if len(datasets) == 0:
+        raise MapVarException('datasets is empty')
+    plan = ModelPlan(dist_dict, observed_varnames, constrained_fcns)
+    prepared = [plan.prepare_data(dataset) for dataset in datasets]
+    _, init_unconstrained_par_dict = \
+        plan.initial_unconstrained(prepared[0])
+    layout = ParameterLayout.from_par_dict(init_unconstrained_par_dict)
+    constrained_layout = ParameterLayout.from_par_dict(
+        plan.constrained(init_unconstrained_par_dict, prepared[0]))
+    data, weights = _stack_datasets(plan, prepared)
+
+    def dataset_loss_and_gradient(args):
+        par_vec, dataset, dataset_weights = args
+        return tfp.math.value_and_gradient(
+            lambda par_vec: -plan.log_prob(
+                layout.unpack(par_vec), dataset, dataset_weights),
+            par_vec)
+
+    def dataset_constrained(args):
+        par_vec, dataset = args
+        return constrained_layout.pack(plan.constrained(
+            layout.unpack(par_vec), dataset))
+
+    @tf.function
+    def batch_loss_and_gradient(par_vecs):
+        return tf.vectorized_map(dataset_loss_and_gradient,
+                                 (par_vecs, data, weights))
+
+    optresults = tfp.optimizer.lbfgs_minimize(
+        batch_loss_and_gradient,
+        initial_position=tf.tile(
+            layout.pack(init_unconstrained_par_dict)[tf.newaxis],
+            [len(prepared), 1]),
+        max_iterations=max_iterations,
+        tolerance=tolerance)
+    par_vecs = optresults.position
+    unconstrained_par_map = layout.unpack(par_vecs)
+    constrained_par_map = constrained_layout.unpack(
+        tf.vectorized_map(dataset_constrained, (par_vecs, data)))
+
     hessian = None
     delta = None
     variance = None
     if not skip_var:
-        constrained_par_size = \
-            {key: tf.size(value) for key, value in
-                constrained_par_map.items()}
-        unconstrained_par_size = \
-            {key: tf.size(value) for key, value in
-                unconstrained_par_map.items()}
-        bandwidths = get_bandwidths(
-            par_vec_from_dict(unconstrained_par_map))
-        hessian, delta, variance = \
-            get_hessian_delta_variance(
-                par_vec_from_dict(unconstrained_par_map).numpy(),
-                loss,
-                constrained_vec,
-                bandwidths,
-                unconstrained_par_size,
-                constrained_par_size)
-                
+        with tf.GradientTape(persistent=True) as tape:
+            tape.watch(par_vecs)
+            gradients = batch_loss_and_gradient(par_vecs)[1]
+            constrained = tf.vectorized_map(dataset_constrained,
+                                            (par_vecs, data))
+        hessian = tape.batch_jacobian(gradients, par_vecs).numpy()
+        hessian = (hessian + np.swapaxes(hessian, 1, 2)) / 2
+        delta = tape.batch_jacobian(constrained, par_vecs).numpy()
+        variance = np.full((hessian.shape[0], delta.shape[1],
+                            delta.shape[1]), np.nan)
+        positive = np.all(np.linalg.eigvalsh(hessian) > 0, axis=-1)
+        if np.any(positive):
+            half = np.linalg.solve(np.linalg.cholesky(hessian[positive]),
+                                   np.swapaxes(delta[positive], 1, 2))
+            variance[positive] = np.matmul(np.swapaxes(half, 1, 2), half)
+
     return unconstrained_par_map, \
             constrained_par_map, \
-            scipyopt, \
+            optresults, \
             hessian, \
             delta, \
             variance
+
+
+def _stack_datasets(plan, prepared):
+    """ Pad datasets to a common length and stack them, with 0/1
+        weights of the observed variables marking the real rows
+    """
+    data = {}
+    weights = {}
+    for node in prepared[0]:
+        lengths = [int(tf.shape(dataset[node])[0]) for dataset in prepared]
+        length = max(lengths)
+        data[node] = tf.stack([
+            tf.concat([dataset[node], tf.repeat(
+                dataset[node][-1:], length - size, axis=0)], 0)
+            for dataset, size in zip(prepared, lengths)])
+        if plan.kinds[node] == "observed":
+            weights[node] = tf.constant(
+                np.arange(length) < np.reshape(lengths, (-1, 1)),
+                dtype=tf.float64)
+    return data, weights
+
+
+def mapvar_update(previous,
+            dist_dict,
+            new_data,
+            observed_varnames=None,
+            constrained_fcns=None,
+            var_params=None):
+    """ Update posterior modes and posterior variances after new
+        observations are added, with one Newton step
+
+        With previous the fit on the old data, the log posterior on
+        all data is the previous log posterior plus the log likelihood
+        of new_data. The previous gradient is zero at the previous
+        mode, so the Newton step only needs the gradient and Hessian
+        of the new log likelihood, whose cost depends on the size of
+        new_data alone. Refit with mapvar(..., init=previous) when
+        the new data move the mode far.
+
+        Parameters:
+        -------
+        previous: MapVarResult or tuple
+            result of mapvar on the old data with skip_var=False and
+            a dense or sparse Hessian
+
+        dist_dict: dict
+            dictonary of distributions, as passed to mapvar
+
+        new_data: dict
+            dictionary of the added observed data only
+
+        observed_varnames: list
+            list of observed varaibles in dist_dict
+
+        constrained_fcns: dictionary (optional)
+            dictionary of functions mapping the unconstrained
+            parameters to the constrained and transformed parameters
+
+        var_params: list (optional)
+            names of constrained parameters to estimate the posterior
+            variance of, defaults to all
+
+        Returns:
+        -------
+        the same as mapvar, with scipyopt a SciPy OptimizeResult
+        holding the updated mode and the loss there, with the previous
+        loss approximated to second order about the previous mode,
+        and the Hessian the sum of the
+        previous Hessian and the Hessian of the new negative log
+        likelihood.
+    """
+    previous_hessian = _previous_hessian(previous)
+    if previous_hessian is None:
+        raise MapVarException('previous result has no Hessian, fit it with skip_var=False')
+    plan = ModelPlan(dist_dict, observed_varnames, constrained_fcns)
+    data = plan.prepare_data(new_data)
+    _, init_unconstrained_par_dict = plan.initial_unconstrained(data)
+    layout = ParameterLayout.from_par_dict(init_unconstrained_par_dict)
+    constrained_layout = ParameterLayout.from_par_dict(
+        plan.constrained(init_unconstrained_par_dict, data))
+    previous_par_vec = layout.pack(previous[0])
+
+    def new_loss(par_vec):
+        return -plan.log_likelihood(layout.unpack(par_vec), data)
+
+    def constrained_vec(par_vec):
+        return constrained_layout.pack(plan.constrained(
+            layout.unpack(par_vec), data))
+
+    with tf.GradientTape() as outer_tape:
+        outer_tape.watch(previous_par_vec)
+        with tf.GradientTape() as inner_tape:
+            inner_tape.watch(previous_par_vec)
+            loss_value = new_loss(previous_par_vec)
+        gradient = inner_tape.gradient(loss_value, previous_par_vec)
+    hessian = _dense(previous_hessian) + \
+        outer_tape.jacobian(gradient, previous_par_vec).numpy()
+    hessian = (hessian + np.transpose(hessian)) / 2
+    try:
+        cholesky = scipy.linalg.cho_factor(hessian, lower=True)
+    except np.linalg.LinAlgError as err:
+        raise MapVarException('updated Hessian is not positive definite') from err
+    par_vec = previous_par_vec.numpy() - \
+        scipy.linalg.cho_solve(cholesky, gradient.numpy())
+    # previous loss expanded to second order about its mode, where its
+    # gradient is zero, plus the new negative log likelihood
+    step = par_vec - previous_par_vec.numpy()
+    fun = float(previous[2].fun) + \
+        np.dot(step, _dense(previous_hessian) @ step) / 2 + \
+        float(new_loss(tf.convert_to_tensor(par_vec, tf.float64)))
+    scipyopt = scipy.optimize.OptimizeResult(
+        x=par_vec, fun=fun, success=True, nit=1, message='Newton update')
+
+    unconstrained_par_map = layout.unpack(par_vec)
+    constrained_par_map = plan.constrained(unconstrained_par_map, data)
+    var_index = get_var_index(constrained_layout, var_params)
+    delta = get_autodiff_delta(par_vec, constrained_vec)[var_index]
+    variance = get_constrained_variance(hessian, delta)
+    return MapVarResult(unconstrained_par_map, constrained_par_map,
+                        scipyopt, layout, constrained_layout,
+                        hessian, delta, variance, var_params, plan, data)
+
+
+def _model_plan(model):
+    return ModelPlan(model["dist_dict"], model.get("observed_varnames"),
+                     model.get("constrained_fcns"))
+
+
+def _shared_data(models, observed_data):
+    """ observed_data with the variables of all models converted to
+        tensors once, so that the fits share them
+    """
+    data = {name: observed_data[name] for name in observed_data}
+    for model in models.values():
+        try:
+            data.update(_model_plan(model).prepare_data(data))
+        except MapVarException:
+            # reported by the fit of the model
+            pass
+    return data
+
+
+def _compare_fit(name, models, observed_data, fit_kwargs):
+    """ Fit one model of compare_models, returning its table row"""
+    model = models[name]
+    row = {"model": name, "log_marginal_likelihood": np.nan,
+           "log_posterior": np.nan, "n_params": np.nan,
+           "success": False, "nit": np.nan, "error": None}
+    try:
+        result = mapvar(observed_data=observed_data,
+                        **dict(fit_kwargs, **model))
+        row.update(log_marginal_likelihood=result.log_marginal_likelihood,
+                   log_posterior=-float(result.scipyopt.fun),
+                   n_params=result.layout.size,
+                   success=bool(result.scipyopt.success),
+                   nit=result.scipyopt.get("nit", np.nan))
+    except MapVarException as err:
+        row["error"] = str(err)
+    return row
+
+
+def _compare_start(name):
+    state = worker_state()
+    if "data" not in state:
+        state["data"] = _shared_data(state["models"],
+                                     state["observed_data"])
+    return _compare_fit(name, state["models"], state["data"],
+                        state["fit_kwargs"])
+
+
+def compare_models(models, observed_data, n_workers=None, **kwargs):
+    """ Rank models by their Laplace approximation of the log marginal
+        likelihood
+
+        Each model is fitted with mapvar and skip_var=False. The
+        observed data are converted to tensors once and shared by all
+        fits in a process. With several workers the models are fitted
+        in parallel, the data being sent once to each worker.
+
+        Parameters:
+        -------
+        models: dict or list
+            models keyed by name, or a list of models named by their
+            position. Each model is a dictionary of mapvar arguments,
+            at least dist_dict and usually observed_varnames and
+            constrained_fcns, overriding kwargs.
+
+        observed_data: dict
+            dictionary of observed data shared by all models
+
+        n_workers: int (optional)
+            number of worker processes, defaults to
+            min(number of models, number of cores). With 1 the models
+            are fitted in this process.
+
+        kwargs:
+            further mapvar arguments common to all models, such as
+            compile_mode or hessian_method (not "matrix_free").
+            var_params defaults to [] as the evidence needs only the
+            Hessian.
+
+        Returns:
+        -------
+        DataFrame indexed by model name, sorted from the highest log
+        marginal likelihood, with columns log_marginal_likelihood,
+        log_posterior (at the mode), n_params, success and nit of the
+        optimization, delta (log marginal likelihood minus the best),
+        weight (posterior model probability under equal prior model
+        probabilities) and error (the MapVarException message of
+        models that failed, such as a Hessian that is not positive
+        definite).
+    """
+    # pylint: disable=import-outside-toplevel
+    import pandas as pd
+    if not isinstance(models, dict):
+        models = dict(enumerate(models))
+    if len(models) == 0:
+        raise MapVarException('models is empty')
+    if kwargs.get("hessian_method") == "matrix_free":
+        raise MapVarException('compare_models requires a hessian_method that forms the Hessian')
+    if is_chunked(observed_data):
+        raise MapVarException('compare_models requires observed data in memory')
+    fit_kwargs = dict({"var_params": []}, **kwargs)
+    fit_kwargs["skip_var"] = False
+    if n_workers is None:
+        n_workers = min(len(models), os.cpu_count() or 1)
+    if n_workers == 1:
+        data = _shared_data(models, observed_data)
+        rows = [_compare_fit(name, models, data, fit_kwargs)
+                for name in models]
+    else:
+        with process_pool(n_workers, {"models": models,
+                                      "observed_data": observed_data,
+                                      "fit_kwargs": fit_kwargs}) as pool:
+            rows = list(pool.map(_compare_start, list(models)))
+    table = pd.DataFrame(rows).set_index("model").sort_values(
+        "log_marginal_likelihood", ascending=False, na_position="last")
+    table["delta"] = table["log_marginal_likelihood"] - \
+        table["log_marginal_likelihood"].max()
+    weights = np.exp(table["delta"].fillna(-np.inf))
+    table["weight"] = weights / weights.sum()
+    return table[["log_marginal_likelihood", "log_posterior", "n_params",
+                  "success", "nit", "delta", "weight", "error"]]
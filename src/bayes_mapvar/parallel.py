@@ -0,0 +1,234 @@
+''' Utilities for running work on a pool of worker processes'''
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import cloudpickle
+import numpy as np
+
+from bayes_mapvar.exceptions import MapVarException
+
+_WORKER_STATE = {}
+
+def _rebuild(cls, parameters):
+    return cls(**parameters)
+
+class _ModelPickler(cloudpickle.CloudPickler):
+    """ cloudpickle, with distributions and bijectors rebuilt from
+        their constructor parameters since not all of them pickle
+    """
+    def __init__(self, file):
+        # pylint: disable=import-outside-toplevel
+        import tensorflow_probability as tfp
+        super().__init__(file)
+        self._rebuilt = (tfp.distributions.Distribution,
+                         tfp.bijectors.Bijector)
+
+    def reducer_override(self, obj):
+        if isinstance(obj, self._rebuilt):
+            return _rebuild, (type(obj), dict(obj.parameters))
+        return super().reducer_override(obj)
+
+def dumps(obj):
+    """ Serialize a model, including lambdas, distributions and
+        bijectors, for sending to worker processes
+    """
+    with io.BytesIO() as file:
+        _ModelPickler(file).dump(obj)
+        return file.getvalue()
+
+def threads_per_worker(n_workers):
+    """ Number of TensorFlow threads for each of n_workers processes,
+        so that the workers together do not oversubscribe the cores
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+def _set_threads(n_threads):
+    # pylint: disable=import-outside-toplevel
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+    except RuntimeError:
+        # TensorFlow already initialized while importing the main module
+        pass
+
+def _init_worker(payload, n_threads):
+    _set_threads(n_threads)
+    _WORKER_STATE.clear()
+    _WORKER_STATE.update(cloudpickle.loads(payload))
+
+def process_pool(n_workers, state, n_threads=None):
+    """ Start a pool of worker processes sharing the same state
+
+        Workers are spawned rather than forked, so TensorFlow is
+        initialized fresh in each worker with its thread limits.
+
+        Parameters:
+        -------
+        n_workers: int
+            number of worker processes
+
+        state: dict
+            state sent once to every worker, serialized with dumps
+            so that models built from lambdas can be sent.
+            Available in the workers through worker_state().
+
+        n_threads: int (optional)
+            TensorFlow intra-op and inter-op threads per worker,
+            defaults to threads_per_worker(n_workers)
+
+        Returns:
+        -------
+        concurrent.futures.ProcessPoolExecutor
+    """
+    if n_threads is None:
+        n_threads = threads_per_worker(n_workers)
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(dumps(state), n_threads))
+
+def worker_state():
+    """ State sent to this worker process by process_pool"""
+    return _WORKER_STATE
+
+def _shard_worker(conn, payload, n_threads, memory_names, index, par_size):
+    _set_threads(n_threads)
+    par_memory, out_memory = [shared_memory.SharedMemory(name=name)
+                              for name in memory_names]
+    par_vec = np.ndarray((par_size,), np.float64, buffer=par_memory.buf)
+    out = np.ndarray((par_size + 1,), np.float64, buffer=out_memory.buf,
+                     offset=8*index*(par_size + 1))
+    try:
+        loss_and_gradient = cloudpickle.loads(payload)()
+        conn.send(None)
+        while conn.recv():
+            try:
+                loss, gradient = loss_and_gradient(par_vec.copy())
+                out[0] = loss
+                out[1:] = gradient
+                conn.send(None)
+            except Exception as err:  # pylint: disable=broad-except
+                conn.send(repr(err))
+    except Exception as err:  # pylint: disable=broad-except
+        conn.send(repr(err))
+    finally:
+        del par_vec, out
+        par_memory.close()
+        out_memory.close()
+        conn.close()
+
+class ShardPool:
+    """ Worker processes each evaluating the loss and gradient of one
+        shard of the data, summed by the caller
+
+        The parameter vector is written to shared memory and the
+        workers write their loss and gradient back to shared memory,
+        only a wake-up flag passes through the pipes. Calls from several
+        threads run one at a time, as they share the buffers. Use as a
+        context manager, or call close, to stop the workers.
+
+        Parameters:
+        -------
+        builders: list
+            one function per shard, called once in its worker,
+            returning a function of a NumPy parameter vector that
+            returns the loss and gradient of the shard.
+            Serialized with dumps.
+
+        par_size: int
+            length of the parameter vector
+
+        n_threads: int (optional)
+            TensorFlow intra-op and inter-op threads per worker,
+            defaults to threads_per_worker(len(builders))
+    """
+    def __init__(self, builders, par_size, n_threads=None):
+        if n_threads is None:
+            n_threads = threads_per_worker(len(builders))
+        self.par_size = par_size
+        self._lock = threading.Lock()
+        self._par_memory = None
+        self._out_memory = None
+        self._par_vec = None
+        self._out = None
+        self._conns = []
+        self._processes = []
+        try:
+            self._start(builders, n_threads)
+        except BaseException:
+            # stop the workers started so far and release the memory
+            self.close()
+            raise
+
+    def _start(self, builders, n_threads):
+        par_size = self.par_size
+        self._par_memory = shared_memory.SharedMemory(
+            create=True, size=8*par_size)
+        self._out_memory = shared_memory.SharedMemory(
+            create=True, size=8*len(builders)*(par_size + 1))
+        self._par_vec = np.ndarray((par_size,), np.float64,
+                                   buffer=self._par_memory.buf)
+        self._out = np.ndarray((len(builders), par_size + 1), np.float64,
+                               buffer=self._out_memory.buf)
+        context = multiprocessing.get_context("spawn")
+        memory_names = (self._par_memory.name, self._out_memory.name)
+        for index, builder in enumerate(builders):
+            payload = dumps(builder)
+            conn, child_conn = context.Pipe()
+            self._conns.append(conn)
+            process = context.Process(target=_shard_worker, daemon=True,
+                args=(child_conn, payload, n_threads,
+                      memory_names, index, par_size))
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+        self._collect()
+
+    def _collect(self):
+        errors = [error for error in
+                  (conn.recv() for conn in self._conns) if error]
+        if errors:
+            raise MapVarException('shard worker failed: ' + errors[0])
+
+    def __call__(self, par_vec):
+        """ Summed loss and gradient of all shards at par_vec"""
+        with self._lock:
+            self._par_vec[:] = np.reshape(par_vec, -1)
+            for conn in self._conns:
+                conn.send(True)
+            self._collect()
+            total = self._out.sum(axis=0)
+        return total[0], total[1:]
+
+    def close(self):
+        """ Stop the workers and release the shared memory"""
+        for conn in self._conns:
+            try:
+                conn.send(False)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for process in self._processes:
+            process.join()
+        self._conns = []
+        self._processes = []
+        self._par_vec = None
+        self._out = None
+        for memory in [self._par_memory, self._out_memory]:
+            if memory is not None:
+                memory.close()
+                memory.unlink()
+        self._par_memory = None
+        self._out_memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,163 @@
+''' Instrumentation of MAP and posterior variance estimation'''
+import time
+from collections import defaultdict
+
+_ACTIVE = []
+
+class _NullPhase:
+    """ Phase that records nothing, used while no Profiler is active"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase:
+    def __init__(self, profiler, name, table):
+        self.profiler = profiler
+        self.name = name
+        self.table = table
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.profiler.record(self.name, seconds, self.table)
+        return False
+
+class Profiler:
+    """ Context manager recording where the time of mapvar goes
+
+        While active, mapvar and its helpers report the wall time of
+        their phases: "init_traversal", "optimize",
+        "optimizer_iteration", "variance_stage", "hessian_probe",
+        "variance_solve" and "labeling". Loss and gradient evaluations
+        are counted, and with node_timing the time of every dist_dict
+        entry in eagerly executed traversals is recorded. With no
+        Profiler active each instrumentation point is a single list
+        check.
+
+        Parameters:
+        -------
+        node_timing: boolean, default value = False
+            time each node of the model graph, only for eager
+            evaluation (compile_mode=None), as compiled graphs run
+            all nodes in one call
+
+        trace_dir: string (optional)
+            directory for a TensorFlow profiler trace of the block,
+            viewable in TensorBoard
+
+        callback: function (optional)
+            called as callback(phase, seconds) at the end of every
+            phase
+
+        Example:
+        -------
+        with Profiler(node_timing=True) as profiler:
+            mapvar(dist_dict, observed_data, ['y'], skip_var=False)
+        print(profiler.summary())
+    """
+    def __init__(self, node_timing=False, trace_dir=None, callback=None):
+        self.node_timing = node_timing
+        self.trace_dir = trace_dir
+        self.callback = callback
+        self.phases = defaultdict(lambda: [0.0, 0])
+        self.nodes = defaultdict(lambda: [0.0, 0])
+        self.counts = defaultdict(int)
+        self.iterations = []
+
+    def __enter__(self):
+        if self.trace_dir is not None:
+            # pylint: disable=import-outside-toplevel
+            import tensorflow as tf
+            tf.profiler.experimental.start(self.trace_dir)
+        _ACTIVE.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _ACTIVE.remove(self)
+        if self.trace_dir is not None:
+            # pylint: disable=import-outside-toplevel
+            import tensorflow as tf
+            tf.profiler.experimental.stop()
+        return False
+
+    def record(self, name, seconds, table="phases"):
+        """ Add seconds to a phase, or to a node with table="nodes" """
+        entry = getattr(self, table)[name]
+        entry[0] = entry[0] + seconds
+        entry[1] = entry[1] + 1
+        if self.callback is not None and table == "phases":
+            self.callback(name, seconds)
+
+    def summary(self):
+        """ Recorded phases and nodes
+
+            Returns:
+            -------
+            DataFrame indexed by kind ("phase", "node" or "count") and
+            name, with the number of calls, total and mean seconds
+        """
+        # pylint: disable=import-outside-toplevel
+        import pandas as pd
+        rows = []
+        for kind, table in (("phase", self.phases), ("node", self.nodes)):
+            for name, (seconds, calls) in table.items():
+                rows.append((kind, name, calls, seconds, seconds / calls))
+        for name, calls in self.counts.items():
+            rows.append(("count", name, calls, None, None))
+        return pd.DataFrame(rows, columns=["kind", "name", "calls",
+                                           "seconds", "mean_seconds"]
+                            ).set_index(["kind", "name"])
+
+def phase(name):
+    """ Context manager timing a phase in the active Profiler"""
+    if not _ACTIVE:
+        return _NULL_PHASE
+    return _Phase(_ACTIVE[-1], name, "phases")
+
+def count(name, calls=1):
+    """ Count calls in the active Profiler"""
+    if _ACTIVE:
+        _ACTIVE[-1].counts[name] += calls
+
+def counted(function, name):
+    """ Wrap function so that its calls are counted in the active
+        Profiler
+    """
+    def wrapper(*args, **kwargs):
+        if _ACTIVE:
+            _ACTIVE[-1].counts[name] += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+def node_timer(eager):
+    """ Function returning a context manager timing one node, or None
+        without an active Profiler with node_timing or when not eager
+    """
+    if not _ACTIVE or not _ACTIVE[-1].node_timing or not eager:
+        return None
+    profiler = _ACTIVE[-1]
+    return lambda node: _Phase(profiler, node, "nodes")
+
+def iteration_callback():
+    """ SciPy minimize callback timing each optimizer iteration, None
+        without an active Profiler
+    """
+    if not _ACTIVE:
+        return None
+    profiler = _ACTIVE[-1]
+    last = [time.perf_counter()]
+
+    def callback(_):
+        now = time.perf_counter()
+        profiler.iterations.append(now - last[0])
+        profiler.record("optimizer_iteration", now - last[0])
+        last[0] = now
+    return callback
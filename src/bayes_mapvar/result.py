@@ -0,0 +1,418 @@
+''' Results of posterior mode and variance estimation'''
+import json
+import os
+
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+import scipy.sparse
+
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from bayes_mapvar import profiling
+from bayes_mapvar.exceptions import MapVarException
+from bayes_mapvar.map_utils import ParameterLayout
+
+MANIFEST = "manifest.json"
+_FORMAT_VERSION = 1
+_SCIPYOPT_FIELDS = {"fun": float, "success": bool, "status": int,
+                    "nit": int, "message": str}
+
+_FIELDS = ("unconstrained_par_map", "constrained_par_map", "scipyopt",
+           "hessian", "delta", "variance")
+
+class MapVarResult:
+    """ Result of mapvar
+
+        The Hessian, Delta and variance matrices are kept as NumPy
+        arrays (the Hessian as a scipy.sparse matrix for
+        hessian_method="sparse") together with the parameter layouts
+        indexing them. Labeled DataFrames are built on first access
+        and share one index per parameter vector.
+
+        The result unpacks and indexes like the tuple
+        (unconstrained_par_map, constrained_par_map, scipyopt,
+        hessian, delta, constrained_var) that mapvar returned before,
+        slices of it being given by fields.
+
+        Parameters:
+        -------
+        unconstrained_par_map: dictionary
+            unconstrained parameter posterior mode
+
+        constrained_par_map: dictionary
+            constrained parameters at the posterior mode
+
+        scipyopt: SciPy optimization object
+            results of MAP estimation
+
+        layout: ParameterLayout
+            layout of the unconstrained parameter vector
+
+        constrained_layout: ParameterLayout
+            layout of the constrained parameter vector
+
+        hessian: array (optional)
+            [p, p] Hessian of the negative log posterior density
+
+        delta: array (optional)
+            Delta matrix, rows of var_params only
+
+        variance: array (optional)
+            constrained variance matrix of var_params
+
+        var_params: list (optional)
+            names of the constrained parameters of the Delta and
+            variance rows, defaults to all
+
+        plan: ModelPlan (optional)
+            model the result was fitted with, needed by sample
+
+        data: dict (optional)
+            prepared data (ModelPlan.prepare_data) used by sample for
+            the constrained parameters and posterior predictive draws
+    """
+    __slots__ = ("unconstrained_par_map", "constrained_par_map", "scipyopt",
+                 "hessian_array", "delta_array", "variance_array", "layout",
+                 "constrained_layout", "var_params", "plan", "data",
+                 "_var_rows", "_frames", "_cholesky")
+
+    def __init__(self, unconstrained_par_map, constrained_par_map,
+                 scipyopt, layout, constrained_layout, hessian=None,
+                 delta=None, variance=None, var_params=None, plan=None,
+                 data=None):
+        self.unconstrained_par_map = unconstrained_par_map
+        self.constrained_par_map = constrained_par_map
+        self.scipyopt = scipyopt
+        self.layout = layout
+        self.constrained_layout = constrained_layout
+        self.hessian_array = hessian
+        self.delta_array = delta
+        self.variance_array = variance
+        self.var_params = list(constrained_layout.names) \
+            if var_params is None else list(var_params)
+        self._var_rows = {}
+        offset = 0
+        for name in self.var_params:
+            size = constrained_layout.sizes[name]
+            self._var_rows[name] = slice(offset, offset + size)
+            offset = offset + size
+        self.plan = plan
+        self.data = data
+        self._frames = {}
+        self._cholesky = None
+
+    def _index(self, key):
+        # pylint: disable=import-outside-toplevel
+        import pandas as pd
+        if key not in self._frames:
+            if key == "unconstrained":
+                labels = self.layout.labels
+            else:
+                labels = [self.constrained_layout.labels[i] for i in
+                          self.constrained_layout.index(self.var_params)]
+            self._frames[key] = pd.Index(labels)
+        return self._frames[key]
+
+    def _frame(self, key, array, index, columns):
+        # pylint: disable=import-outside-toplevel
+        import pandas as pd
+        if array is None:
+            return None
+        if key not in self._frames:
+            with profiling.phase("labeling"):
+                self._frames[key] = pd.DataFrame(
+                    array, index=self._index(index),
+                    columns=self._index(columns), copy=False)
+        return self._frames[key]
+
+    @property
+    def hessian(self):
+        """ Hessian DataFrame, the sparse matrix itself when sparse"""
+        if scipy.sparse.issparse(self.hessian_array):
+            return self.hessian_array
+        return self._frame("hessian", self.hessian_array,
+                           "unconstrained", "unconstrained")
+
+    @property
+    def delta(self):
+        """ Delta matrix DataFrame"""
+        return self._frame("delta", self.delta_array,
+                           "constrained", "unconstrained")
+
+    @property
+    def variance(self):
+        """ Constrained variance DataFrame"""
+        return self._frame("variance", self.variance_array,
+                           "constrained", "constrained")
+
+    def covariance(self, name, other=None):
+        """ Block of the constrained variance matrix
+
+            Parameters:
+            -------
+            name: string
+                constrained parameter of the rows
+
+            other: string (optional)
+                constrained parameter of the columns, defaults to name
+
+            Returns:
+            -------
+            [size of name, size of other] view of the variance array
+        """
+        if self.variance_array is None:
+            raise MapVarException('variance was not estimated, fit with skip_var=False')
+        other = name if other is None else other
+        unknown = [par for par in (name, other) if par not in self._var_rows]
+        if unknown:
+            raise MapVarException('no variance estimated for: ' + ', '.join(unknown))
+        return self.variance_array[self._var_rows[name],
+                                   self._var_rows[other]]
+
+    def sample_chunks(self, n_draws, seed=None, chunk_size=1000,
+                      post_pred=True):
+        """ Draws from the Laplace approximation of the posterior, in
+            chunks of at most chunk_size draws
+
+            Unconstrained parameters are drawn from N(MAP, H^-1)
+            through the Cholesky factor H = L L' as
+            MAP + L'^-1 z, and all draws of a chunk are pushed through
+            the constrained functions and, optionally, the observed
+            distributions in one vectorized traversal.
+
+            Parameters:
+            -------
+            n_draws: int
+                number of draws S
+
+            seed: int (optional)
+                seed of the draws, the same seed, n_draws and
+                chunk_size give the same draws
+
+            chunk_size: int, default value = 1000
+                most draws evaluated at once, bounding memory use
+
+            post_pred: boolean, default value = True
+                also draw the observed variables given each parameter
+                draw
+
+            Returns:
+            -------
+            iterator over dictionaries with keys "unconstrained",
+            "constrained" and, with post_pred, "post_pred", each a
+            dictionary of [draws in chunk, ...] tensors
+        """
+        if self.plan is None:
+            raise MapVarException('result has no model, set its plan and data to sample')
+        cholesky = self._hessian_cholesky()
+        if seed is None:
+            seed = np.random.default_rng().integers(2**31 - 1)
+        par_map = self.layout.pack(self.unconstrained_par_map).numpy()
+        traverse = self._draw_traversal(post_pred)
+        for start in range(0, n_draws, chunk_size):
+            size = min(chunk_size, n_draws - start)
+            normal_seed, pred_seed = tfp.random.split_seed(
+                tf.constant([int(seed), start], tf.int32))
+            normal = tf.random.stateless_normal(
+                [self.layout.size, size], normal_seed, dtype=tf.float64)
+            par_vecs = tf.constant(par_map + np.transpose(
+                scipy.linalg.solve_triangular(
+                    cholesky, normal.numpy(), lower=True, trans="T")))
+            chunk = {"unconstrained": self.layout.unpack(par_vecs)}
+            if post_pred:
+                chunk["constrained"], chunk["post_pred"] = traverse(
+                    par_vecs, tf.random.stateless_uniform(
+                        [size, 2], pred_seed, minval=None, maxval=None,
+                        dtype=tf.int32))
+            else:
+                chunk["constrained"] = traverse(par_vecs)
+            yield chunk
+
+    def _hessian_cholesky(self):
+        """ Lower Cholesky factor L of the Hessian H = L L', computed
+            once
+        """
+        if self.hessian_array is None:
+            raise MapVarException('result has no Hessian, fit it with skip_var=False and a dense or sparse hessian_method')
+        if self._cholesky is None:
+            hessian = self.hessian_array.toarray() \
+                if scipy.sparse.issparse(self.hessian_array) \
+                else np.asarray(self.hessian_array)
+            try:
+                self._cholesky = np.linalg.cholesky(hessian)
+            except np.linalg.LinAlgError as err:
+                raise MapVarException('Hessian is not positive definite, the posterior mode may not have been found') from err
+        return self._cholesky
+
+    @property
+    def log_marginal_likelihood(self):
+        """ Laplace approximation of the log marginal likelihood
+
+            log p(y) = log p(y, MAP) + p/2 log(2 pi) - 1/2 log|H|,
+            with log p(y, MAP) the log posterior density at the mode
+            (-scipyopt.fun) and log|H| = 2 sum(log diag(L)) from the
+            Cholesky factor of the Hessian, so H is not inverted.
+            None when the result has no Hessian.
+        """
+        if self.hessian_array is None:
+            return None
+        log_det = 2 * np.sum(np.log(np.diag(self._hessian_cholesky())))
+        return -float(self.scipyopt.fun) + \
+            self.layout.size / 2 * np.log(2 * np.pi) - log_det / 2
+
+    def sample(self, n_draws, seed=None, chunk_size=1000, post_pred=True):
+        """ Draws from the Laplace approximation of the posterior
+
+            Parameters and returns as sample_chunks, with the chunks
+            concatenated into [n_draws, ...] tensors.
+        """
+        chunks = list(self.sample_chunks(n_draws, seed, chunk_size,
+                                         post_pred))
+        return tf.nest.map_structure(lambda *parts: tf.concat(parts, 0),
+                                     *chunks)
+
+    def _draw_traversal(self, post_pred):
+        plan, data, layout = self.plan, self.data, self.layout
+        if post_pred:
+            @tf.function
+            def traverse(par_vecs, seeds):
+                return tf.vectorized_map(
+                    lambda args: plan.post_pred(layout.unpack(args[0]),
+                                                data, seed=args[1]),
+                    (par_vecs, seeds))
+        else:
+            @tf.function
+            def traverse(par_vecs):
+                return tf.vectorized_map(
+                    lambda par_vec: plan.constrained(
+                        layout.unpack(par_vec), data), par_vecs)
+        return traverse
+
+    def save(self, path):
+        """ Save the result to a directory of .npy files
+
+            Each array is written as its own .npy file, next to a JSON
+            manifest of the parameter names and shapes, so load can
+            memory-map the matrices instead of reading them into
+            memory. A sparse Hessian is saved as its CSC arrays.
+
+            Parameters:
+            -------
+            path: string
+                directory to save to, created if missing
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            "unconstrained": self.layout.pack(
+                self.unconstrained_par_map).numpy(),
+            "constrained": self.constrained_layout.pack(
+                self.constrained_par_map).numpy(),
+            "delta": self.delta_array,
+            "variance": self.variance_array}
+        hessian = None
+        if scipy.sparse.issparse(self.hessian_array):
+            hessian = "sparse"
+            matrix = self.hessian_array.tocsc()
+            arrays.update({"hessian_data": matrix.data,
+                           "hessian_indices": matrix.indices,
+                           "hessian_indptr": matrix.indptr})
+        elif self.hessian_array is not None:
+            hessian = "dense"
+            arrays["hessian"] = self.hessian_array
+        files = {}
+        for name, array in arrays.items():
+            if array is not None:
+                files[name] = name + ".npy"
+                np.save(os.path.join(path, files[name]), np.asarray(array))
+        scipyopt = {field: convert(getattr(self.scipyopt, field))
+                    for field, convert in _SCIPYOPT_FIELDS.items()
+                    if getattr(self.scipyopt, field, None) is not None}
+        manifest = {
+            "version": _FORMAT_VERSION,
+            "unconstrained": {name: list(shape) for name, shape in
+                              self.layout.shapes.items()},
+            "constrained": {name: list(shape) for name, shape in
+                            self.constrained_layout.shapes.items()},
+            "var_params": self.var_params,
+            "hessian": hessian,
+            "hessian_shape": None if hessian is None else
+                list(self.hessian_array.shape),
+            "scipyopt": scipyopt,
+            "files": files}
+        with open(os.path.join(path, MANIFEST), "w",
+                  encoding="utf-8") as file:
+            json.dump(manifest, file, indent=1)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """ Load a result saved with save
+
+            Parameters:
+            -------
+            path: string
+                directory the result was saved to
+
+            mmap_mode: string (optional), default value = "r"
+                memory-map mode of the matrices, see numpy.load.
+                With "r" the matrices stay on disk and only the
+                blocks read are paged in. None reads them into memory.
+
+            Returns:
+            -------
+            MapVarResult
+        """
+        try:
+            with open(os.path.join(path, MANIFEST), encoding="utf-8") \
+                    as file:
+                manifest = json.load(file)
+        except FileNotFoundError as err:
+            raise MapVarException('no saved mapvar result in ' + str(path)) from err
+        if manifest.get("version") != _FORMAT_VERSION:
+            raise MapVarException('unsupported saved result version: ' + str(manifest.get("version")))
+        files = manifest["files"]
+
+        def load_array(name, mode=mmap_mode):
+            if name not in files:
+                return None
+            return np.load(os.path.join(path, files[name]),
+                           mmap_mode=mode)
+
+        layout = ParameterLayout(manifest["unconstrained"])
+        constrained_layout = ParameterLayout(manifest["constrained"])
+        unconstrained = load_array("unconstrained", None)
+        hessian = load_array("hessian")
+        if manifest["hessian"] == "sparse":
+            hessian = scipy.sparse.csc_matrix(
+                (load_array("hessian_data"), load_array("hessian_indices"),
+                 load_array("hessian_indptr")),
+                shape=tuple(manifest["hessian_shape"]))
+        return cls(layout.unpack(unconstrained),
+                   constrained_layout.unpack(load_array("constrained", None)),
+                   scipy.optimize.OptimizeResult(x=unconstrained,
+                                                 **manifest["scipyopt"]),
+                   layout, constrained_layout, hessian,
+                   load_array("delta"), load_array("variance"),
+                   manifest["var_params"])
+
+    def __getitem__(self, index):
+        return getattr(self, _FIELDS[index])
+
+    def fields(self, index=slice(None)):
+        """ Tuple of the fields of the 6-tuple selected by a slice,
+            only computing the selected ones
+        """
+        return tuple(getattr(self, field) for field in _FIELDS[index])
+
+    def __iter__(self):
+        for field in _FIELDS:
+            yield getattr(self, field)
+
+    def __len__(self):
+        return len(_FIELDS)
+
+    def __repr__(self):
+        return "MapVarResult(" + ", ".join(
+            self.layout.names) + ", variance=" + \
+            str(self.variance_array is not None) + ")"
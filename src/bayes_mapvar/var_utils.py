@@ -1,10 +1,22 @@
 ''' Utilities for posterior variance estimation'''
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import numpy as np
-import pandas as pd
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
 
 import tensorflow as tf
 import tensorflow_probability as tfp
 
+from bayes_mapvar import profiling
+from bayes_mapvar.exceptions import MapVarException
+from bayes_mapvar.map_utils import ParameterLayout
+from bayes_mapvar.parallel import process_pool, worker_state
+
+HESSIAN_METHODS = ["finite_difference", "batched_finite_difference",
+                   "sparse", "autodiff", "matrix_free"]
+
 def get_bandwidths(unconstrained_par_vec):
     """ Get bandwidths for calculating numeric derivatives w.r.t. the parameters
     """
@@ -15,9 +27,734 @@ def get_bandwidths(unconstrained_par_vec):
     scaleparmstable = scale + abspars
     return scaleparmstable - abspars
 
+def get_autodiff_hessian_delta(unconstrained_par_vec, loss,
+        constrained_par_vec_fcn):
+    """ Get Hessian and Delta matrix by automatic differentiation
+
+        The Hessian is the Jacobian of the gradient and the Delta
+        matrix the Jacobian of the constrained parameter vector, both
+        vectorized with pfor instead of probing each parameter.
+
+        Parameters:
+        -------
+        unconstrained_par_vec: vector
+            unconstrained parameter values
+
+        loss: function
+            negative of log posterior density function
+
+        constrained_par_vec_fcn: function
+            returns constrained parameters in a vector given
+            unconstrained
+
+        Returns:
+        -------
+        hessian: array
+            Hessian matrix of negative log posterior density
+
+        delta: array
+            Delta matrix for constrained parameter variance
+            calculation
+    """
+    par_vec = tf.convert_to_tensor(unconstrained_par_vec, tf.float64)
+    return autodiff_hessian(loss, par_vec).numpy(), \
+        get_autodiff_delta(par_vec, constrained_par_vec_fcn)
+
+def autodiff_hessian(loss, par_vec):
+    """ Hessian of loss by automatic differentiation
+
+        Parameters:
+        -------
+        loss: function
+            negative of log posterior density function
+
+        par_vec: 1D tensor
+            unconstrained parameter values
+
+        Returns:
+        -------
+        2D tensor, Hessian of loss at par_vec
+    """
+    with tf.GradientTape() as outer_tape:
+        outer_tape.watch(par_vec)
+        with tf.GradientTape() as inner_tape:
+            inner_tape.watch(par_vec)
+            loss_value = tf.reduce_sum(loss(par_vec))
+        gradient = inner_tape.gradient(loss_value, par_vec)
+    return outer_tape.jacobian(gradient, par_vec)
+
+def get_autodiff_delta(unconstrained_par_vec, constrained_par_vec_fcn):
+    """ Get Delta matrix by automatic differentiation
+
+        Parameters:
+        -------
+        unconstrained_par_vec: vector
+            unconstrained parameter values
+
+        constrained_par_vec_fcn: function
+            returns constrained parameters in a vector given
+            unconstrained
+
+        Returns:
+        -------
+        Delta matrix for constrained parameter variance calculation
+    """
+    par_vec = tf.convert_to_tensor(unconstrained_par_vec, tf.float64)
+    with tf.GradientTape() as tape:
+        tape.watch(par_vec)
+        constrained = constrained_par_vec_fcn(par_vec)
+    return tape.jacobian(constrained, par_vec).numpy()
+
+def _probe_fcn(loss_and_gradient, constrained_par_vec_fcn,
+               loss_gradient_constrained=None):
+    """ Function of a NumPy parameter vector returning the gradient and
+        the constrained parameter vector, from one traversal of the
+        model when loss_gradient_constrained is given
+    """
+    def probe(par_vec):
+        if loss_gradient_constrained is not None:
+            _, gradient, constrained = loss_gradient_constrained(par_vec)
+        else:
+            gradient = loss_and_gradient(
+                tf.convert_to_tensor(par_vec, tf.float64))[1]
+            constrained = constrained_par_vec_fcn(par_vec)
+        return np.asarray(gradient), np.asarray(constrained)
+    return probe
+
+def _column(probe, unconstrained_par_vec, bandwidths, iter_par):
+    """ Hessian and Delta column iter_par by central differences"""
+    parplus = unconstrained_par_vec.copy()
+    parplus[iter_par] = parplus[iter_par] \
+        + bandwidths[iter_par]
+    parminus = unconstrained_par_vec.copy()
+    parminus[iter_par] = parminus[iter_par] \
+        - bandwidths[iter_par]
+    gradplus, consplus = probe(parplus)
+    gradminus, consminus = probe(parminus)
+    return (gradplus - gradminus) / (2 * bandwidths[iter_par]), \
+        (consplus - consminus) / (2 * bandwidths[iter_par])
+
+def _worker_column(unconstrained_par_vec, bandwidths, iter_par):
+    state = worker_state()
+    if "probe" not in state:
+        state["probe"] = state["probe_builder"]()
+    return _column(state["probe"], unconstrained_par_vec, bandwidths,
+                   iter_par)
+
+def _columns(probe, unconstrained_par_vec, bandwidths, todo, n_jobs,
+             probe_builder, n_threads):
+    """ Iterate over (iter_par, Hessian column, Delta column) of the
+        columns todo, in the order they finish
+    """
+    if n_jobs == 1:
+        for iter_par in todo:
+            with profiling.phase("hessian_probe"):
+                yield (iter_par,) + _column(probe, unconstrained_par_vec,
+                                            bandwidths, iter_par)
+        return
+    if probe_builder is None:
+        pool = ThreadPoolExecutor(max_workers=n_jobs)
+        futures = {pool.submit(_column, probe, unconstrained_par_vec,
+                               bandwidths, iter_par): iter_par
+                   for iter_par in todo}
+    else:
+        pool = process_pool(n_jobs, {"probe_builder": probe_builder},
+                            n_threads)
+        futures = {pool.submit(_worker_column, unconstrained_par_vec,
+                               bandwidths, iter_par): iter_par
+                   for iter_par in todo}
+    with pool, profiling.phase("hessian_probe"):
+        for future in as_completed(futures):
+            yield (futures[future],) + future.result()
+
+def _finite_difference_hessian_delta(unconstrained_par_vec, probe,
+                                     bandwidths, checkpoint=None,
+                                     n_jobs=None, probe_builder=None,
+                                     n_threads=None):
+    npar = len(unconstrained_par_vec)
+    hessian = np.zeros((npar,npar))
+    delta = None
+    done = np.zeros(npar, dtype=bool)
+    if checkpoint is not None:
+        resumed = checkpoint.hessian_columns(unconstrained_par_vec,
+                                             bandwidths)
+        if resumed is not None:
+            hessian, delta, done = resumed
+    todo = [iter_par for iter_par in range(npar) if not done[iter_par]]
+    n_jobs = max(1, min(n_jobs or 1, len(todo)))
+    for iter_par, hessian_column, delta_column in _columns(
+            probe, unconstrained_par_vec, bandwidths, todo, n_jobs,
+            probe_builder, n_threads):
+        hessian[:, iter_par] = hessian_column
+        if delta is None:
+            delta = np.zeros((len(delta_column), npar))
+        delta[:, iter_par] = delta_column
+        done[iter_par] = True
+        if checkpoint is not None:
+            checkpoint.record_columns(unconstrained_par_vec, bandwidths,
+                                      hessian, delta, done)
+    if checkpoint is not None:
+        checkpoint.record_columns(unconstrained_par_vec, bandwidths,
+                                  hessian, delta, done, force=True)
+    return hessian, delta
+
+def _batched_finite_difference_hessian_delta(unconstrained_par_vec,
+        loss, constrained_par_vec_fcn, bandwidths):
+    """ Central differences with all 2p probes in one vectorized call"""
+    npar = len(unconstrained_par_vec)
+    steps = np.diag(bandwidths)
+    probes = tf.convert_to_tensor(
+        np.concatenate([unconstrained_par_vec + steps,
+                        unconstrained_par_vec - steps]), tf.float64)
+
+    def probe(par_vec):
+        gradient = tfp.math.value_and_gradient(loss, par_vec)[1]
+        return gradient, constrained_par_vec_fcn(par_vec)
+
+    with profiling.phase("hessian_probe"):
+        gradients, constrained = tf.vectorized_map(
+            probe, probes, fallback_to_while_loop=True)
+    scale = 2 * np.reshape(bandwidths, (npar, 1))
+    hessian = np.transpose(
+        (gradients[:npar].numpy() - gradients[npar:].numpy()) / scale)
+    delta = np.transpose(
+        (constrained[:npar].numpy() - constrained[npar:].numpy()) / scale)
+    return hessian, delta
+
+def get_par_labels(par_size):
+    """ Get labels of flattened parameter vector elements
+
+        Parameters:
+        -------
+        par_size: dict or ParameterLayout
+            dictionary of sizes of parameters
+
+        Returns:
+        -------
+        list of labels, the parameter name for parameters of size 1
+        and the parameter name with an "_i" suffix otherwise
+    """
+    return ParameterLayout.from_sizes(par_size).labels
+
+def get_var_index(constrained_par_size, var_params=None):
+    """ Get positions of selected constrained parameters in the
+        flattened constrained parameter vector
+
+        Parameters:
+        -------
+        constrained_par_size: dict or ParameterLayout
+            dictionary of sizes of constrained parameters
+
+        var_params: list (optional)
+            names of constrained parameters, defaults to all
+
+        Returns:
+        -------
+        integer array of positions
+    """
+    layout = ParameterLayout.from_sizes(constrained_par_size)
+    unknown = [par for par in var_params or []
+               if par not in layout.sizes]
+    if unknown:
+        raise MapVarException('unknown constrained parameters in var_params: ' + ', '.join(unknown))
+    return layout.index(var_params)
+
+def hessian_vector_product(loss, par_vec, vector):
+    """ Product of the Hessian of loss and a vector
+
+        Forward-over-reverse automatic differentiation, the Hessian
+        is never formed.
+
+        Parameters:
+        -------
+        loss: function
+            negative of log posterior density function
+
+        par_vec: 1D tensor
+            unconstrained parameter values
+
+        vector: 1D tensor
+            vector to multiply
+
+        Returns:
+        -------
+        1D tensor, Hessian of loss at par_vec times vector
+    """
+    with tf.autodiff.ForwardAccumulator(par_vec, vector) as accumulator:
+        with tf.GradientTape() as tape:
+            tape.watch(par_vec)
+            loss_value = tf.reduce_sum(loss(par_vec))
+        gradient = tape.gradient(loss_value, par_vec)
+    return accumulator.jvp(gradient)
+
+def conjugate_gradient(matmul, rhs, tol=1e-10, maxiter=None):
+    """ Solve A X = rhs for all columns of rhs by conjugate gradients
+
+        Parameters:
+        -------
+        matmul: function
+            returns A times a matrix, A symmetric positive definite
+
+        rhs: 2D array
+            right hand sides, one per column
+
+        tol: float, default value = 1e-10
+            relative residual tolerance
+
+        maxiter: int (optional)
+            maximum number of iterations, defaults to ten times the
+            number of rows
+
+        Returns:
+        -------
+        solution with the same shape as rhs
+    """
+    if maxiter is None:
+        maxiter = 10 * rhs.shape[0]
+    solution = np.zeros(rhs.shape)
+    residual = rhs.copy()
+    direction = residual.copy()
+    residual_norm = np.sum(residual**2, axis=0)
+    target = tol**2 * residual_norm
+    for _ in range(maxiter):
+        active = residual_norm > target
+        if not np.any(active):
+            return solution
+        product = matmul(direction)
+        curvature = np.sum(direction * product, axis=0)
+        if np.any(curvature[active] <= 0):
+            raise MapVarException('Hessian is not positive definite')
+        step = np.where(active, residual_norm / np.where(
+            active, curvature, 1), 0)
+        solution = solution + step * direction
+        residual = residual - step * product
+        new_residual_norm = np.sum(residual**2, axis=0)
+        direction = residual + np.where(
+            active, new_residual_norm / np.where(
+                active, residual_norm, 1), 0) * direction
+        residual_norm = new_residual_norm
+    raise MapVarException('conjugate gradient solve did not converge')
+
+def get_matrix_free_delta_variance(unconstrained_par_vec, loss,
+        constrained_par_vec_fcn, var_index, tol=1e-10, maxiter=None):
+    """ Get Delta rows and constrained variance without forming the
+        Hessian
+
+        The requested rows of the Delta matrix are solved against the
+        Hessian by conjugate gradients, each iteration taking one
+        batch of Hessian-vector products, giving D H^-1 D' in O(p)
+        memory per requested row.
+
+        Parameters:
+        -------
+        unconstrained_par_vec: vector
+            unconstrained parameter values
+
+        loss: function
+            negative of log posterior density function
+
+        constrained_par_vec_fcn: function
+            returns constrained parameters in a vector given
+            unconstrained
+
+        var_index: array
+            positions of the requested elements of the constrained
+            parameter vector
+
+        tol: float, default value = 1e-10
+            relative residual tolerance of the conjugate gradient solves
+
+        maxiter: int (optional)
+            maximum number of conjugate gradient iterations
+
+        Returns:
+        -------
+        delta: array
+            rows of the Delta matrix for the requested elements
+
+        constrained_var: array
+            constrained variance matrix of the requested elements
+    """
+    par_vec = tf.convert_to_tensor(unconstrained_par_vec, tf.float64)
+    with tf.GradientTape() as tape:
+        tape.watch(par_vec)
+        constrained = tf.gather(constrained_par_vec_fcn(par_vec),
+                                var_index)
+    delta = tape.jacobian(constrained, par_vec).numpy()
+
+    def hvp(vector):
+        return hessian_vector_product(loss, par_vec, vector)
+
+    @tf.function
+    def batch_hvp(vectors):
+        return tf.vectorized_map(hvp, vectors)
+
+    def matmul(matrix):
+        return np.transpose(batch_hvp(tf.convert_to_tensor(
+            np.transpose(matrix), tf.float64)).numpy())
+
+    solves = conjugate_gradient(matmul, np.transpose(delta), tol, maxiter)
+    return delta, np.matmul(delta, solves)
+
+def get_hessian_coloring(unconstrained_par_size, hessian_structure):
+    """ Color the Hessian columns so that columns sharing a color can
+        be probed together
+
+        Columns conflict when they have a nonzero in a common row of
+        the Hessian or the Delta matrix, so that after perturbing all
+        columns of one color at once every nonzero can be attributed
+        to a single column. Parameters are colored greedily, largest
+        first, at the level of the unconstrained parameters of the
+        model graph.
+
+        Parameters:
+        -------
+        unconstrained_par_size: dict
+            dictionary of sizes of unconstrained parameters
+
+        hessian_structure: tuple
+            terms and constrained dependencies, as returned by
+            ModelPlan.hessian_structure
+
+        Returns:
+        -------
+        colors: array
+            color of each element of the unconstrained parameter vector
+
+        adjacency: dictionary
+            set of unconstrained parameters each unconstrained
+            parameter interacts with in the Hessian
+    """
+    terms, constrained_deps = hessian_structure
+    adjacency = {par: {par} for par in unconstrained_par_size}
+    for term in terms:
+        for par in term:
+            adjacency[par] = adjacency[par] | term
+    conflicts = {par: set() for par in unconstrained_par_size}
+    for group in list(adjacency.values()) + \
+            list(constrained_deps.values()):
+        for par in group:
+            conflicts[par] = conflicts[par] | group
+    par_colors = {}
+    for par in sorted(unconstrained_par_size,
+                      key=lambda par: -int(unconstrained_par_size[par])):
+        used = set()
+        for other in conflicts[par]:
+            used.update(par_colors.get(other, []))
+        par_colors[par] = []
+        color = 0
+        while len(par_colors[par]) < int(unconstrained_par_size[par]):
+            if color not in used:
+                par_colors[par].append(color)
+            color = color + 1
+    colors = np.concatenate([np.array(par_colors[par], dtype=int)
+                             for par in unconstrained_par_size])
+    return colors, adjacency
+
+def _element_structure(probe, unconstrained_par_vec, bandwidths,
+                       elements):
+    """ Element-level dependencies on the given parameter elements
+
+        Probes perturb the elements whose position in elements has a
+        given bit set, then those with it unset, 2 log2(len(elements))
+        probes in all. Values that depend on no perturbed element are
+        reproduced exactly. A gradient entry of an element that does not
+        change when only elements on the other side of some bit move is
+        diagonal, it depends on no other of the elements. A constrained
+        entry that changes on exactly one side of every bit depends on
+        the one element whose bits those are.
+
+        Returns:
+        -------
+        diagonal: boolean array
+            for each of the elements, does its gradient entry depend
+            on none of the other elements?
+
+        dependence: int array
+            for each constrained entry, the position in elements of the
+            only element it depends on, -1 for none and -2 for several
+    """
+    base_gradient, base_constrained = probe(unconstrained_par_vec)
+    positions = np.arange(len(elements))
+    n_bits = max(1, int(np.ceil(np.log2(len(elements)))))
+    others = np.zeros(len(elements), dtype=bool)
+    changed = np.zeros((2, n_bits, len(base_constrained)), dtype=bool)
+    for bit in range(n_bits):
+        side = (positions >> bit) & 1
+        for value in (0, 1):
+            members = elements[side == value]
+            if len(members) == 0:
+                continue
+            step = np.zeros(len(unconstrained_par_vec))
+            step[members] = bandwidths[members]
+            with profiling.phase("hessian_probe"):
+                gradient, constrained = probe(unconstrained_par_vec + step)
+            others = others | ((gradient[elements] !=
+                                base_gradient[elements]) & (side != value))
+            changed[value, bit] = constrained != base_constrained
+    sides = changed[0].astype(int) + changed[1]
+    codes = np.sum(changed[1] * (1 << np.arange(n_bits))[:, None], axis=0)
+    dependence = np.where(np.all(sides == 0, axis=0), -1, -2)
+    single = np.all(sides == 1, axis=0) & (codes < len(elements))
+    dependence[single] = codes[single]
+    return ~others, dependence
+
+def _color_cliques(n_elements, cliques):
+    """ Greedy coloring of elements so that the members of each clique
+        have distinct colors
+    """
+    colors = np.zeros(n_elements, dtype=int)
+    member_of = [[] for _ in range(n_elements)]
+    for index, clique in enumerate(cliques):
+        for element in clique:
+            member_of[element].append(index)
+    used = np.zeros((len(cliques), n_elements + 1), dtype=bool)
+    for element in range(n_elements):
+        if not member_of[element]:
+            continue
+        color = int(np.argmin(np.any(used[member_of[element]], axis=0)))
+        colors[element] = color
+        used[member_of[element], color] = True
+    return colors
+
+def get_sparse_hessian_delta(unconstrained_par_vec, loss_and_gradient,
+        constrained_par_vec_fcn, bandwidths, unconstrained_par_size,
+        constrained_par_size, hessian_structure,
+        loss_gradient_constrained=None):
+    """ Get sparse Hessian and Delta matrix by compressed central
+        differences
+
+        All columns of one color are perturbed together, so
+        2 x (number of colors) gradient and constrained parameter
+        evaluations replace 2p. Parameters with at most sqrt(p)
+        elements are colored with get_hessian_coloring from the model
+        graph and their columns are recovered whole, including the
+        rows of larger parameters. The elements of larger parameters,
+        such as a vector of random effects, are colored by their
+        element-level structure from _element_structure, and their
+        rows of the smaller parameters follow by symmetry. A random
+        effect vector whose gradient entries each depend on their own
+        element only then takes a single color. Large parameters whose
+        elements interact, or whose constrained parameters depend on
+        several of their elements, fall back to a color per element.
+
+        Parameters:
+        -------
+        unconstrained_par_vec: vector
+            unconstrained parameter values
+
+        loss_and_gradient: function
+            returns the value and gradient of the negative log
+            posterior density
+
+        constrained_par_vec_fcn: function
+            returns constrained parameters in a vector given
+            unconstrained
+
+        bandwidths: vector
+            bandwidths to use in numerical derivatives
+
+        unconstrained_par_size: dict or ParameterLayout
+            dictionary of sizes of unconstrained parameters
+
+        constrained_par_size: dict or ParameterLayout
+            dictionary of sizes of constrained parameters
+
+        hessian_structure: tuple
+            terms and constrained dependencies, as returned by
+            ModelPlan.hessian_structure
+
+        loss_gradient_constrained: function (optional)
+            returns the loss, its gradient and the constrained
+            parameter vector from one traversal of the model, used
+            instead of loss_and_gradient and constrained_par_vec_fcn
+
+        Returns:
+        -------
+        hessian: scipy.sparse.csc_matrix
+            Hessian matrix of negative log posterior density
+
+        delta: scipy.sparse.csr_matrix
+            Delta matrix for constrained parameter variance
+            calculation
+    """
+    unconstrained_layout = ParameterLayout.from_sizes(unconstrained_par_size)
+    constrained_layout = ParameterLayout.from_sizes(constrained_par_size)
+    probe = _probe_fcn(loss_and_gradient, constrained_par_vec_fcn,
+                       loss_gradient_constrained)
+    sizes = unconstrained_layout.sizes
+    npar = len(unconstrained_par_vec)
+    large = {par for par, size in sizes.items()
+             if int(size) > max(1, np.sqrt(npar))}
+    small_colors, adjacency = get_hessian_coloring(
+        {par: 0 if par in large else size for par, size in sizes.items()},
+        hessian_structure)
+    constrained_deps = hessian_structure[1]
+    bandwidths = np.asarray(bandwidths)
+    ncons = constrained_layout.size
+    owners = np.concatenate([[par] * int(size) for par, size in
+                             sizes.items()])
+    is_large = np.isin(owners, list(large))
+    elements = np.flatnonzero(is_large)
+    n_small_colors = int(np.max(small_colors)) + 1 \
+        if len(small_colors) else 0
+    colors = np.zeros(npar, dtype=int)
+    colors[~is_large] = small_colors
+    position = np.full(npar, -1)
+    position[elements] = np.arange(len(elements))
+    if len(elements):
+        diagonal, dependence = _element_structure(
+            probe, unconstrained_par_vec, bandwidths, elements)
+        nondiagonal = {par: elements[(owners[elements] == par) &
+                                     ~diagonal] for par in large}
+        hess_rows_of = {par: _concat([nondiagonal[other]
+                                      for other in adjacency[par]
+                                      if other in large]).astype(int)
+                        for par in large}
+        multi_rows = {par: rows[dependence[rows] == -2] for par, rows in
+                      ((par, constrained_layout.rows(par))
+                       for par in constrained_deps)}
+        single_rows = {}
+        for row in np.flatnonzero(dependence >= 0):
+            single_rows.setdefault(int(dependence[row]), []).append(row)
+        cliques = [position[hess_rows_of[par]] for par in large
+                   if len(nondiagonal[par])]
+        cliques = cliques + [
+            position[np.flatnonzero(np.isin(owners, list(deps & large)))]
+            for par, deps in constrained_deps.items()
+            if len(multi_rows[par])]
+        colors[elements] = n_small_colors + _color_cliques(
+            len(elements), [clique for clique in cliques if len(clique)])
+    hess_rows, hess_cols, hess_vals = [], [], []
+    delta_rows, delta_cols, delta_vals = [], [], []
+    for color in range(int(np.max(colors)) + 1 if npar else 0):
+        members = np.flatnonzero(colors == color)
+        step = np.zeros(npar)
+        step[members] = bandwidths[members]
+        with profiling.phase("hessian_probe"):
+            gradplus, consplus = probe(unconstrained_par_vec + step)
+            gradminus, consminus = probe(unconstrained_par_vec - step)
+        for iter_par in members:
+            owner = owners[iter_par]
+            if owner in large:
+                rows = hess_rows_of[owner] \
+                    if not diagonal[position[iter_par]] \
+                    else np.array([iter_par])
+                cons_rows = np.concatenate([
+                    np.asarray(single_rows.get(position[iter_par], []),
+                               dtype=int)] +
+                    [multi_rows[par] for par, deps in
+                     constrained_deps.items() if owner in deps])
+                pars_rows = [(rows, False)]
+            else:
+                cons_rows = _concat([constrained_layout.rows(par) for
+                                     par, deps in constrained_deps.items()
+                                     if owner in deps]).astype(int)
+                pars_rows = [(unconstrained_layout.rows(par), par in large)
+                             for par in adjacency[owner]]
+            for rows, mirror in pars_rows:
+                values = (gradplus[rows] - gradminus[rows]) / (
+                    2 * bandwidths[iter_par])
+                hess_rows.append(rows)
+                hess_cols.append(np.full(len(rows), iter_par))
+                hess_vals.append(values)
+                if mirror:
+                    hess_rows.append(np.full(len(rows), iter_par))
+                    hess_cols.append(rows)
+                    hess_vals.append(values)
+            delta_rows.append(cons_rows)
+            delta_cols.append(np.full(len(cons_rows), iter_par))
+            delta_vals.append((consplus[cons_rows] - consminus[cons_rows]) / (
+                2 * bandwidths[iter_par]))
+    hessian = _sparse(hess_vals, hess_rows, hess_cols, (npar, npar)).tocsc()
+    delta = _sparse(delta_vals, delta_rows, delta_cols,
+                    (ncons, npar)).tocsr()
+    return hessian, delta
+
+def _sparse(values, rows, cols, shape):
+    """ COO matrix of the nonzero triplets"""
+    values = _concat(values)
+    keep = values != 0
+    return scipy.sparse.coo_matrix(
+        (values[keep], (_concat(rows).astype(int)[keep],
+                        _concat(cols).astype(int)[keep])), shape=shape)
+
+def _concat(arrays):
+    if not arrays:
+        return np.zeros(0)
+    return np.concatenate(arrays)
+
+def get_constrained_variance(hessian, delta):
+    """ Get constrained variance from the Hessian and Delta matrix
+
+        The variance delta H^-1 delta' is computed as W' W with
+        W = L^-1 delta' from the Cholesky factor H = L L', so only one
+        triangular solve against the given Delta rows is needed and
+        the inverse Hessian is never formed.
+
+        Parameters:
+        -------
+        hessian: 2D array
+            Hessian matrix of negative log posterior density
+
+        delta: 2D array
+            rows of the Delta matrix of the constrained parameters
+            of interest
+
+        Returns:
+        -------
+        constrained variance matrix
+    """
+    with profiling.phase("variance_solve"):
+        try:
+            cholesky = np.linalg.cholesky(hessian)
+        except np.linalg.LinAlgError as err:
+            raise MapVarException('Hessian is not positive definite, the posterior mode may not have been found') from err
+        half = scipy.linalg.solve_triangular(cholesky, np.transpose(delta),
+                                             lower=True)
+        return np.matmul(np.transpose(half), half)
+
+def get_sparse_constrained_variance(hessian, delta):
+    """ Get constrained variance from a sparse Hessian and Delta matrix
+
+        The Hessian is factored by a sparse LU with symmetric pivoting
+        only, P H P' = L U. Then U = D L' and H is positive definite
+        exactly when the pivots in D are positive, as for
+        get_constrained_variance.
+
+        Parameters:
+        -------
+        hessian: scipy.sparse.csc_matrix
+            symmetric Hessian matrix of negative log posterior density
+
+        delta: 2D array
+            rows of the Delta matrix of the constrained parameters
+            of interest
+
+        Returns:
+        -------
+        constrained variance matrix
+    """
+    with profiling.phase("variance_solve"):
+        try:
+            factor = scipy.sparse.linalg.splu(
+                hessian, permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0,
+                options={"SymmetricMode": True})
+        except RuntimeError as err:
+            raise MapVarException('Hessian is not positive definite, the posterior mode may not have been found') from err
+        if not np.array_equal(factor.perm_r, factor.perm_c) or \
+                np.any(factor.U.diagonal() <= 0):
+            raise MapVarException('Hessian is not positive definite, the posterior mode may not have been found')
+        solves = factor.solve(np.transpose(delta))
+        return np.matmul(delta, solves)
+
 def get_hessian_delta_variance(unconstrained_par_vec, loss,
         constrained_par_vec_fcn, bandwidths,
-        unconstrained_par_size, constrained_par_size):
+        unconstrained_par_size, constrained_par_size,
+        loss_and_gradient=None, hessian_method="finite_difference",
+        var_params=None, hessian_structure=None, as_frames=True,
+        loss_gradient_constrained=None, checkpoint=None, n_jobs=None,
+        probe_builder=None, n_threads=None):
     """ Get Hessian for posterior and Delta matrix for constrained
         variance calculation
 
@@ -35,26 +772,101 @@ def get_hessian_delta_variance(unconstrained_par_vec, loss,
 
         bandwidths: vector
             bandwidths to use in numerical derivatives for
-            Hessian and Delta calculation
+            Hessian and Delta calculation, not used when
+            hessian_method is "autodiff" or "matrix_free"
 
-        unconstrained_par_size: dict
+        unconstrained_par_size: dict or ParameterLayout
             dictionary of sizes of unconstrained parameters,
             used in labeling hessian and delta matrices.
 
-        constrained_par_size: dict
+        constrained_par_size: dict or ParameterLayout
             dictionary of sizes of constrained parameters,
             used in labeling unconstrained variance matrix.
 
+        loss_and_gradient: function (optional)
+            returns the value and gradient of loss, such as the
+            compiled function from make_loss_and_gradient.
+            Defaults to tfp.math.value_and_gradient of loss.
+
+        hessian_method: string, default value = "finite_difference"
+            "finite_difference": central differences of the gradient
+                                 and constrained parameters
+            "batched_finite_difference": as "finite_difference",
+                                 with all 2p probes evaluated in
+                                 one vectorized call
+            "sparse": central differences compressed by coloring the
+                      Hessian sparsity pattern of hessian_structure,
+                      with a sparse LU solve for the variance
+            "autodiff": exact Hessian and Delta matrix from
+                        vectorized automatic differentiation
+            "matrix_free": Hessian-vector products and conjugate
+                           gradient solves, the Hessian is not formed
+
+        var_params: list (optional)
+            names of constrained parameters to return the variance
+            and Delta rows for, defaults to all
+
+        hessian_structure: tuple (optional)
+            terms and constrained dependencies, as returned by
+            ModelPlan.hessian_structure, required when
+            hessian_method="sparse"
+
+        as_frames: boolean, default value = True
+            return labeled DataFrames, otherwise NumPy arrays (and the
+            sparse Hessian) without labels
+
+        loss_gradient_constrained: function (optional)
+            returns the loss, its gradient and the constrained
+            parameter vector of a NumPy parameter vector from one
+            traversal of the model, optionally cached with
+            map_utils.cache_by_vector. Used for the probes of the
+            "finite_difference" and "sparse" methods instead of
+            loss_and_gradient and constrained_par_vec_fcn, which
+            traverse the model once each.
+
+        checkpoint: checkpoint.Checkpoint (optional)
+            checkpoint to resume the Hessian and Delta columns of the
+            "finite_difference" method from and write the completed
+            ones to
+
+        n_jobs: int (optional)
+            number of workers computing the columns of the
+            "finite_difference" method concurrently, each column
+            assembled into the Hessian and Delta matrices as it
+            finishes. The columns are the same as those computed one
+            by one, bit for bit, up to n_threads. The other methods
+            raise MapVarException with n_jobs > 1. Defaults to 1.
+
+        probe_builder: function (optional)
+            called once in each of n_jobs worker processes, returns a
+            function of a NumPy parameter vector returning the gradient
+            of loss and the constrained parameter vector. Serialized
+            with parallel.dumps, so that models built from lambdas can
+            be sent. Without probe_builder the columns are computed on
+            n_jobs threads of this process, which share its TensorFlow
+            thread pool.
+
+        n_threads: int (optional)
+            TensorFlow intra-op and inter-op threads of each worker
+            process, defaults to parallel.threads_per_worker(n_jobs)
+            so that the workers do not oversubscribe the cores. The
+            rounding of threaded reductions depends on the number of
+            threads, so the columns are the same bit for bit as those
+            computed in this process only with
+            tf.config.threading.get_intra_op_parallelism_threads().
+
         Returns:
         -------
         hessian: dataframe
             Hessian matrix of log posterior density.
             Dataframe is indexed by unconstrained parameter
             names and indices to flattened parameter vectors.
+            A scipy.sparse.csc_matrix when hessian_method="sparse"
+            and None when hessian_method="matrix_free".
 
         delta: dataframe
             Delta matrix for constrained parameter variance
-            calculation.
+            calculation, rows of var_params only.
             Dataframe is indexed by constrained and unconstrained
             parameter names and indices to flattened parameter
             vectors.
@@ -64,58 +876,75 @@ def get_hessian_delta_variance(unconstrained_par_vec, loss,
             Dataframe is indexed by constrained parameter names and
             indices to flattened parameter vectors.
     """
-    npar = len(unconstrained_par_vec)
-    hessian = np.zeros((npar,npar))
-    for iter_par in np.arange(0, npar):
-        parplus = unconstrained_par_vec.copy()
-        parplus[iter_par] = parplus[iter_par] \
-            + bandwidths[iter_par]
-        parminus = unconstrained_par_vec.copy()
-        parminus[iter_par] = parminus[iter_par] \
-            - bandwidths[iter_par]
-        gradplus = tfp.math.value_and_gradient(loss,
-            tf.convert_to_tensor(parplus,tf.float64))[1]
-        gradminus = tfp.math.value_and_gradient(loss,
-            tf.convert_to_tensor(parminus,tf.float64))[1]
-        hessian[:, iter_par] = (gradplus - gradminus) / (
-                                2 * bandwidths[iter_par])
-        consplus = constrained_par_vec_fcn(parplus)
-        consminus = constrained_par_vec_fcn(parminus)
-        if iter_par == 0:
-            delta = np.zeros((len(consplus), npar))
-        delta[:, iter_par] = (consplus - consminus) / (
-                            2 * bandwidths[iter_par])
-    hessian = (hessian+np.transpose(hessian))/2
-    constrained_var = np.matmul(
-                        np.matmul(delta,np.linalg.inv(hessian)),
-                            np.transpose(delta))
-    constrained_labels = []
-    for constrained_par in constrained_par_size:
-        size_constrained_par = \
-            constrained_par_size[constrained_par]
-        if size_constrained_par > 1:
-            for i in range(0,size_constrained_par):
-                constrained_labels.append(
-                    constrained_par +"_" + str(i))
+    if hessian_method not in HESSIAN_METHODS:
+        raise MapVarException('invalid value for hessian_method argument')
+    if n_jobs is not None and n_jobs > 1 and \
+            hessian_method != "finite_difference":
+        raise MapVarException('n_jobs requires hessian_method "finite_difference"')
+    unconstrained_layout = ParameterLayout.from_sizes(unconstrained_par_size)
+    constrained_layout = ParameterLayout.from_sizes(constrained_par_size)
+    var_index = get_var_index(constrained_layout, var_params)
+    if hessian_method == "matrix_free":
+        hessian = None
+        delta, constrained_var = get_matrix_free_delta_variance(
+            unconstrained_par_vec, loss, constrained_par_vec_fcn,
+            var_index)
+    elif hessian_method == "sparse":
+        if hessian_structure is None:
+            raise MapVarException('hessian_structure is required when hessian_method="sparse"')
+        hessian, delta = get_sparse_hessian_delta(
+            unconstrained_par_vec, _gradient_fcn(loss, loss_and_gradient),
+            constrained_par_vec_fcn, bandwidths,
+            unconstrained_layout, constrained_layout,
+            hessian_structure, loss_gradient_constrained)
+        hessian = ((hessian + hessian.transpose()) / 2).tocsc()
+        delta = delta[var_index].toarray()
+        constrained_var = get_sparse_constrained_variance(hessian, delta)
+    else:
+        if hessian_method == "autodiff":
+            hessian, delta = get_autodiff_hessian_delta(
+                unconstrained_par_vec, loss, constrained_par_vec_fcn)
+        elif hessian_method == "batched_finite_difference":
+            hessian, delta = _batched_finite_difference_hessian_delta(
+                unconstrained_par_vec, loss, constrained_par_vec_fcn,
+                bandwidths)
         else:
-            constrained_labels.append(constrained_par)
+            hessian, delta = _finite_difference_hessian_delta(
+                unconstrained_par_vec,
+                _probe_fcn(_gradient_fcn(loss, loss_and_gradient),
+                           constrained_par_vec_fcn,
+                           loss_gradient_constrained),
+                bandwidths, checkpoint, n_jobs, probe_builder, n_threads)
+        hessian = (hessian+np.transpose(hessian))/2
+        delta = delta[var_index]
+        constrained_var = get_constrained_variance(hessian, delta)
+    if not as_frames:
+        return hessian, delta, constrained_var
+    with profiling.phase("labeling"):
+        return _frames(hessian, delta, constrained_var, var_index,
+                       unconstrained_layout, constrained_layout)
+
+def _frames(hessian, delta, constrained_var, var_index,
+            unconstrained_layout, constrained_layout):
+    # pylint: disable=import-outside-toplevel
+    import pandas as pd
+    constrained_labels = [constrained_layout.labels[i] for i in var_index]
+    unconstrained_labels = unconstrained_layout.labels
     constrained_var = pd.DataFrame(
                         constrained_var,index=constrained_labels,
                             columns=constrained_labels)
-    unconstrained_labels = []
-    for unconstrained_par in unconstrained_par_size:
-        size_unconstrained_par = \
-            unconstrained_par_size[unconstrained_par]
-        if size_unconstrained_par > 1:
-            for i in range(0,size_unconstrained_par):
-                unconstrained_labels.append(
-                    unconstrained_par +"_" + str(i))
-        else:
-            unconstrained_labels.append(unconstrained_par)
-    hessian = pd.DataFrame(hessian,
-                index=unconstrained_labels,
-                    columns=unconstrained_labels)
+    if hessian is not None and not scipy.sparse.issparse(hessian):
+        hessian = pd.DataFrame(hessian,
+                    index=unconstrained_labels,
+                        columns=unconstrained_labels)
     delta = pd.DataFrame(delta,
                 index=constrained_labels,
                     columns=unconstrained_labels)
     return hessian, delta, constrained_var
+
+def _gradient_fcn(loss, loss_and_gradient):
+    if loss_and_gradient is not None:
+        return loss_and_gradient
+    def value_and_gradient(par_vec):
+        return tfp.math.value_and_gradient(loss, par_vec)
+    return value_and_gradient
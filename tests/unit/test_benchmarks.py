@@ -0,0 +1,32 @@
+''' Unit tests for the benchmark suite '''
+from unittest import TestCase
+import pytest
+
+from benchmarks.run_benchmarks import run_case, suite_cases, compare, \
+    import_times, BASE_CASE
+
+class TestBenchmarks(TestCase):
+    ''' Smoke tests of the synthetic models and benchmark runner '''
+
+    @pytest.mark.eager
+    def test_suite_cases(self):
+        cases = suite_cases("full")
+        assert BASE_CASE in cases
+        assert all(case["n_rows"] * case["n_params"] <= 10**8
+                   for case in cases)
+
+    @pytest.mark.eager
+    def test_run_case(self):
+        result = run_case({"n_rows": 50, "n_params": 3, "depth": 2,
+                           "n_constraints": 2}, repeat=1)
+        assert result["map"] > 0 and result["variance"] > 0
+        assert result["peak_rss_mb"] > 0
+        assert compare({"cases": [result]}, {"cases": [result]}) == 0
+
+    @pytest.mark.eager
+    def test_import_times(self):
+        times = import_times(repeat=1)
+        assert times["package"] < times["mapvar"], \
+            "importing the package is not lazy"
+        assert compare({"cases": [], "imports": times},
+                       {"cases": [], "imports": times}) == 0
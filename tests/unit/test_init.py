@@ -0,0 +1,37 @@
+''' Unit tests for the package namespace '''
+import importlib
+import os
+import subprocess
+import sys
+from unittest import TestCase
+import pytest
+
+import bayes_mapvar
+
+class TestInit(TestCase):
+    ''' Unit tests for the lazy public API '''
+
+    @pytest.mark.eager
+    def test_import_is_lightweight(self):
+        ''' importing the package does not import its dependencies '''
+        code = "import sys\nimport bayes_mapvar\n" + \
+            "print(sorted(set(sys.modules) & " + \
+            "{'tensorflow', 'tensorflow_probability', 'pandas', " + \
+            "'scipy.optimize'}))"
+        completed = subprocess.run([sys.executable, "-c", code],
+            capture_output=True, text=True, check=True,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        assert completed.stdout.strip() == "[]", \
+            "heavy modules imported: " + completed.stdout
+
+    @pytest.mark.eager
+    def test_public_api(self):
+        ''' exports resolve to the functions of their modules '''
+        submodule = importlib.import_module("bayes_mapvar.mapvar")
+        assert callable(bayes_mapvar.mapvar)
+        assert bayes_mapvar.mapvar is submodule.mapvar, \
+            "submodule import replaced the mapvar function"
+        assert bayes_mapvar.Profiler.__module__ == "bayes_mapvar.profiling"
+        assert set(bayes_mapvar.__all__) <= set(dir(bayes_mapvar))
+        with pytest.raises(AttributeError):
+            bayes_mapvar.not_a_function  # pylint: disable=pointless-statement
@@ -0,0 +1,148 @@
+''' Unit tests for MAP estimation utilities '''
+from unittest import TestCase
+import pytest
+
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from tests.data.load_data_csv import load_data_csv
+from tests.test_utils import reldif
+from bayes_mapvar.exceptions import MapVarException
+from bayes_mapvar.map_utils import ModelPlan, ParameterLayout, \
+    cache_by_vector, traverse_dist
+from bayes_mapvar.var_utils import get_hessian_coloring
+
+tfd = tfp.distributions
+tfb = tfp.bijectors
+
+class TestModelPlan(TestCase):
+    ''' Unit tests for the compiled model plan '''
+
+    @classmethod
+    def setUpClass(self):  # pylint: disable=bad-classmethod-argument
+        self.samp_data = load_data_csv("sim_ex.csv")
+        self.dist_dict = {}
+        self.dist_dict['beta'] = lambda unconstrained_beta: \
+            tfd.Deterministic(loc=unconstrained_beta)
+        self.dist_dict['unconstrained_alpha'] = \
+            tfd.TransformedDistribution(
+                tfd.Chi2(4*tf.ones(1,dtype=tf.float64)),tfb.Log())
+        self.dist_dict['alpha'] = lambda unconstrained_alpha: \
+            tfd.Deterministic(loc=tfb.Log().inverse(unconstrained_alpha))
+        self.dist_dict['y'] = lambda alpha, beta: \
+            tfd.Normal(loc = alpha + beta*self.samp_data['x'],
+                scale=tf.ones(1,dtype=tf.float64))
+        self.dist_dict['unconstrained_beta'] = \
+            tfd.Normal(tf.ones(1,dtype=tf.float64),1)
+
+    @pytest.mark.eager
+    def test_plan_order_and_kinds(self):
+        plan = ModelPlan(self.dist_dict, ['y'])
+        _, init = plan.initial_unconstrained(self.samp_data)
+        assert list(init.keys()) == \
+            ['unconstrained_beta', 'unconstrained_alpha']
+        assert plan.order.index('unconstrained_beta') < \
+            plan.order.index('beta') < plan.order.index('y')
+        assert plan.kinds == {'unconstrained_beta': 'free',
+            'beta': 'deterministic', 'unconstrained_alpha': 'free',
+            'alpha': 'deterministic', 'y': 'observed'}
+
+    @pytest.mark.eager
+    def test_plan_matches_traverse_dist(self):
+        plan = ModelPlan(self.dist_dict, ['y'])
+        par_dict = {'unconstrained_beta': tf.constant([1.5],tf.float64),
+            'unconstrained_alpha': tf.constant([1.0],tf.float64)}
+        log_prob, _, constrained, _ = traverse_dist(self.dist_dict,
+            self.samp_data, ['y'], generate="constrained",
+            unconstrained_par_dict=par_dict)
+        data = plan.prepare_data(self.samp_data)
+        assert reldif(plan.log_prob(par_dict, data).numpy(),
+            log_prob.numpy()[0]) < 1e-12
+        assert reldif(plan.constrained(par_dict, data)['alpha'].numpy(),
+            constrained['alpha'].numpy()) < 1e-12
+        _, post_pred = plan.post_pred(par_dict, data)
+        assert post_pred['y'].shape == (len(self.samp_data),)
+        joint_log_prob, joint_constrained = \
+            plan.log_prob_and_constrained(par_dict, data)
+        assert reldif(joint_log_prob.numpy(), log_prob.numpy()[0]) < 1e-12
+        assert reldif(joint_constrained['alpha'].numpy(),
+            constrained['alpha'].numpy()) < 1e-12
+
+    @pytest.mark.eager
+    def test_plan_cycle(self):
+        dist_dict = {'a': lambda b: tfd.Deterministic(loc=b),
+            'b': lambda a: tfd.Deterministic(loc=a)}
+        with pytest.raises(MapVarException):
+            ModelPlan(dist_dict, [])
+
+    @pytest.mark.eager
+    def test_plan_hessian_structure(self):
+        dist_dict = {'mu_a': tfd.Normal(tf.zeros(1,dtype=tf.float64),1),
+            'mu_b': tfd.Normal(tf.zeros(1,dtype=tf.float64),1),
+            'unconstrained_s': tfd.Normal(tf.zeros(1,dtype=tf.float64),1),
+            'y_a': lambda mu_a: tfd.Normal(mu_a, 1),
+            'y_b': lambda mu_b: tfd.Normal(mu_b, 1)}
+        constraints = {'s': lambda unconstrained_s: \
+            tf.exp(unconstrained_s)}
+        plan = ModelPlan(dist_dict, ['y_a', 'y_b'], constraints)
+        data = {'y_a': [1.0, 2.0], 'y_b': [3.0]}
+        _, init = plan.initial_unconstrained(data)
+        terms, constrained_deps = plan.hessian_structure()
+        assert {'mu_a', 'mu_b'} not in terms
+        assert constrained_deps == {'s': {'unconstrained_s'}}
+        colors, _ = get_hessian_coloring(
+            {key: 1 for key in init}, (terms, constrained_deps))
+        assert list(colors) == [0, 0, 0]
+
+    @pytest.mark.eager
+    def test_parameter_layout(self):
+        par_dict = {'a': tf.constant([[1.0, 2.0], [3.0, 4.0]], tf.float64),
+            'b': tf.constant([5.0], tf.float64),
+            'c': tf.constant([6.0, 7.0], tf.float64)}
+        layout = ParameterLayout.from_par_dict(par_dict)
+        par_vec = layout.pack(par_dict)
+        assert par_vec.numpy().tolist() == [1, 2, 3, 4, 5, 6, 7]
+        unpacked = layout.unpack(par_vec)
+        assert unpacked['a'].shape == (2, 2)
+        assert unpacked['c'].numpy().tolist() == [6, 7]
+        batch = layout.unpack(tf.stack([par_vec, 2*par_vec]))
+        assert batch['a'].shape == (2, 2, 2)
+        assert batch['b'].numpy().tolist() == [[5], [10]]
+        assert layout.labels == ['a_0', 'a_1', 'a_2', 'a_3', 'b',
+            'c_0', 'c_1']
+        assert layout.index(['c', 'b']).tolist() == [5, 6, 4]
+        with pytest.raises(MapVarException):
+            layout.index(['d'])
+
+    @pytest.mark.eager
+    def test_plan_dtype(self):
+        dist_dict = dict(self.dist_dict)
+        dist_dict['y'] = lambda alpha, beta, x: \
+            tfd.Normal(loc = alpha + beta*x, scale=1.0)
+        par_dict = {'unconstrained_beta': tf.constant([1.5],tf.float64),
+            'unconstrained_alpha': tf.constant([1.0],tf.float64)}
+        plan64 = ModelPlan(dist_dict, ['y'])
+        plan32 = ModelPlan(dist_dict, ['y'], dtype=tf.float32)
+        data = plan32.prepare_data(self.samp_data)
+        assert data['x'].dtype == tf.float32
+        log_prob = plan32.log_prob(par_dict, data)
+        assert log_prob.dtype == tf.float64, "not accumulated in float64"
+        assert reldif(log_prob.numpy(), plan64.log_prob(par_dict,
+            plan64.prepare_data(self.samp_data)).numpy()) < 1e-6
+        assert plan32.constrained(par_dict, data)['alpha'].dtype == \
+            tf.float32
+
+    def test_cache_by_vector(self):
+        calls = []
+        def function(par_vec):
+            calls.append(par_vec.copy())
+            return par_vec.sum()
+        cached = cache_by_vector(function, maxsize=2)
+        assert cached([1.0, 2.0]) == 3.0
+        assert cached(tf.constant([1.0, 2.0], tf.float64)) == 3.0
+        assert len(calls) == 1, "repeated vector was recomputed"
+        cached([0.0, 1.0])
+        cached([0.0, 2.0])
+        cached([1.0, 2.0])
+        assert len(calls) == 4, "least recently used vector was kept"
+        assert cached.cache_info().hits == 1
@@ -1,7 +1,9 @@
 ''' Unit tests for MAP and posterior variance estimation '''
 import os
+import tempfile
 from unittest import TestCase
 import pytest
+import numpy as np
 import pandas as pd
 
 import tensorflow as tf
@@ -9,7 +11,11 @@ import tensorflow_probability as tfp
 
 from tests.data.load_data_csv import load_data_csv
 from tests.test_utils import reldif
-from bayes_mapvar.mapvar import mapvar
+from bayes_mapvar.mapvar import mapvar, mapvar_batch, mapvar_update, \
+    compare_models, _Preconditioner
+from bayes_mapvar.result import MapVarResult
+from bayes_mapvar.profiling import Profiler
+from bayes_mapvar.exceptions import MapVarException
 
 tfd = tfp.distributions
 tfb = tfp.bijectors
@@ -121,3 +127,531 @@ class TestMapVar(TestCase):
         assert reldif(m2[3].loc['unconstrained_beta', \
             'unconstrained_alpha'],-2.879597369813636) < 1e-4, \
             "map and posterior variance estimation failed"
+
+    def _sim_dist_dict(self):
+        samp_x = tf.constant(self.samp_data['x'], dtype=tf.float64)
+        dist_dict = {}
+        dist_dict['unconstrained_beta'] = \
+            tfd.Normal(tf.ones(1,dtype=tf.float64),1)
+        dist_dict['unconstrained_alpha'] = tfd.TransformedDistribution(
+            tfd.Chi2(4*tf.ones(1,dtype=tf.float64)),tfb.Log())
+        dist_dict['y'] = lambda alpha, beta: \
+            tfd.Normal(loc = alpha + beta*samp_x,scale=tf.ones(1,dtype=tf.float64))
+        constraints = {}
+        constraints['beta'] = lambda unconstrained_beta: unconstrained_beta
+        constraints['alpha'] = lambda unconstrained_alpha: \
+            tfb.Log().inverse(unconstrained_alpha)
+        return dist_dict, constraints
+
+    @pytest.mark.graph
+    def test_mapvar_sim_compiled(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        eager = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False)
+        for compile_mode in ["graph", "xla"]:
+            compiled = mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                compile_mode=compile_mode)
+
+            assert reldif(compiled[0]['unconstrained_alpha'].numpy(),
+                eager[0]['unconstrained_alpha'].numpy()) < 1e-6, \
+                "compiled map estimation failed"
+
+            assert reldif(compiled[5].values, eager[5].values) < 1e-6, \
+                "compiled posterior variance estimation failed"
+
+    @pytest.mark.eager
+    def test_mapvar_sim_autodiff(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False,
+            hessian_method="autodiff")
+
+        assert reldif(m0[5].loc['alpha','alpha'], \
+            0.009973651034083814)  < 1e-4, \
+            "autodiff posterior variance estimation failed"
+
+        assert reldif(m0[5].loc['beta','alpha'], \
+            0.00010401063160407793) < 1e-4, \
+            "autodiff posterior variance estimation failed"
+
+        assert reldif(m0[4].loc['alpha','unconstrained_alpha'], \
+            2.695193593504064) < 1e-4, \
+            "autodiff posterior variance estimation failed"
+
+        assert reldif(m0[3].loc['unconstrained_beta', \
+            'unconstrained_alpha'],-2.879597369813636) < 1e-4, \
+            "autodiff posterior variance estimation failed"
+
+    @pytest.mark.eager
+    def test_mapvar_sim_batched_finite_difference(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False,
+            hessian_method="batched_finite_difference")
+
+        assert reldif(m0[5].loc['alpha','alpha'], \
+            0.009973651034083814)  < 1e-4, \
+            "batched finite difference posterior variance estimation failed"
+
+        assert reldif(m0[5].loc['beta','alpha'], \
+            0.00010401063160407793) < 1e-4, \
+            "batched finite difference posterior variance estimation failed"
+
+        assert reldif(m0[4].loc['alpha','unconstrained_alpha'], \
+            2.695193593504064) < 1e-4, \
+            "batched finite difference posterior variance estimation failed"
+
+        assert reldif(m0[3].loc['unconstrained_beta', \
+            'unconstrained_alpha'],-2.879597369813636) < 1e-4, \
+            "batched finite difference posterior variance estimation failed"
+
+    @pytest.mark.eager
+    def test_mapvar_sim_matrix_free(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False,
+            hessian_method="matrix_free", var_params=['alpha'])
+
+        assert m0[3] is None, \
+            "matrix free posterior variance estimation failed"
+
+        assert list(m0[5].index) == ['alpha'], \
+            "matrix free posterior variance estimation failed"
+
+        assert reldif(m0[5].loc['alpha','alpha'], \
+            0.009973651034083814)  < 1e-4, \
+            "matrix free posterior variance estimation failed"
+
+        assert reldif(m0[4].loc['alpha','unconstrained_alpha'], \
+            2.695193593504064) < 1e-4, \
+            "matrix free posterior variance estimation failed"
+
+    @pytest.mark.eager
+    def test_mapvar_sim_sparse(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False,
+            hessian_method="sparse")
+
+        assert reldif(m0[5].loc['alpha','alpha'], \
+            0.009973651034083814)  < 1e-4, \
+            "sparse posterior variance estimation failed"
+
+        assert reldif(m0[5].loc['beta','alpha'], \
+            0.00010401063160407793) < 1e-4, \
+            "sparse posterior variance estimation failed"
+
+        assert reldif(m0.hessian_array[1, 0],-2.879597369813636) < 1e-4, \
+            "sparse posterior variance estimation failed"
+
+    @pytest.mark.eager
+    def test_mapvar_sim_var_params(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False,
+            var_params=['beta'])
+
+        assert list(m0[5].index) == ['beta'], \
+            "posterior variance subset estimation failed"
+
+        assert reldif(m0[5].loc['beta','beta'], \
+            0.009761802606078345) < 1e-4, \
+            "posterior variance subset estimation failed"
+
+    @pytest.mark.slow
+    def test_mapvar_sim_multistart(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints,
+            n_starts=3, n_workers=2, seed=1)
+
+        assert len(m0[2].candidates) == 3, \
+            "multi-start map estimation failed"
+
+        assert m0[2].log_posterior == \
+            max(cand.log_posterior for cand in m0[2].candidates), \
+            "multi-start map estimation failed"
+
+        assert reldif(m0[0]['unconstrained_beta'].numpy()[0], \
+            1.51747775) < 1e-4, "multi-start map estimation failed"
+
+    @pytest.mark.eager
+    def test_mapvar_batch(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        dist_dict['y'] = lambda alpha, beta, x: \
+            tfd.Normal(loc = alpha + beta*x,scale=tf.ones(1,dtype=tf.float64))
+        datasets = [self.samp_data.iloc[:60], self.samp_data.iloc[60:]]
+        mb = mapvar_batch(dist_dict, datasets,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False)
+
+        for i, dataset in enumerate(datasets):
+            m0 = mapvar(dist_dict, dataset,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False)
+
+            assert reldif(mb[0]['unconstrained_alpha'][i].numpy(), \
+                m0[0]['unconstrained_alpha'].numpy()) < 1e-4, \
+                "batched map estimation failed"
+
+            assert reldif(mb[5][i], m0[5].values) < 1e-4, \
+                "batched posterior variance estimation failed"
+
+    @pytest.mark.eager
+    def test_mapvar_warm_start_update(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        dist_dict['y'] = lambda alpha, beta, x: \
+            tfd.Normal(loc = alpha + beta*x,scale=tf.ones(1,dtype=tf.float64))
+        old_data = self.samp_data.iloc[:90]
+        new_data = self.samp_data.iloc[90:]
+        m0 = mapvar(dist_dict, old_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False)
+        m1 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, init=m0)
+
+        assert reldif(m1[0]['unconstrained_alpha'].numpy()[0], \
+            0.99147004) < 1e-4, "warm started map estimation failed"
+
+        # the L-BFGS estimate is factored on the span of its pairs
+        preconditioner = _Preconditioner(inverse_hessian=m1[2].hess_inv)
+        identity = np.eye(len(m1[2].x))
+        factor = np.stack([preconditioner.to_par(vec) for vec in identity],
+                          axis=1)
+        assert reldif(np.matmul(factor, np.transpose(factor)),
+            m1[2].hess_inv.matmat(identity)) < 1e-8, \
+            "preconditioner factor failed"
+        assert reldif(np.stack([preconditioner.to_grad(vec)
+                                for vec in identity], axis=1),
+                      np.transpose(factor)) < 1e-12
+        m4 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, init=m1)
+        assert reldif(m4[0]['unconstrained_alpha'].numpy()[0], \
+            0.99147004) < 1e-4, "repeated warm start failed"
+
+        m2 = mapvar_update(m0, dist_dict, new_data,
+            observed_varnames=['y'], constrained_fcns=constraints)
+
+        assert reldif(m2[0]['unconstrained_alpha'].numpy()[0], \
+            0.99147004) < 1e-3, "newton update of map estimation failed"
+
+        assert reldif(m2[5].loc['beta','beta'], \
+            0.009761802606078345) < 1e-3, \
+            "newton update of posterior variance estimation failed"
+
+        m3 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False)
+        assert reldif(m2.log_marginal_likelihood,
+            m3.log_marginal_likelihood) < 1e-3, \
+            "newton update of log marginal likelihood failed"
+
+    @pytest.mark.eager
+    def test_mapvar_chunked_data(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        dist_dict['y'] = lambda alpha, beta, x: \
+            tfd.Normal(loc = alpha + beta*x,scale=tf.ones(1,dtype=tf.float64))
+        chunks = [self.samp_data.iloc[start:start + 30]
+            for start in range(0, len(self.samp_data), 30)]
+        dataset = tf.data.Dataset.from_tensor_slices(
+            {'x': self.samp_data['x'].values,
+             'y': self.samp_data['y'].values}).batch(30)
+        for observed_data in [chunks, dataset]:
+            m = mapvar(dist_dict, observed_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False)
+
+            assert reldif(m[0]['unconstrained_alpha'].numpy()[0], \
+                0.99147004) < 1e-4, "chunked map estimation failed"
+
+            assert reldif(m[5].loc['beta','alpha'], \
+                0.00010401063160407793) < 1e-3, \
+                "chunked posterior variance estimation failed"
+
+        with tempfile.TemporaryDirectory() as path, Profiler() as profiler:
+            m = mapvar(dist_dict, chunks, observed_varnames=['y'],
+                constrained_fcns=constraints, checkpoint_dir=path)
+        assert profiler.counts["loss_and_gradient"] == m[2].nfev, \
+            "checkpoints evaluated the loss again"
+
+    @pytest.mark.slow
+    def test_mapvar_sharded_data(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        dist_dict['y'] = lambda alpha, beta, x: \
+            tfd.Normal(loc = alpha + beta*x,scale=tf.ones(1,dtype=tf.float64))
+        m = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False, n_shards=2)
+
+        assert reldif(m[0]['unconstrained_alpha'].numpy()[0], \
+            0.99147004) < 1e-4, "sharded map estimation failed"
+
+        assert reldif(m[5].loc['beta','alpha'], \
+            0.00010401063160407793) < 1e-3, \
+            "sharded posterior variance estimation failed"
+
+        # threads probing the Hessian share the shard workers
+        m1 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False, n_shards=2,
+            n_jobs=2)
+        assert np.array_equal(m1.hessian_array, m.hessian_array), \
+            "threaded sharded hessian differs from serial"
+        with pytest.raises(MapVarException):
+            mapvar(dist_dict, {'y': self.samp_data['y'].to_numpy()},
+                constrained_fcns=constraints, n_shards=2)
+
+    @pytest.mark.eager
+    def test_mapvar_result(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False)
+        unconstrained_map, _, _, hessian, _, variance = m0
+
+        assert len(m0) == 6
+        assert unconstrained_map is m0.unconstrained_par_map
+        assert hessian is m0.hessian, "labeled hessian is not cached"
+        assert [field is value for field, value in zip(
+            m0.fields(slice(3, 6, 2)), (hessian, variance))] == [True, True]
+        assert reldif(m0.covariance('beta', 'alpha')[0, 0], \
+            variance.loc['beta', 'alpha']) < 1e-12, \
+            "covariance block lookup failed"
+        assert m0.covariance('alpha').shape == (1, 1)
+        assert isinstance(m0.variance_array, np.ndarray)
+
+    @pytest.mark.eager
+    def test_mapvar_result_save_load(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False)
+        with tempfile.TemporaryDirectory() as path:
+            m0.save(path)
+            m1 = MapVarResult.load(path)
+
+            assert isinstance(m1.variance_array, np.memmap)
+            assert reldif(m1[5].loc['beta','beta'], \
+                0.009761802606078345) < 1e-4, "loaded variance differs"
+            assert reldif(m1[0]['unconstrained_alpha'].numpy()[0], \
+                0.99147004) < 1e-4, "loaded map estimate differs"
+            assert m1[2].success == m0[2].success
+            del m1
+
+    @pytest.mark.eager
+    def test_mapvar_result_sample(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False)
+        draws = m0.sample(2000, seed=1, chunk_size=700)
+
+        assert draws['constrained']['beta'].shape == (2000, 1)
+        assert draws['post_pred']['y'].shape == (2000, len(self.samp_data))
+        assert reldif(np.var(draws['constrained']['beta'].numpy()), \
+            0.009761802606078345) < 0.1, "laplace sampling failed"
+        assert np.array_equal(draws['post_pred']['y'].numpy(),
+            m0.sample(2000, seed=1, chunk_size=700)['post_pred']['y'].numpy())
+
+    @pytest.mark.eager
+    def test_mapvar_sim_optimizers(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        for optimizer in ["trust-krylov", "trust-exact", "tfp-lbfgs"]:
+            m0 = mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                optimizer=optimizer)
+
+            assert reldif(m0[0]['unconstrained_beta'].numpy()[0], \
+                1.51747775) < 1e-4, optimizer + " map estimation failed"
+
+            assert reldif(m0[5].loc['beta','alpha'], \
+                0.00010401063160407793) < 1e-3, \
+                optimizer + " posterior variance estimation failed"
+
+            if optimizer == "trust-exact":
+                assert np.allclose(m0.hessian_array, m0[2].hess), \
+                    "final newton hessian was not reused"
+
+    @pytest.mark.eager
+    def test_mapvar_profiler(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        with Profiler(node_timing=True) as profiler:
+            m0 = mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False)
+            m0.variance  # pylint: disable=pointless-statement
+
+        assert profiler.counts["loss_and_gradient"] > 0
+        for phase in ["init_traversal", "optimize", "optimizer_iteration",
+                      "variance_stage", "hessian_probe", "variance_solve",
+                      "labeling"]:
+            assert profiler.phases[phase][1] > 0, phase + " not recorded"
+        assert profiler.nodes['y'][1] > 0, "node timing failed"
+        assert len(profiler.iterations) == m0[2].nit
+        assert profiler.summary().loc[('phase', 'optimize'), 'calls'] == 1
+
+    @pytest.mark.eager
+    def test_mapvar_log_marginal_likelihood(self):
+        # Laplace approximation is exact for a linear Gaussian model:
+        # beta ~ N(1, 1), y ~ N(beta x, 1) gives y ~ N(x, I + x x')
+        dist_dict = {'unconstrained_beta':
+                tfd.Normal(tf.ones(1, dtype=tf.float64), 1),
+            'y': lambda unconstrained_beta, x: tfd.Normal(
+                loc=unconstrained_beta*x, scale=tf.ones(1,dtype=tf.float64))}
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'], skip_var=False,
+            constrained_fcns={'beta': lambda unconstrained_beta:
+                unconstrained_beta},
+            hessian_method="autodiff")
+        x = self.samp_data['x'].to_numpy()
+        resid = self.samp_data['y'].to_numpy() - x
+        xx = np.dot(x, x)
+        exact = -0.5*(len(x)*np.log(2*np.pi) + np.log(1 + xx) +
+            np.dot(resid, resid) - np.dot(x, resid)**2 / (1 + xx))
+
+        assert reldif(m0.log_marginal_likelihood, exact) < 1e-8, \
+            "laplace log marginal likelihood failed"
+
+    @pytest.mark.eager
+    def test_compare_models(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        dist_dict['y'] = lambda alpha, beta, x: \
+            tfd.Normal(loc = alpha + beta*x,scale=tf.ones(1,dtype=tf.float64))
+        null_dict = {'unconstrained_alpha': dist_dict['unconstrained_alpha'],
+            'y': lambda alpha: tfd.Normal(loc=alpha,
+                scale=tf.ones(1,dtype=tf.float64))}
+        table = compare_models({
+            'null': {'dist_dict': null_dict, 'observed_varnames': ['y'],
+                'constrained_fcns': {'alpha': constraints['alpha']}},
+            'linear': {'dist_dict': dist_dict, 'observed_varnames': ['y'],
+                'constrained_fcns': constraints}},
+            self.samp_data, n_workers=1)
+
+        assert list(table.index) == ['linear', 'null']
+        assert table.loc['linear', 'delta'] == 0
+        assert reldif(table['weight'].sum(), 1.0) < 1e-12
+        assert table.loc['linear', 'n_params'] == 2
+        assert table['error'].isna().all()
+
+    @pytest.mark.eager
+    def test_mapvar_float32(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        dist_dict['y'] = lambda alpha, beta, x: \
+            tfd.Normal(loc = alpha + beta*x, scale=1.0)
+        m0 = mapvar(dist_dict, self.samp_data,
+            observed_varnames=['y'],
+            constrained_fcns=constraints, skip_var=False,
+            dtype=tf.float32)
+
+        assert reldif(m0[0]['unconstrained_beta'].numpy()[0], \
+            1.51747775) < 1e-4, "float32 map estimation failed"
+        assert reldif(m0[5].loc['beta','alpha'], \
+            0.00010401063160407793) < 1e-3, \
+            "float32 posterior variance estimation failed"
+        assert m0[1]['alpha'].dtype == tf.float64
+        assert m0.data['x'].dtype == tf.float64, "variance not in float64"
+
+        # priors built in float32 are cast in the float64 variance stage
+        dist_dict['unconstrained_beta'] = \
+            tfd.Normal(tf.ones(1,dtype=tf.float32),1)
+        dist_dict['unconstrained_alpha'] = tfd.TransformedDistribution(
+            tfd.Chi2(4*tf.ones(1,dtype=tf.float32)),tfb.Log())
+        for hessian_method in ["finite_difference", "autodiff"]:
+            m1 = mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                hessian_method=hessian_method, dtype=tf.float32)
+            assert reldif(m1[5].values, m0[5].values) < 1e-3, \
+                "float32 prior variance estimation failed"
+
+    @pytest.mark.eager
+    def test_mapvar_checkpoint_resume(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        with tempfile.TemporaryDirectory() as path:
+            m0 = mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                checkpoint_dir=path, checkpoint_interval=0)
+            for name in ["manifest.json", "optimizer.npz", "hessian.npz"]:
+                assert os.path.exists(os.path.join(path, name)), name
+
+            # interrupted after the first Hessian column and during the
+            # optimization
+            with np.load(os.path.join(path, "hessian.npz")) as arrays:
+                state = {key: arrays[key] for key in arrays.files}
+            state["done"][1:] = False
+            state["hessian"][:, 1:] = 0
+            np.savez(os.path.join(path, "hessian.npz"), **state)
+            with np.load(os.path.join(path, "optimizer.npz")) as arrays:
+                state = {key: arrays[key] for key in arrays.files}
+            state["done"] = np.asarray(False)
+            np.savez(os.path.join(path, "optimizer.npz"), **state)
+
+            m1 = mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                resume_from=path, checkpoint_interval=0)
+            m2 = mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                resume_from=path)
+
+        assert reldif(m1[0]['unconstrained_beta'].numpy()[0], \
+            1.51747775) < 1e-4, "resumed map estimation failed"
+        assert reldif(m1[5].loc['beta','beta'], \
+            0.009761802606078345) < 1e-4, "resumed variance failed"
+        assert m1[2].nit >= m0[2].nit
+        assert np.array_equal(m2[2].x, m1[2].x), "finished fit was repeated"
+        assert np.array_equal(m2.hessian_array, m1.hessian_array)
+
+    @pytest.mark.eager
+    def test_mapvar_parallel_hessian(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        fits = [mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                n_jobs=n_jobs)
+            for n_jobs in [None, 2]]
+
+        assert np.array_equal(fits[1].hessian_array, fits[0].hessian_array), \
+            "parallel hessian differs from serial"
+        assert np.array_equal(fits[1].delta_array, fits[0].delta_array)
+        assert np.array_equal(fits[1].variance_array, fits[0].variance_array)
+        with pytest.raises(MapVarException):
+            mapvar(dist_dict, self.samp_data, observed_varnames=['y'],
+                constrained_fcns=constraints, hessian_backend="gpu")
+        with pytest.raises(MapVarException):
+            mapvar(dist_dict, self.samp_data, observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                hessian_method="autodiff", n_jobs=2)
+
+    @pytest.mark.slow
+    def test_mapvar_process_hessian(self):
+        dist_dict, constraints = self._sim_dist_dict()
+        fits = [mapvar(dist_dict, self.samp_data,
+                observed_varnames=['y'],
+                constrained_fcns=constraints, skip_var=False,
+                n_jobs=n_jobs, hessian_backend=backend, n_threads=n_threads)
+            for n_jobs, backend, n_threads in [
+                (None, "threads", None), (2, "processes", None),
+                (2, "processes",
+                 tf.config.threading.get_intra_op_parallelism_threads())]]
+
+        assert reldif(fits[1].variance_array, fits[0].variance_array) \
+            < 1e-6, "process hessian failed"
+        assert np.array_equal(fits[2].hessian_array, fits[0].hessian_array), \
+            "process hessian differs from serial"
+        assert np.array_equal(fits[2].delta_array, fits[0].delta_array)
+        assert np.array_equal(fits[2].variance_array, fits[0].variance_array)
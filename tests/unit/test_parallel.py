@@ -0,0 +1,35 @@
+''' Unit tests for the worker process pools '''
+import functools
+import multiprocessing
+import os
+import threading
+from unittest import TestCase
+import pytest
+
+from bayes_mapvar.parallel import ShardPool
+
+def _shared_memory_blocks():
+    if not os.path.isdir("/dev/shm"):
+        return set()
+    return set(os.listdir("/dev/shm"))
+
+class TestParallel(TestCase):
+    ''' Unit tests for ShardPool '''
+
+    @pytest.mark.slow
+    def test_shard_pool_failed_start(self):
+        ''' workers and shared memory are released when start-up fails '''
+        blocks = _shared_memory_blocks()
+        # the second builder does not serialize after the first worker
+        # started, the first worker exits while building
+        for builders, error in [
+                ([functools.partial(abs, 1),
+                  functools.partial(abs, threading.Lock())], TypeError),
+                ([functools.partial(os._exit, 1)],  # pylint: disable=protected-access
+                 EOFError)]:
+            with pytest.raises(error):
+                ShardPool(builders, 3)
+            assert multiprocessing.active_children() == [], \
+                "shard workers leaked"
+            assert _shared_memory_blocks() == blocks, \
+                "shared memory leaked"
@@ -0,0 +1,86 @@
+''' Unit tests for posterior variance utilities '''
+from unittest import TestCase
+import pytest
+import numpy as np
+import scipy.sparse
+
+from tests.test_utils import reldif
+from bayes_mapvar.exceptions import MapVarException
+from bayes_mapvar.var_utils import get_constrained_variance, \
+    get_sparse_constrained_variance, get_sparse_hessian_delta, \
+    get_bandwidths
+
+class TestVarUtils(TestCase):
+    ''' Unit tests for posterior variance utilities '''
+
+    @pytest.mark.eager
+    def test_constrained_variance(self):
+        hessian = np.array([[4.0, 1.0, 0.5], [1.0, 3.0, 0.2],
+            [0.5, 0.2, 2.0]])
+        delta = np.array([[1.0, 0.0, 2.0], [0.0, 3.0, 1.0]])
+        expected = np.matmul(np.matmul(delta, np.linalg.inv(hessian)),
+            np.transpose(delta))
+        assert reldif(get_constrained_variance(hessian, delta),
+            expected) < 1e-12
+
+    @pytest.mark.eager
+    def test_constrained_variance_not_positive_definite(self):
+        hessian = np.array([[1.0, 2.0], [2.0, 1.0]])
+        with pytest.raises(MapVarException):
+            get_constrained_variance(hessian, np.eye(2))
+
+    @pytest.mark.eager
+    def test_sparse_constrained_variance(self):
+        hessian = np.array([[4.0, 1.0, 0.0], [1.0, 3.0, 0.2],
+            [0.0, 0.2, 2.0]])
+        delta = np.array([[1.0, 0.0, 2.0], [0.0, 3.0, 1.0]])
+        assert reldif(get_sparse_constrained_variance(
+            scipy.sparse.csc_matrix(hessian), delta),
+            get_constrained_variance(hessian, delta)) < 1e-12
+        for hessian in [-np.eye(2), np.array([[1.0, 2.0], [2.0, 1.0]]),
+                        np.array([[0.0, 1.0], [1.0, 0.0]])]:
+            with pytest.raises(MapVarException):
+                get_sparse_constrained_variance(
+                    scipy.sparse.csc_matrix(hessian), np.eye(2))
+
+    @pytest.mark.eager
+    def test_sparse_hessian_random_effects(self):
+        # y_g ~ N(mu + u_g, 1), u_g ~ N(0, exp(tau)^2), mu, tau ~ N(0, 1)
+        n_groups = 50
+        y = np.random.default_rng(0).normal(size=n_groups)
+        calls = []
+
+        def loss_gradient_constrained(par_vec):
+            calls.append(1)
+            mu, u, tau = par_vec[0], par_vec[1:-1], par_vec[-1]
+            resid = y - mu - u
+            precision = np.exp(-2*tau)
+            loss = np.sum(resid**2)/2 + np.sum(u**2)*precision/2 + \
+                n_groups*tau + mu**2/2 + tau**2/2
+            gradient = np.concatenate([[-np.sum(resid) + mu],
+                -resid + u*precision,
+                [-np.sum(u**2)*precision + n_groups + tau]])
+            return loss, gradient, np.concatenate([[np.exp(tau)], u])
+
+        par_vec = np.concatenate([[0.3], y/2, [-0.5]])
+        u, precision = par_vec[1:-1], np.exp(1.0)
+        expected = np.zeros((n_groups + 2, n_groups + 2))
+        expected[0, 0] = n_groups + 1
+        expected[0, 1:-1] = expected[1:-1, 0] = 1
+        expected[1:-1, 1:-1] = np.diag(np.full(n_groups, 1 + precision))
+        expected[-1, 1:-1] = expected[1:-1, -1] = -2*u*precision
+        expected[-1, -1] = 2*np.sum(u**2)*precision + 1
+        hessian, delta = get_sparse_hessian_delta(par_vec, None, None,
+            get_bandwidths(par_vec), {'mu': 1, 'u': n_groups, 'tau': 1},
+            {'sd': 1, 'u_c': n_groups},
+            ([{'mu'}, {'tau'}, {'u', 'tau'}, {'mu', 'u'}],
+             {'sd': {'tau'}, 'u_c': {'u'}}),
+            loss_gradient_constrained)
+        hessian = (hessian + hessian.transpose()) / 2
+
+        assert len(calls) < 25, "random effects not probed together"
+        assert hessian.nnz == (n_groups + 2) + 4*n_groups
+        assert np.max(np.abs(hessian.toarray() - expected)) < 1e-6
+        assert delta.nnz == n_groups + 1
+        assert np.max(np.abs(delta.toarray()[1:, 1:-1] -
+            np.eye(n_groups))) < 1e-8